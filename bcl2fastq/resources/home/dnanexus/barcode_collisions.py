@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+
+"""
+Pre-flight barcode collision analysis for bcl2fastq.
+
+bcl2fastq assigns a read to a sample when each index read is within the
+allowed number of mismatches of the sample barcode. Two samples collide when
+a single read could be assigned to both, i.e. when for every index read the
+Hamming distance between their barcodes is at most twice the number of
+allowed mismatches. bcl2fastq refuses to run in that case, so the largest
+safe mismatch tolerance is chosen here, before any conversion is attempted.
+
+Barcodes are packed into a (samples x bases) uint8 matrix, and the pairwise
+Hamming distance matrix of each index read is computed with NumPy in blocks
+of rows, which keeps memory bounded for 1536-plex pools.
+"""
+
+import json
+import itertools
+
+import numpy
+
+# Mismatch tolerances bcl2fastq accepts for an index read
+MISMATCH_VALUES = (0, 1, 2)
+# Rows of the distance matrix computed per NumPy block
+BLOCK_SIZE = 256
+
+BASE_CODES = numpy.zeros(256, dtype=numpy.uint8)
+for code, base in enumerate('ACGTN'):
+    BASE_CODES[ord(base)] = code
+    BASE_CODES[ord(base.lower())] = code
+
+def split_barcodes(barcodes):
+    ''' Description: Split barcodes into their index reads. Dual-index
+    barcodes are joined with '-', as in SampleSheet.get_barcodes(). Returns a
+    list of index read sequences for each index read, or an empty list if
+    the lane is not barcoded.
+    '''
+
+    split = [barcode.rstrip('-').split('-') for barcode in barcodes if barcode.rstrip('-')]
+    if len(split) != len(barcodes):
+        return []
+    index_reads = min([len(indexes) for indexes in split])
+    return [[indexes[read] for indexes in split] for read in range(index_reads)]
+
+def encode_barcodes(sequences):
+    ''' Description: Pack barcode sequences into a (samples x bases) uint8
+    matrix with one code per base. Sequences are truncated to the shortest
+    one, since bcl2fastq only reads that many index bases.
+    '''
+
+    length = min([len(sequence) for sequence in sequences])
+    packed = numpy.frombuffer(''.join([sequence[:length] for sequence in sequences]).encode('ascii'),
+                              dtype=numpy.uint8)
+    return BASE_CODES[packed].reshape(len(sequences), length)
+
+def hamming_distances(encoded):
+    ''' Description: Returns the pairwise Hamming distance matrix of an
+    encoded barcode matrix.
+    '''
+
+    samples = encoded.shape[0]
+    distances = numpy.empty((samples, samples), dtype=numpy.uint8)
+    for start in range(0, samples, BLOCK_SIZE):
+        block = encoded[start:start + BLOCK_SIZE]
+        distances[start:start + BLOCK_SIZE] = (block[:, numpy.newaxis, :] != encoded[numpy.newaxis, :, :]).sum(axis=2)
+    return distances
+
+def find_collisions(distances, mismatches):
+    ''' Description: Returns the (i, j) sample pairs, i < j, that collide when
+    'mismatches[read]' mismatches are allowed in each index read.
+    '''
+
+    collides = numpy.ones(distances[0].shape, dtype=bool)
+    for read_distances, read_mismatches in zip(distances, mismatches):
+        collides &= read_distances <= 2 * read_mismatches
+    rows, columns = numpy.nonzero(numpy.triu(collides, k=1))
+    return list(zip(rows.tolist(), columns.tolist()))
+
+def select_mismatches(distances, candidates):
+    ''' Description: Returns the safe mismatch tolerance from 'candidates'
+    that allows the most mismatches, preferring the most even split between
+    index reads, or None if none is safe.
+    '''
+
+    safe = [mismatches for mismatches in candidates if not find_collisions(distances, mismatches)]
+    if not safe:
+        return None
+    return max(safe, key=lambda mismatches: (sum(mismatches), min(mismatches)))
+
+def analyze_barcodes(barcodes, bcl2fastq_version=2, max_mismatches=1):
+    ''' Description: Analyze the barcodes of a lane and select the largest
+    safe barcode mismatch tolerance of at most 'max_mismatches'. bcl2fastq v2
+    takes a tolerance per index read; v1 takes a single tolerance for all of
+    them.
+
+    Returns a report dict. 'mismatches' is a list with the tolerance of each
+    index read, or None if the lane is not barcoded.
+    '''
+
+    index_reads = split_barcodes(barcodes)
+    report = {
+              'samples': len(barcodes),
+              'index_reads': len(index_reads),
+              'min_distances': [],
+              'mismatches': None,
+              'collisions': []
+             }
+    if not index_reads:
+        return report
+
+    distances = [hamming_distances(encode_barcodes(sequences)) for sequences in index_reads]
+    if len(barcodes) > 1:
+        off_diagonal = ~numpy.eye(len(barcodes), dtype=bool)
+        report['min_distances'] = [int(read_distances[off_diagonal].min()) for read_distances in distances]
+
+    values = [value for value in MISMATCH_VALUES if value <= max_mismatches]
+    if bcl2fastq_version == 2:
+        candidates = list(itertools.product(values, repeat=len(index_reads)))
+    else:
+        candidates = [(value,) * len(index_reads) for value in values]
+
+    mismatches = select_mismatches(distances, candidates)
+    if mismatches is None:
+        # Duplicate barcodes collide at any tolerance
+        mismatches = candidates[0]
+    report['mismatches'] = list(mismatches)
+
+    # Report the pairs that would collide with one more mismatch allowed
+    report_mismatches = [min(value + 1, max(MISMATCH_VALUES)) for value in mismatches]
+    for i, j in find_collisions(distances, report_mismatches):
+        report['collisions'].append({
+                                     'barcodes': [barcodes[i], barcodes[j]],
+                                     'distances': [int(read_distances[i, j]) for read_distances in distances]
+                                    })
+    return report
+
+def write_report(report, json_file, tsv_file):
+    ''' Description: Write a collision report as JSON and as a TSV table of
+    colliding barcode pairs.
+    '''
+
+    with open(json_file, 'w') as JSON:
+        json.dump(report, JSON, indent=2, sort_keys=True)
+    with open(tsv_file, 'w') as TSV:
+        TSV.write('barcode_1\tbarcode_2\t%s\n' % '\t'.join(['distance_index_%d' % (read + 1) for read in range(report['index_reads'])]))
+        for collision in report['collisions']:
+            fields = collision['barcodes'] + [str(distance) for distance in collision['distances']]
+            TSV.write('\t'.join(fields) + '\n')
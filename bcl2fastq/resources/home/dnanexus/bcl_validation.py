@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+
+"""
+Pre-flight scan of the BCL input of a lane, run before bcl2fastq.
+
+For every cycle and tile of the lane, the basecall file must exist and have
+a plausible size: per-tile BCL files (s_<lane>_<tile>.bcl, or .bcl.gz) or,
+on NovaSeq, per-surface CBCL files (L00<lane>_<surface>.cbcl) covering the
+tiles of a surface. Each tile also needs a filter file and a positions file
+(.locs, .clocs or _pos.txt, or a single s.locs shared by all tiles of a
+patterned flowcell).
+
+Each cycle directory is listed in a thread pool with os.scandir (the
+scandir backport on Python 2, or os.listdir and os.stat without it), so
+file sizes come from a single directory read instead of one stat call per
+file. The result is a cycle x tile matrix of missing or truncated files,
+used to fail fast when the input is grossly incomplete and to only ignore
+missing files in bcl2fastq when some are actually missing.
+"""
+
+import os
+import json
+import stat
+from multiprocessing.pool import ThreadPool
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+SCAN_THREADS = 16
+
+# A basecall file smaller than this fraction of the median size of the same
+# tile (or surface) across cycles is considered truncated
+MIN_SIZE_FRACTION = 0.5
+# Smallest possible BCL/CBCL file: the header
+MIN_BCL_SIZE = 4
+
+# The input is rejected if more than this fraction of the basecall files of
+# the lane are missing or truncated, or if any cycle is missing entirely
+MAX_BAD_FRACTION = 0.05
+
+# Matrix symbols
+OK = '.'
+MISSING = 'M'
+TRUNCATED = 'T'
+
+POSITIONS_SUFFIXES = ['.locs', '.clocs', '_pos.txt']
+
+def list_dir(path):
+    ''' Description: Returns a dict of the names and sizes of the files in a
+    directory, or None if the directory does not exist.
+    '''
+
+    sizes = {}
+    try:
+        if scandir is not None:
+            for entry in scandir(path):
+                if entry.is_file():
+                    sizes[entry.name] = entry.stat().st_size
+        else:
+            for name in os.listdir(path):
+                file_stat = os.stat(os.path.join(path, name))
+                if stat.S_ISREG(file_stat.st_mode):
+                    sizes[name] = file_stat.st_size
+    except OSError:
+        return None
+    return sizes
+
+def get_median(values):
+    values = sorted(values)
+    if not values:
+        return 0
+    return values[len(values) // 2]
+
+def classify_sizes(sizes):
+    ''' Description: Classify the basecall file sizes of one tile (or surface)
+    across cycles, given as a list with None for missing files. Returns a
+    list of matrix symbols.
+    '''
+
+    median = get_median([size for size in sizes if size is not None])
+    symbols = []
+    for size in sizes:
+        if size is None:
+            symbols.append(MISSING)
+        elif size < MIN_BCL_SIZE or size < MIN_SIZE_FRACTION * median:
+            symbols.append(TRUNCATED)
+        else:
+            symbols.append(OK)
+    return symbols
+
+def get_bcl_size(listing, lane_index, tile):
+    ''' Description: Returns the size of the BCL file of a tile in a cycle
+    directory listing, or None if there is none.
+    '''
+
+    for suffix in ['.bcl', '.bcl.gz']:
+        name = 's_%d_%s%s' % (lane_index, tile, suffix)
+        if name in listing:
+            return listing[name]
+    return None
+
+def scan_lane(basecalls_dir, lane_index, cycles, tiles, threads=SCAN_THREADS):
+    ''' Description: Scan the basecall, filter and positions files of a lane.
+
+    Input:
+    basecalls_dir (str): Data/Intensities/BaseCalls directory of the run
+    lane_index (int): Lane number
+    cycles (int): Total number of cycles of the run
+    tiles (list): Tile names of the lane (i.e. '1101')
+
+    Returns a report dict:
+    matrix (list): One string per cycle, with one symbol per tile
+    missing_bcl, truncated_bcl, missing_filter, missing_positions (int): Counts
+    bad_cycles (list): Cycles with no usable basecall file
+    format (str): 'bcl' or 'cbcl'
+    '''
+
+    lane_dir = os.path.join(basecalls_dir, 'L%03d' % lane_index)
+    intensities_lane_dir = os.path.join(os.path.dirname(basecalls_dir), 'L%03d' % lane_index)
+    cycle_dirs = [os.path.join(lane_dir, 'C%d.1' % cycle) for cycle in range(1, cycles + 1)]
+
+    pool = ThreadPool(processes = max(1, min(threads, len(cycle_dirs) + 3)))
+    try:
+        listings = pool.map(list_dir, cycle_dirs + [lane_dir, intensities_lane_dir, os.path.dirname(basecalls_dir)],
+                            chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    cycle_listings = listings[:cycles]
+    lane_listing, intensities_listing, intensities_root_listing = listings[cycles:]
+    cycle_listings = [listing or {} for listing in cycle_listings]
+
+    # NovaSeq writes one CBCL file per surface and cycle
+    cbcl = any([name.endswith('.cbcl') for listing in cycle_listings for name in listing])
+    if cbcl:
+        surfaces = sorted(set([tile[0] for tile in tiles]))
+        surface_symbols = {}
+        for surface in surfaces:
+            # CBCL names: L001_1.cbcl
+            name = 'L%03d_%s.cbcl' % (lane_index, surface)
+            surface_symbols[surface] = classify_sizes([listing.get(name) for listing in cycle_listings])
+        columns = [surface_symbols[tile[0]] for tile in tiles]
+    else:
+        columns = [classify_sizes([get_bcl_size(listing, lane_index, tile) for listing in cycle_listings])
+                   for tile in tiles]
+    matrix = [''.join([column[cycle] for column in columns]) for cycle in range(cycles)]
+
+    lane_listing = lane_listing or {}
+    intensities_listing = intensities_listing or {}
+    intensities_root_listing = intensities_root_listing or {}
+    missing_filter = [tile for tile in tiles if not 's_%d_%s.filter' % (lane_index, tile) in lane_listing]
+    if 's.locs' in intensities_root_listing:
+        missing_positions = []
+    else:
+        missing_positions = [tile for tile in tiles
+                             if not any(['s_%d_%s%s' % (lane_index, tile, suffix) in intensities_listing
+                                         for suffix in POSITIONS_SUFFIXES])]
+
+    report = {
+              'lane': lane_index,
+              'format': 'cbcl' if cbcl else 'bcl',
+              'cycles': cycles,
+              'tiles': tiles,
+              'matrix': matrix,
+              'missing_bcl': sum([row.count(MISSING) for row in matrix]),
+              'truncated_bcl': sum([row.count(TRUNCATED) for row in matrix]),
+              'bad_cycles': [cycle + 1 for cycle, row in enumerate(matrix) if tiles and not OK in row],
+              'missing_filter': len(missing_filter),
+              'missing_positions': len(missing_positions),
+              'missing_filter_tiles': missing_filter,
+              'missing_positions_tiles': missing_positions
+             }
+    return report
+
+def get_gross_problems(report, max_bad_fraction=MAX_BAD_FRACTION):
+    ''' Description: Returns a list of the problems of a scan report that
+    make conversion pointless, or an empty list.
+    '''
+
+    problems = []
+    files = report['cycles'] * len(report['tiles'])
+    bad_files = report['missing_bcl'] + report['truncated_bcl']
+    if report['bad_cycles']:
+        problems.append('No usable basecall files for cycles %s' % ','.join(map(str, report['bad_cycles'])))
+    if files and float(bad_files) / files > max_bad_fraction:
+        problems.append('%d of %d basecall files are missing or truncated' % (bad_files, files))
+    if report['tiles'] and report['missing_filter'] == len(report['tiles']):
+        problems.append('No filter files found')
+    return problems
+
+def get_ignore_flags(report):
+    ''' Description: Returns the bcl2fastq ignore flags needed by the scanned
+    input: ignore_missing_bcl, ignore_missing_filter and
+    ignore_missing_positions.
+    '''
+
+    return {
+            'ignore_missing_bcl': bool(report['missing_bcl'] or report['truncated_bcl']),
+            'ignore_missing_filter': bool(report['missing_filter']),
+            'ignore_missing_positions': bool(report['missing_positions'])
+           }
+
+def write_report(report, json_file, tsv_file):
+    ''' Description: Write a scan report as JSON and the missing-file matrix
+    as a TSV table with one row per cycle and one column per tile.
+    '''
+
+    with open(json_file, 'w') as JSON:
+        json.dump(report, JSON, indent=2, sort_keys=True)
+    with open(tsv_file, 'w') as TSV:
+        TSV.write('cycle\t%s\n' % '\t'.join(report['tiles']))
+        for cycle, row in enumerate(report['matrix']):
+            TSV.write('%d\t%s\n' % (cycle + 1, '\t'.join(row)))
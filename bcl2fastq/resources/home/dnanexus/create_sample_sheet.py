@@ -6,6 +6,8 @@ from scgpm_lims import Connection
 import json
 import argparse
 
+from run_metadata import create_sample_sheet
+
 try:
 	token = os.environ["UHTS_LIMS_TOKEN"]
 except KeyError:
@@ -42,9 +44,5 @@ parser.add_argument('-l','--lane',type=int,help="The number of the lane sequence
 args = parser.parse_args()
 conn = Connection(lims_url=args.lims_url, lims_token=args.lims_token, verbose=False)
 
-fn = args.run_name
-if args.lane:
-	fn += "_L" + str(args.lane)
-fn += '_samplesheet.csv'
-conn.getsamplesheet(run=args.run_name,lane=args.lane,bcl2fastq_version=args.bcl2fastq_version,filename=fn)
+fn = create_sample_sheet(conn=conn,run_name=args.run_name,bcl2fastq_version=args.bcl2fastq_version,lane=args.lane)
 print fn
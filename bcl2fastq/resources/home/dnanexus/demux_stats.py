@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+
+"""
+Reads the demultiplexing statistics written by bcl2fastq and summarizes them
+per lane: raw and passing filter clusters, reads and yield of each sample,
+and Undetermined reads.
+
+bcl2fastq v2 writes Stats/Stats.json, which is streamed one lane at a time
+with ijson if it is installed. bcl2fastq v1 (CASAVA 1.8) writes
+Basecall_Stats_<flowcell>/Flowcell_demux_summary.xml, with counts per
+sample, barcode, tile and read, which is streamed with iterparse and summed
+over tiles. Both give the same summary dict.
+
+A preview summary, from a conversion of a few tiles of the lane, is
+extrapolated to the whole lane by scaling counts by the ratio of lane tiles
+to converted tiles. Tiles are picked across surfaces and swaths, so the
+fractions of reads per barcode and the undetermined rate of the preview
+reflect the whole lane.
+
+A lane converted in tile shards has one summary per shard, which are summed
+into the lane summary. The lane.html report bcl2fastq writes for each shard
+only covers its tiles, so the lane report is written from the lane summary.
+"""
+
+import cgi
+import json
+import collections
+import xml.etree.ElementTree as ET
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# Fraction of the even share of reads below which a sample is reported as low
+LOW_SAMPLE_RATIO = 0.2
+
+def iter_conversion_results(stats_file):
+    ''' Description: Yields the ConversionResults entries of a Stats.json
+    file, one lane at a time.
+    '''
+
+    with open(stats_file, 'rb') as STATS:
+        if ijson is not None:
+            for lane_results in ijson.items(STATS, 'ConversionResults.item'):
+                yield lane_results
+        else:
+            for lane_results in json.load(STATS).get('ConversionResults', []):
+                yield lane_results
+
+def read_stats_json(stats_file, lane_index):
+    ''' Description: Returns the demultiplexing summary of a lane from a
+    bcl2fastq v2 Stats.json file.
+    '''
+
+    for lane_results in iter_conversion_results(stats_file):
+        if int(lane_results['LaneNumber']) == int(lane_index):
+            return summarize_lane(lane_results)
+    raise RuntimeError('Could not find lane %s in %s' % (lane_index, stats_file))
+
+def get_sample_barcode(demux_result):
+    ''' Description: Returns the barcode of a DemuxResults entry, with dual
+    indexes joined with '-' like LIMS barcodes.
+    '''
+
+    index_metrics = demux_result.get('IndexMetrics') or []
+    if not index_metrics:
+        return None
+    return index_metrics[0]['IndexSequence'].replace('+', '-')
+
+def summarize_lane(lane_results):
+    ''' Description: Returns the demultiplexing summary of a Stats.json
+    ConversionResults entry.
+    '''
+
+    samples = []
+    for demux_result in lane_results.get('DemuxResults', []):
+        samples.append({
+                        'sample_id': demux_result.get('SampleId'),
+                        'sample_name': demux_result.get('SampleName'),
+                        'barcode': get_sample_barcode(demux_result),
+                        'reads': int(demux_result.get('NumberReads', 0)),
+                        'yield': int(demux_result.get('Yield', 0))
+                       })
+    undetermined = lane_results.get('Undetermined') or {}
+    return make_summary(lane_index = lane_results['LaneNumber'],
+                        clusters_raw = lane_results.get('TotalClustersRaw', 0),
+                        clusters_pf = lane_results.get('TotalClustersPF', 0),
+                        samples = samples,
+                        undetermined_reads = undetermined.get('NumberReads', 0),
+                        undetermined_yield = undetermined.get('Yield', 0))
+
+def make_summary(lane_index, clusters_raw, clusters_pf, samples, undetermined_reads, undetermined_yield):
+    ''' Description: Returns a lane summary dict. Sample and undetermined
+    fractions are of passing filter clusters.
+    '''
+
+    clusters_pf = int(clusters_pf)
+    for sample in samples:
+        sample['fraction'] = float(sample['reads']) / clusters_pf if clusters_pf else 0.0
+    summary = {
+               'lane': int(lane_index),
+               'clusters_raw': int(clusters_raw),
+               'clusters_pf': clusters_pf,
+               'yield': sum([sample['yield'] for sample in samples]) + int(undetermined_yield),
+               'samples': samples,
+               'undetermined_reads': int(undetermined_reads),
+               'undetermined_yield': int(undetermined_yield),
+               'undetermined_fraction': float(undetermined_reads) / clusters_pf if clusters_pf else 0.0
+              }
+    return summary
+
+def read_demux_summary_xml(xml_file, lane_index):
+    ''' Description: Returns the demultiplexing summary of a lane from a
+    bcl2fastq v1 Flowcell_demux_summary.xml file. Counts are summed over
+    tiles; clusters are counted on read 1 and yields over all reads.
+    '''
+
+    lane_index = str(lane_index)
+    counts = collections.OrderedDict()  # (sample, barcode) : [raw clusters, pf clusters, pf yield]
+    path = {}
+    for event, elt in ET.iterparse(xml_file, events=('start', 'end')):
+        if event == 'start':
+            if elt.tag in ('Lane', 'Sample', 'Barcode', 'Read'):
+                path[elt.tag] = elt.get('index')
+            continue
+        if path.get('Lane') != lane_index:
+            if elt.tag in ('Tile', 'Lane'):
+                elt.clear()
+            continue
+        if elt.tag in ('Raw', 'Pf'):
+            key = (path['Sample'], path['Barcode'])
+            if not key in counts:
+                counts[key] = [0, 0, 0]
+            clusters = int(elt.findtext('ClusterCount') or 0)
+            if elt.tag == 'Raw':
+                if path['Read'] == '1':
+                    counts[key][0] += clusters
+            else:
+                if path['Read'] == '1':
+                    counts[key][1] += clusters
+                counts[key][2] += int(elt.findtext('Yield') or 0)
+        elif elt.tag == 'Tile':
+            # Tile counts are summed; free them as the file is streamed
+            elt.clear()
+
+    samples = []
+    undetermined = [0, 0, 0]
+    for (sample, barcode), (raw, pf, pf_yield) in counts.items():
+        if barcode in ('Undetermined', 'NoIndex', 'unknown'):
+            undetermined = [undetermined[0] + raw, undetermined[1] + pf, undetermined[2] + pf_yield]
+            continue
+        samples.append({
+                        'sample_id': sample,
+                        'sample_name': sample,
+                        'barcode': barcode,
+                        'reads': pf,
+                        'yield': pf_yield
+                       })
+    return make_summary(lane_index = lane_index,
+                        clusters_raw = sum([raw for raw, pf, pf_yield in counts.values()]),
+                        clusters_pf = sum([pf for raw, pf, pf_yield in counts.values()]),
+                        samples = samples,
+                        undetermined_reads = undetermined[1],
+                        undetermined_yield = undetermined[2])
+
+def extrapolate_preview(summary, preview_tiles, lane_tiles):
+    ''' Description: Extrapolate the summary of a preview conversion of
+    'preview_tiles' tiles to a lane of 'lane_tiles' tiles. Adds estimated
+    lane counts, the ratio of each sample's fraction of reads to an even
+    share of the demultiplexed reads, and the list of low samples.
+    '''
+
+    scale = float(lane_tiles) / preview_tiles if preview_tiles else 0.0
+    samples = summary['samples']
+    even_fraction = (1.0 - summary['undetermined_fraction']) / len(samples) if samples else 0.0
+
+    preview = dict(summary)
+    preview['preview_tiles'] = preview_tiles
+    preview['lane_tiles'] = lane_tiles
+    preview['estimated_clusters_raw'] = int(summary['clusters_raw'] * scale)
+    preview['estimated_clusters_pf'] = int(summary['clusters_pf'] * scale)
+    preview['estimated_undetermined_reads'] = int(summary['undetermined_reads'] * scale)
+    preview['samples'] = []
+    for sample in samples:
+        sample = dict(sample)
+        sample['estimated_reads'] = int(sample['reads'] * scale)
+        sample['estimated_yield'] = int(sample['yield'] * scale)
+        sample['balance'] = sample['fraction'] / even_fraction if even_fraction else 0.0
+        preview['samples'].append(sample)
+    preview['low_samples'] = [preview_sample['barcode'] for preview_sample in preview['samples']
+                              if preview_sample['balance'] < LOW_SAMPLE_RATIO]
+    return preview
+
+def merge_summaries(summaries):
+    ''' Description: Returns the summary of a lane converted in tile shards,
+    summing the counts of the shard summaries.
+    '''
+
+    samples = collections.OrderedDict()  # (sample_id, barcode) : sample
+    for summary in summaries:
+        for sample in summary['samples']:
+            key = (sample['sample_id'], sample['barcode'])
+            if not key in samples:
+                samples[key] = {
+                                'sample_id': sample['sample_id'],
+                                'sample_name': sample['sample_name'],
+                                'barcode': sample['barcode'],
+                                'reads': 0,
+                                'yield': 0
+                               }
+            samples[key]['reads'] += sample['reads']
+            samples[key]['yield'] += sample['yield']
+    return make_summary(lane_index = summaries[0]['lane'],
+                        clusters_raw = sum([summary['clusters_raw'] for summary in summaries]),
+                        clusters_pf = sum([summary['clusters_pf'] for summary in summaries]),
+                        samples = samples.values(),
+                        undetermined_reads = sum([summary['undetermined_reads'] for summary in summaries]),
+                        undetermined_yield = sum([summary['undetermined_yield'] for summary in summaries]))
+
+def write_lane_html(summary, html_file, title):
+    ''' Description: Write an HTML report of a lane summary, with the
+    clusters of the lane and the reads, fraction of the lane and yield of
+    each sample. 'summary' is None if bcl2fastq wrote no statistics.
+    '''
+
+    lines = ['<html>',
+             '<head><title>%s</title></head>' % cgi.escape(title),
+             '<body>',
+             '<h1>%s</h1>' % cgi.escape(title)]
+    if summary is None:
+        lines.append('<p>No demultiplexing statistics were written for this lane.</p>')
+    else:
+        lines += ['<h2>Lane Summary</h2>',
+                  '<table border="1">',
+                  '<tr><th>Lane</th><th>Clusters (Raw)</th><th>Clusters (PF)</th><th>Yield (Mbases)</th></tr>',
+                  '<tr><td>%d</td><td>%d</td><td>%d</td><td>%d</td></tr>' % (summary['lane'],
+                                                                            summary['clusters_raw'],
+                                                                            summary['clusters_pf'],
+                                                                            summary['yield'] // 1000000),
+                  '</table>',
+                  '<h2>Samples</h2>',
+                  '<table border="1">',
+                  '<tr><th>Sample</th><th>Barcode sequence</th><th>PF Clusters</th>'
+                  '<th>% of the lane</th><th>Yield (Mbases)</th></tr>']
+        rows = [(sample['sample_name'] or sample['sample_id'], sample['barcode'], sample['reads'],
+                 sample['fraction'], sample['yield']) for sample in summary['samples']]
+        rows.append(('Undetermined', 'unknown', summary['undetermined_reads'],
+                     summary['undetermined_fraction'], summary['undetermined_yield']))
+        for name, barcode, reads, fraction, sample_yield in rows:
+            lines.append('<tr><td>%s</td><td>%s</td><td>%d</td><td>%.2f</td><td>%d</td></tr>' % (
+                                                    cgi.escape(str(name)),
+                                                    cgi.escape(str(barcode)),
+                                                    reads,
+                                                    100 * fraction,
+                                                    sample_yield // 1000000))
+        lines.append('</table>')
+    lines += ['</body>', '</html>', '']
+    with open(html_file, 'w') as HTML:
+        HTML.write('\n'.join(lines))
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+
+"""
+Recompresses gzipped fastq files into BGZF (blocked gzip, as written by
+htslib's bgzip) while they are uploaded.
+
+BGZF is a series of gzip members of at most 64 KB of uncompressed data, each
+recording its compressed size in a gzip extra field, and ending with an
+empty EOF block. Any gzip reader can read it, and tools that understand BGZF
+can seek to a block without decompressing the file from the start.
+
+The source file is read and decompressed in the calling thread; blocks are
+compressed in a thread pool (zlib releases the GIL while compressing), one
+batch ahead of the batch being written. Output is returned in chunks of
+about the upload chunk size, together with the uncompressed data, so fastq
+statistics do not have to decompress the output again.
+"""
+
+import os
+import time
+import zlib
+import struct
+import hashlib
+import threading
+from multiprocessing.pool import ThreadPool
+
+# Uncompressed bytes per BGZF block; the largest block htslib writes
+BGZF_BLOCK_SIZE = 65280
+
+# Blocks compressed per batch and thread
+BATCH_BLOCKS_PER_THREAD = 16
+
+# Bytes of the source file read at a time
+READ_CHUNK_SIZE = 16 * 1024 * 1024
+
+# Empty block marking the end of a BGZF file
+BGZF_EOF = ('\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43\x02\x00'
+            '\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00')
+
+def compress_block(data, level):
+    ''' Description: Returns a BGZF block of the uncompressed 'data'.
+    '''
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    deflated = compressor.compress(data) + compressor.flush()
+    # gzip header with the 'BC' extra subfield holding the block size - 1
+    header = struct.pack('<BBBBIBBHBBHH', 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(deflated) + 25)
+    footer = struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data))
+    return header + deflated + footer
+
+def iter_uncompressed(fastq_path, source_md5=None):
+    ''' Description: Yields the uncompressed data of a gzipped file with one
+    or more gzip members. Updates 'source_md5' with the compressed data.
+    '''
+
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    with open(fastq_path, 'rb') as FASTQ:
+        chunk = FASTQ.read(READ_CHUNK_SIZE)
+        while chunk:
+            if source_md5 is not None:
+                source_md5.update(chunk)
+            data = decompressor.decompress(chunk)
+            # Start a new decompressor at each following gzip member
+            while decompressor.unused_data:
+                unused_data = decompressor.unused_data
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                data += decompressor.decompress(unused_data)
+            if data:
+                yield data
+            chunk = FASTQ.read(READ_CHUNK_SIZE)
+    data = decompressor.flush()
+    if data:
+        yield data
+
+def iter_blocks(fastq_path, source_md5=None):
+    ''' Description: Yields the uncompressed data of a gzipped file in
+    BGZF-sized blocks.
+    '''
+
+    buffered = ''
+    for data in iter_uncompressed(fastq_path, source_md5):
+        buffered += data
+        offset = 0
+        while len(buffered) - offset >= BGZF_BLOCK_SIZE:
+            yield buffered[offset:offset + BGZF_BLOCK_SIZE]
+            offset += BGZF_BLOCK_SIZE
+        buffered = buffered[offset:]
+    if buffered:
+        yield buffered
+
+def iter_batches(blocks, size):
+    batch = []
+    for block in blocks:
+        batch.append(block)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+class BgzfRecompressor:
+
+    def __init__(self, level, threads=1):
+        ''' Description: Recompresses gzipped files into BGZF at compression
+        'level' using 'threads' compression threads, and keeps the source
+        and output sizes, source MD5 and time spent reading and decompressing
+        the source (read_seconds) and compressing blocks, summed over threads
+        (compress_seconds).
+        '''
+
+        self.level = level
+        self.threads = max(1, threads)
+        self.source_md5 = hashlib.md5()
+        self.source_size = 0
+        self.size = 0
+        self.read_seconds = 0.0
+        self.compress_seconds = 0.0
+        self.lock = threading.Lock()
+
+    def compress(self, data):
+        start_time = time.time()
+        block = compress_block(data, self.level)
+        with self.lock:
+            self.compress_seconds += time.time() - start_time
+        return block
+
+    def iter_chunks(self, fastq_path, chunk_size):
+        ''' Description: Yields (compressed, uncompressed) tuples of BGZF
+        output of about 'chunk_size' compressed bytes and the uncompressed
+        data they hold, in file order. The last chunk ends with the BGZF EOF
+        block.
+        '''
+
+        self.source_size += os.path.getsize(fastq_path)
+        batches = iter_batches(iter_blocks(fastq_path, self.source_md5), self.threads * BATCH_BLOCKS_PER_THREAD)
+        output = OutputBuffer(chunk_size)
+        pool = ThreadPool(processes = self.threads)
+        try:
+            pending = None
+            while True:
+                start_time = time.time()
+                batch = next(batches, None)
+                self.read_seconds += time.time() - start_time
+                if batch is None:
+                    break
+                # Compress the next batch while the previous one is written
+                result = pool.map_async(self.compress, batch, chunksize=BATCH_BLOCKS_PER_THREAD)
+                if pending:
+                    for chunk in output.add(pending[0], pending[1].get()):
+                        yield chunk
+                pending = (batch, result)
+            if pending:
+                for chunk in output.add(pending[0], pending[1].get()):
+                    yield chunk
+        finally:
+            pool.close()
+            pool.join()
+        self.size += output.size + len(BGZF_EOF)
+        yield output.flush(BGZF_EOF)
+
+class OutputBuffer:
+
+    def __init__(self, chunk_size):
+        ''' Description: Collects compressed blocks, and the uncompressed data
+        they hold, into chunks of about 'chunk_size' compressed bytes.
+        '''
+
+        self.chunk_size = chunk_size
+        self.compressed = []
+        self.uncompressed = []
+        self.buffered = 0
+        self.size = 0
+
+    def add(self, batch, blocks):
+        ''' Description: Add a batch of blocks and yield the chunks filled.
+        '''
+
+        for data, block in zip(batch, blocks):
+            self.compressed.append(block)
+            self.uncompressed.append(data)
+            self.buffered += len(block)
+            self.size += len(block)
+            if self.buffered >= self.chunk_size:
+                yield self.flush()
+
+    def flush(self, trailer=''):
+        chunk = (''.join(self.compressed) + trailer, ''.join(self.uncompressed))
+        self.compressed = []
+        self.uncompressed = []
+        self.buffered = 0
+        return chunk
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+
+"""
+Splits FASTQ data into gzipped chunks of a fixed number of reads as it
+streams through split. Shared by bcl2fastq, which chunks the fastq files it
+writes, and map_sample, which scatters large samples across subjobs.
+
+Chunks are numbered with a suffix wide enough for the most chunks a file
+could hold given its compressed size, so split never runs out of suffixes.
+Chunk files are renamed or uploaded under other names, so the width of
+local chunk names does not matter.
+"""
+
+import os
+import re
+
+# Most reads a byte of gzipped FASTQ can hold: deflate expands data at most
+# 1032 times, and a FASTQ record takes at least 8 bytes ("@\nA\n+\nI\n")
+MAX_READS_PER_BYTE = 1032 // 8
+
+# Narrowest chunk suffix, as in bcl2fastq file names (_001)
+MIN_SUFFIX_WIDTH = 3
+
+def get_suffix_width(file_size, reads_per_chunk):
+    ''' Description: Returns the chunk suffix width for splitting a gzipped
+    FASTQ file of 'file_size' bytes into chunks of 'reads_per_chunk' reads.
+    '''
+
+    max_chunks = file_size * MAX_READS_PER_BYTE // reads_per_chunk + 1
+    return max(MIN_SUFFIX_WIDTH, len(str(max_chunks)))
+
+def split_command(reads_per_chunk, prefix, suffix_width, first_suffix=0, compress_command='pigz -1'):
+    ''' Description: Returns the shell command splitting uncompressed FASTQ
+    data read from standard input into chunks of 'reads_per_chunk' reads,
+    compressed with 'compress_command' and named <prefix><suffix>.fastq.gz,
+    with zero-padded suffixes of 'suffix_width' digits counting from
+    'first_suffix'.
+    '''
+
+    return ("split -l %d -d -a %d --numeric-suffixes=%d --additional-suffix=.fastq.gz "
+            "--filter='%s > $FILE' - %s" % (reads_per_chunk * 4, suffix_width, first_suffix,
+                                            compress_command, prefix))
+
+def get_chunk_path(prefix, suffix_width, suffix):
+    return '%s%0*d.fastq.gz' % (prefix, suffix_width, suffix)
+
+def list_chunks(prefix):
+    ''' Description: Returns the chunk files written by split_command, in
+    read order.
+    '''
+
+    directory = os.path.dirname(prefix)
+    pattern = re.compile(re.escape(os.path.basename(prefix)) + r'(\d+)\.fastq\.gz$')
+    chunks = []
+    for name in os.listdir(directory or '.'):
+        match = pattern.match(name)
+        if match:
+            chunks.append((int(match.group(1)), os.path.join(directory, name)))
+    return [path for suffix, path in sorted(chunks)]
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+
+"""
+Computes integrity and summary statistics of a gzipped fastq file from the
+same stream of compressed chunks that is uploaded, so no second pass over the
+data is needed: MD5 and size of the compressed file, and the uncompressed
+size, read count, base count, mean base quality and fraction of bases of
+quality 30 or more.
+
+Concatenated gzip members (as written by bcl2fastq, or produced by merging
+tile shards) are decompressed one after the other.
+"""
+
+import zlib
+import hashlib
+
+import numpy
+
+# Phred+33 quality encoding
+QUALITY_OFFSET = 33
+
+class FastqStats:
+
+    def __init__(self):
+        ''' Description: Statistics accumulated over the compressed chunks of
+        a gzipped fastq file, passed in order to update().
+        '''
+
+        self.md5 = hashlib.md5()
+        self.size = 0
+        self.uncompressed_size = 0
+        self.line_count = 0
+        self.base_count = 0
+        self.quality_sum = 0
+        self.q30_count = 0
+        self.quality_count = 0
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.partial_line = ''
+
+    def update(self, chunk, data=None):
+        ''' Description: Add a compressed chunk. If the uncompressed 'data' it
+        holds is already known (i.e. when it was just compressed), it is not
+        decompressed again.
+        '''
+
+        self.md5.update(chunk)
+        self.size += len(chunk)
+        if data is not None:
+            self.add_data(data)
+            return
+
+        data = self.decompressor.decompress(chunk)
+        # Start a new decompressor at each following gzip member
+        while self.decompressor.unused_data:
+            unused_data = self.decompressor.unused_data
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            data += self.decompressor.decompress(unused_data)
+        self.add_data(data)
+
+    def add_data(self, data):
+        if not data:
+            return
+        self.uncompressed_size += len(data)
+        lines = (self.partial_line + data).split('\n')
+        self.partial_line = lines.pop()
+        self.add_lines(lines)
+
+    def add_lines(self, lines):
+        # Lines of a record: header, sequence, '+', quality
+        first = self.line_count % 4
+        sequences = lines[(1 - first) % 4::4]
+        qualities = lines[(3 - first) % 4::4]
+        self.line_count += len(lines)
+
+        self.base_count += sum([len(sequence) for sequence in sequences])
+        quality_values = numpy.frombuffer(''.join(qualities), dtype=numpy.uint8)
+        self.quality_count += quality_values.size
+        self.quality_sum += int(quality_values.sum(dtype=numpy.uint64)) - QUALITY_OFFSET * quality_values.size
+        self.q30_count += int(numpy.count_nonzero(quality_values >= QUALITY_OFFSET + 30))
+
+    def finish(self):
+        ''' Description: Returns the statistics as a dict of strings, suitable
+        for DNAnexus file properties.
+        '''
+
+        self.add_data(self.decompressor.flush())
+        if self.partial_line:
+            self.add_lines([self.partial_line])
+            self.partial_line = ''
+
+        mean_quality = 0.0
+        q30_fraction = 0.0
+        if self.quality_count:
+            mean_quality = float(self.quality_sum) / self.quality_count
+            q30_fraction = float(self.q30_count) / self.quality_count
+        return {
+                'md5': self.md5.hexdigest(),
+                'size': str(self.size),
+                'uncompressed_size': str(self.uncompressed_size),
+                'read_count': str(self.line_count // 4),
+                'base_count': str(self.base_count),
+                'mean_quality': '%.2f' % mean_quality,
+                'q30_fraction': '%.4f' % q30_fraction
+               }
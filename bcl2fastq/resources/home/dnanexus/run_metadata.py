@@ -0,0 +1,504 @@
+#!/usr/bin/env python
+
+"""
+Parses the run configuration (RunInfo.xml) and sample sheet of a sequencing
+run, and calculates the --use-bases-mask argument for bcl2fastq. Used
+in-process by the bcl2fastq applet, and by the calculate_use_bases_mask.py
+and create_sample_sheet.py command-line wrappers. Also builds the run
+metadata index, a compact JSON summary of a converted lane that downstream
+applets load instead of describing each fastq file.
+
+RunInfo.xml describes the actual read lengths being produced by the run
+(e.g., a 2x101bp paired run with an 8bp index read). CASAVA normally
+guesses the length of the barcode based on the length of the index read
+specified in RunInfo.xml. Specifically, an N bp index read implies an N-1
+bp barcode (i.e., CASAVA ignores the last base of the index read).
+
+In some cases, the length of the actual barcodes may not match that guessed
+by CASAVA. For example, a user might specify 6bp barcodes to be used with
+an 8bp index read. calculate_use_bases_mask() reconciles those two sources
+of information.
+"""
+
+import sys
+import string
+import xml.etree.ElementTree as ET
+
+COMPLEMENT = string.maketrans('ACGTNacgtn', 'TGCANtgcan')
+
+# Version of the run metadata index format; increment on incompatible changes
+RUN_INDEX_VERSION = 2
+
+class RunConfig:
+
+    def __init__(self, run_info_file):
+        ''' Description: Run configuration parsed from RunInfo.xml.
+
+        Attributes:
+        run_id (str): Run ID
+        flowcell (str): Flowcell ID
+        reads (list): Dicts describing each read ('Number', 'NumCycles',
+                      'IsIndexedRead'), sorted by read number
+        layout (dict): FlowcellLayout attributes (LaneCount, SurfaceCount, ...)
+        tiles (list): Tile names ('<lane>_<tile>') listed in RunInfo.xml;
+                      empty for older runs that do not list tiles
+        '''
+
+        self.run_info_file = run_info_file
+        tree = ET.parse(run_info_file)
+
+        run_elt = tree.find('.//Run')
+        self.run_id = None
+        if run_elt is not None:
+            self.run_id = run_elt.get('Id')
+
+        self.flowcell = None
+        flowcell_elt = tree.find('.//Flowcell')
+        if flowcell_elt is not None:
+            self.flowcell = flowcell_elt.text.strip()
+
+        self.reads = parse_reads(tree)
+
+        self.layout = {}
+        self.tiles = []
+        layout_elt = tree.find('.//FlowcellLayout')
+        if layout_elt is not None:
+            self.layout = dict(layout_elt.attrib)
+            self.tiles = [tile_elt.text.strip() for tile_elt in layout_elt.findall('.//Tile')]
+
+    def get_lane_tiles(self, lane_index):
+        ''' Description: Returns the list of tile names (i.e. '1101') for a lane,
+        read from the <Tiles> list in RunInfo.xml. Older RunInfo.xml files do not
+        list tiles, in which case they are generated from the surface, swath and
+        tile counts of the <FlowcellLayout>.
+        '''
+
+        if not self.layout:
+            raise RuntimeError('Could not find FlowcellLayout in %s' % self.run_info_file)
+
+        tiles = []
+        for tile_name in self.tiles:
+            lane, tile = tile_name.split('_')
+            if int(lane) == int(lane_index):
+                tiles.append(tile)
+
+        if not tiles:
+            for surface in range(1, int(self.layout['SurfaceCount']) + 1):
+                for swath in range(1, int(self.layout['SwathCount']) + 1):
+                    for tile in range(1, int(self.layout['TileCount']) + 1):
+                        tiles.append('%d%d%02d' % (surface, swath, tile))
+        return tiles
+
+    def get_spread_tiles(self, lane_index, count):
+        ''' Description: Returns 'count' tiles of a lane spread across its
+        surfaces and swaths: tiles are grouped by surface and swath (the first
+        two digits of the tile name), and taken in turn from each group at
+        evenly spaced positions along the swath.
+        '''
+
+        tiles = self.get_lane_tiles(lane_index)
+        if count >= len(tiles):
+            return tiles
+
+        groups = {}
+        for tile in tiles:
+            groups.setdefault(tile[:2], []).append(tile)
+        group_keys = sorted(groups.keys())
+
+        # Number of tiles taken from each group
+        counts = dict([(key, 0) for key in group_keys])
+        for position in range(count):
+            counts[group_keys[position % len(group_keys)]] += 1
+
+        selected = []
+        for key in group_keys:
+            group = groups[key]
+            group_count = min(counts[key], len(group))
+            for position in range(group_count):
+                # Middle of each of 'group_count' equal segments of the swath
+                selected.append(group[(2 * position + 1) * len(group) // (2 * group_count)])
+        return sorted(selected)
+
+class RunParameters:
+
+    def __init__(self, run_params_file):
+        ''' Description: Run parameters parsed from runParameters.xml. Element
+        names differ between instruments and RTA versions, so each value is
+        taken from the first of its known elements found in the file.
+
+        Attributes:
+        rta_version (str): RTA version (i.e. '2.7.3')
+        lane_barcode (str): Flowcell barcode, used in bcl2fastq report paths
+        instrument (str): Instrument name, or None
+        '''
+
+        self.run_params_file = run_params_file
+        tree = ET.parse(run_params_file)
+        self.rta_version = find_text(tree, ['RTAVersion', 'RtaVersion'])
+        self.lane_barcode = find_text(tree, ['Barcode', 'FlowCellSerialBarcode'])
+        self.instrument = find_text(tree, ['ScannerID', 'InstrumentName', 'InstrumentID'])
+
+class SampleSheet:
+
+    def __init__(self, sample_sheet_file):
+        ''' Description: bcl2fastq sample sheet, read in a single pass into
+        column lists with lane and barcode indexes. Both the bcl2fastq v1 format
+        (header line starting with 'FCID') and the v2 format ('[Data]' section
+        with a header line starting with 'Sample_Project') are supported.
+
+        Attributes:
+        version (int): bcl2fastq version of the sample sheet format (1 or 2)
+        preamble (list): Lines preceding the column header line
+        columns (list): Column names
+        data (list): One list of values per column
+        lanes (dict): Lane index : list of row indexes
+        barcode_rows (dict): (lane index, barcode) : row index
+        '''
+
+        self.sample_sheet_file = sample_sheet_file
+        self.version = None
+        self.preamble = []
+        self.columns = []
+        self.data = []
+
+        with open(sample_sheet_file, 'r') as sfile:
+            lines = sfile.read().splitlines()
+
+        for line_index, line in enumerate(lines):
+            line = line.strip()
+            if line.startswith('FCID,'):
+                self.version = 1
+            elif line.startswith('Sample_Project,'):
+                self.version = 2
+            else:
+                self.preamble.append(line)
+                continue
+            self.columns = line.split(',')
+            break
+
+        if not self.columns:
+            raise RuntimeError('Could not find header line in sample sheet %s' % sample_sheet_file)
+
+        rows = [row.strip().split(',') for row in lines[line_index + 1:] if row.strip()]
+        for fields in rows:
+            assert len(fields) == len(self.columns), "Expected %d fields but found %s; line '%s'" % (len(self.columns), len(fields), ','.join(fields))
+        if rows:
+            self.data = [list(column) for column in zip(*rows)]
+        else:
+            self.data = [[] for column in self.columns]
+        self.index()
+
+    def __len__(self):
+        return len(self.data[0])
+
+    def index(self):
+        ''' Description: (Re)build the lane and barcode indexes. Must be called
+        after any transform that changes lanes or indexes.
+        '''
+
+        self.lanes = {}
+        for row, lane in enumerate(self.data[1]):
+            self.lanes.setdefault(int(lane), []).append(row)
+
+        self.barcode_rows = {}
+        for row, barcode in enumerate(self.get_row_barcodes()):
+            self.barcode_rows[(int(self.data[1][row]), barcode.rstrip('-'))] = row
+
+    def get_row_barcodes(self):
+        ''' Description: Returns the barcode of every row. Dual-index barcodes
+        are joined with '-'.
+        '''
+
+        if self.version == 1:
+            return list(self.data[4])
+        else:
+            return ['-'.join(indexes) for indexes in zip(self.data[4], self.data[5])]
+
+    @property
+    def flowcell_id(self):
+        ''' Flowcell ID; the first column of the first sample row. '''
+        if not len(self):
+            return None
+        return self.data[0][0]
+
+    def get_barcodes(self, lane_index):
+        ''' Description: Returns a list of the barcode(s) for the given lane.
+        Dual-index barcodes are joined with '-'.
+        '''
+
+        row_barcodes = self.get_row_barcodes()
+        return [row_barcodes[row] for row in self.lanes.get(int(lane_index), [])]
+
+    def get_row(self, lane_index, barcode):
+        ''' Description: Returns the fields of the sample with 'barcode' in
+        lane 'lane_index' as a dict keyed by column name, or None.
+        '''
+
+        row = self.barcode_rows.get((int(lane_index), barcode))
+        if row is None:
+            return None
+        return dict([(name, column[row]) for name, column in zip(self.columns, self.data)])
+
+    def get_sample_name(self, lane_index, barcode):
+        ''' Description: Returns the name of the sample with 'barcode' in lane
+        'lane_index', or None.
+        '''
+
+        row = self.get_row(lane_index, barcode)
+        if row is None:
+            return None
+        if self.version == 1:
+            return row['SampleID']
+        return row['Sample_Name']
+
+    def reverse_complement_i5(self):
+        ''' Description: Reverse complement the i5 index (v2 'index2' column)
+        of every dual-index sample, along with the i5 index embedded as the
+        third '_'-separated element of its Sample_ID and Sample_Name. Returns
+        the number of samples changed.
+        '''
+
+        if self.version != 2:
+            return 0
+
+        rows = [row for row, i5_index in enumerate(self.data[5]) if i5_index]
+        if not rows:
+            return 0
+
+        def replace_i5(values, rc_i5_indexes):
+            for row, rc_i5_index in zip(rows, rc_i5_indexes):
+                elements = values[row].split('_')
+                if len(elements) > 2:
+                    elements[2] = rc_i5_index
+                    values[row] = '_'.join(elements)
+
+        rc_i5_indexes = [reverse_complement(self.data[5][row]) for row in rows]
+        replace_i5(self.data[2], rc_i5_indexes)
+        replace_i5(self.data[3], rc_i5_indexes)
+        for row, rc_i5_index in zip(rows, rc_i5_indexes):
+            self.data[5][row] = rc_i5_index
+        self.index()
+        return len(rows)
+
+    def write(self, filename, lane_index=None):
+        ''' Description: Write the sample sheet, or only the samples of lane
+        'lane_index', to 'filename'.
+        '''
+
+        if lane_index is None:
+            rows = range(len(self))
+        else:
+            rows = self.lanes.get(int(lane_index), [])
+
+        lines = list(self.preamble)
+        lines.append(','.join(self.columns))
+        for row in rows:
+            lines.append(','.join([column[row] for column in self.data]))
+        with open(filename, 'w') as OUT:
+            OUT.write('\n'.join(lines) + '\n')
+
+def parse_reads(tree):
+    """Parses the reads of a RunInfo.xml element tree. Returns a list of
+    dicts, each describing the configuration of one read. """
+
+    reads = []
+
+    for read_elt in tree.findall(".//Read"):
+        read_desc = {}
+
+        read_desc['Number'] = int(read_elt.get('Number'))
+        read_desc['NumCycles'] = int(read_elt.get('NumCycles'))
+
+        is_indexed = read_elt.get('IsIndexedRead')
+        if is_indexed == 'Y':
+            read_desc['IsIndexedRead'] = True
+        elif is_indexed == 'N':
+            read_desc['IsIndexedRead'] = False
+        else:
+            raise RuntimeError('Invalid value for IsIndexedRead: %s' % is_indexed)
+
+        reads.append(read_desc)
+
+    return sorted(reads, key=lambda read_desc: read_desc['Number'])
+
+def find_text(tree, tags):
+    """Returns the text of the first element of an element tree with one of
+    the given tags, in order of preference, or None."""
+
+    for tag in tags:
+        elt = tree.find('.//' + tag)
+        if elt is not None and elt.text and elt.text.strip():
+            return elt.text.strip()
+    return None
+
+def reverse_complement(seq):
+    """Returns the reverse complement of a DNA sequence."""
+
+    return seq[::-1].translate(COMPLEMENT)
+
+def create_sample_sheet(conn, run_name, bcl2fastq_version, lane=None):
+    """Creates a sample sheet for the run, or a single lane of the run, from
+    LIMS using an scgpm_lims Connection. Returns the sample sheet filename."""
+
+    fn = run_name
+    if lane:
+        fn += "_L" + str(lane)
+    fn += '_samplesheet.csv'
+    conn.getsamplesheet(run=run_name, lane=lane, bcl2fastq_version=bcl2fastq_version, filename=fn)
+    return fn
+
+def get_barcode_length(barcode):
+    """Returns the length of the given barcode. If the barcode is empty or
+    'Undetermined', returns None. If the barcode is a dual-indexed barcode,
+    returns a tuple containing the lengths of the two parts. Otherwise,
+    returns the length of the barcode."""
+
+    if barcode == '' or barcode == 'Undetermined':
+        return None
+    elif '-' in barcode:
+        barcodes = barcode.split('-')
+        assert len(barcodes) == 2
+        return (len(barcodes[0]), len(barcodes[1]))
+    else:
+        return len(barcode)
+
+def get_distinct_lengths(barcode_lengths):
+    """Given a list of barcode lengths, possibly including None, returns a
+    list of the distinct lengths, excluding None."""
+
+    len_set = {bc_len for bc_len in barcode_lengths if bc_len != None}
+    return list(len_set)
+
+def get_actual_barcode_length(barcode_lengths):
+    """Verify that the given list of barcode lengths contains a single
+    element, and return it."""
+
+    if len(barcode_lengths) == 0:
+        return None
+    elif len(barcode_lengths) == 1:
+        return barcode_lengths[0]
+    else:
+        raise RuntimeError('Found multiple barcode lengths (%s) in sample sheet' % barcode_lengths)
+
+def get_use_bases_mask(read_config, barcode_length):
+    """Calculates the correct value of --use-bases-mask, given the read
+    configuration and barcode length(s) determined from the sample
+    sheet."""
+
+    components = []
+
+    for read_desc in read_config:
+        if read_desc['IsIndexedRead'] == False:
+            # non-index read: keep all bases
+            components.append('y%d' % read_desc['NumCycles'])
+        else:
+            # index read: construct based on barcode length
+            read_len = read_desc['NumCycles']
+            barcode_len = None
+            if read_desc['Number'] == 2:
+                # first index
+                barcode_len = barcode_length[0]
+            elif read_desc['Number'] == 3:
+                # second index
+                barcode_len = barcode_length[1]
+            else:
+                raise RuntimeError('Invalid read number for index read: %d' % read_desc['Number'])
+
+            icomp = ''
+            if barcode_len != 0:
+                icomp = 'I%d' % barcode_len
+
+            ncomp = ''
+            if read_len - barcode_len != 0:
+                ncomp = 'n%d' % (read_len - barcode_len)
+
+            components.append(icomp + ncomp)
+
+    return ','.join(components)
+
+def calculate_use_bases_mask(run_config, sample_sheet, lane_index):
+    """Returns the --use-bases-mask value for a lane, given a RunConfig and
+    a SampleSheet."""
+
+    barcodes = sample_sheet.get_barcodes(lane_index)
+    print >> sys.stderr, 'barcodes: %s' % barcodes
+
+    barcode_lengths = [get_barcode_length(bc) for bc in barcodes]
+    distinct_lengths = get_distinct_lengths(barcode_lengths)
+    print >> sys.stderr, 'distinct_lengths: %s' % distinct_lengths
+
+    barcode_length = get_actual_barcode_length(distinct_lengths)
+    if barcode_length == None:
+        print >> sys.stderr, 'Found no barcodes'
+        barcode_length = (0, 0)
+    elif isinstance(barcode_length, int):
+        print >> sys.stderr, 'Found single-index barcodes of length %s' % barcode_length
+        barcode_length = (barcode_length, 0)
+    elif isinstance(barcode_length, tuple):
+        print >> sys.stderr, 'Found dual-index barcodes of lengths %s and %s' % barcode_length
+
+    use_bases_mask = get_use_bases_mask(run_config.reads, barcode_length)
+    print >> sys.stderr, 'use_bases_mask: %s' % use_bases_mask
+    return use_bases_mask
+
+def create_run_index(run_config, run_parameters, sample_sheet, lane_index, fastqs, **lane_info):
+    """Returns the run metadata index of a converted lane: read geometry,
+    tiles, lane barcode, RTA version, the barcodes and sample names of each
+    lane in the sample sheet, and the fastq file IDs of each read of each
+    sample of the lane, as a list in chunk order.
+
+    'fastqs' is a list of dicts with the 'file_id', 'barcode' and 'read' of
+    each fastq file, and optionally its 'barcode_name', 'chunk', and the
+    'sample_reads' and 'sample_yield' of its sample from the demultiplexing
+    statistics. Keyword arguments (i.e. run_name, use_bases_mask) are added
+    to the index as they are."""
+
+    lane_index = int(lane_index)
+    data_reads = [read for read in run_config.reads if not read['IsIndexedRead']]
+    index_reads = [read for read in run_config.reads if read['IsIndexedRead']]
+
+    lanes = {}
+    for lane in sorted(sample_sheet.lanes.keys()):
+        barcodes = [barcode.rstrip('-') for barcode in sample_sheet.get_barcodes(lane)]
+        lanes[str(lane)] = {
+                            'barcodes': barcodes,
+                            'sample_names': dict([(barcode, sample_sheet.get_sample_name(lane, barcode)) 
+                                                  for barcode in barcodes])
+                           }
+
+    samples = {}
+    for fastq in fastqs:
+        barcode = fastq['barcode']
+        if not barcode in samples:
+            samples[barcode] = {
+                                'barcode_name': fastq.get('barcode_name'),
+                                'sample_name': sample_sheet.get_sample_name(lane_index, barcode),
+                                'fastqs': {}
+                               }
+        if fastq.get('sample_reads') is not None:
+            samples[barcode]['reads'] = int(fastq['sample_reads'])
+            samples[barcode]['yield'] = int(fastq['sample_yield'])
+        samples[barcode]['fastqs'].setdefault(str(fastq['read']), []).append((int(fastq.get('chunk') or 1), 
+                                                                               fastq['file_id']))
+    for sample in samples.values():
+        for read, chunks in sample['fastqs'].items():
+            sample['fastqs'][read] = [fastq_dxid for chunk, fastq_dxid in sorted(chunks)]
+
+    run_index = {
+                 'version': RUN_INDEX_VERSION,
+                 'run_id': run_config.run_id,
+                 'flowcell': run_config.flowcell,
+                 'lane_index': lane_index,
+                 'lane_barcode': run_parameters.lane_barcode,
+                 'rta_version': run_parameters.rta_version,
+                 'instrument': run_parameters.instrument,
+                 'reads': run_config.reads,
+                 'read_lengths': [read['NumCycles'] for read in data_reads],
+                 'index_lengths': [read['NumCycles'] for read in index_reads],
+                 'paired_end': len(data_reads) > 1,
+                 'tiles': run_config.get_lane_tiles(lane_index) if run_config.layout else [],
+                 'lanes': lanes,
+                 'samples': samples
+                }
+    run_index.update(lane_info)
+    return run_index
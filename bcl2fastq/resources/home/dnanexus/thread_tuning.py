@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+"""
+Chooses the bcl2fastq v2 thread split (--loading-threads, --processing-threads
+and --writing-threads) for a lane.
+
+Without a benchmark, the split is derived from the instance: loading and
+writing threads are mostly waiting on I/O, so a few of each are enough, and
+bcl2fastq never uses more writing threads than there are samples (plus the
+Undetermined output). Processing threads get every core, limited by memory.
+
+A benchmark sweeps candidate profiles around the derived one on a subset of
+tiles. Winning profiles are cached in a JSON file keyed by instance type and
+run geometry (use bases mask, tiles per lane and sample count), so later
+lanes with the same shape reuse them without benchmarking.
+"""
+
+import json
+import multiprocessing
+
+CACHE_VERSION = 1
+
+# Memory held by bcl2fastq regardless of the number of threads (GB)
+BASE_MEMORY_GB = 4.0
+# Additional memory per processing thread (GB); a conservative estimate
+MEMORY_PER_PROCESSING_THREAD_GB = 0.5
+
+MAX_LOADING_THREADS = 8
+MAX_WRITING_THREADS = 8
+
+def get_cpu_count():
+    return multiprocessing.cpu_count()
+
+def get_memory_gb(meminfo_file='/proc/meminfo'):
+    ''' Description: Returns the total memory of the instance in GB, or None
+    if it cannot be read.
+    '''
+
+    try:
+        with open(meminfo_file, 'r') as MEMINFO:
+            for line in MEMINFO:
+                if line.startswith('MemTotal:'):
+                    return int(line.split()[1]) / 1024.0 / 1024.0
+    except IOError:
+        pass
+    return None
+
+def get_max_processing_threads(cpus, memory_gb):
+    ''' Description: Returns the number of processing threads that fit in
+    memory, or 'cpus' * 2 if memory is unknown.
+    '''
+
+    if memory_gb is None:
+        return cpus * 2
+    return max(1, int((memory_gb - BASE_MEMORY_GB) / MEMORY_PER_PROCESSING_THREAD_GB))
+
+def make_profile(loading_threads, processing_threads, writing_threads, source):
+    return {
+            'loading_threads': int(loading_threads),
+            'processing_threads': int(processing_threads),
+            'writing_threads': int(writing_threads),
+            'source': source
+           }
+
+def derive_thread_profile(cpus, memory_gb, samples):
+    ''' Description: Returns the thread profile derived from the number of
+    cores, the memory and the number of samples of the lane.
+    '''
+
+    loading_threads = min(MAX_LOADING_THREADS, max(2, cpus // 4))
+    writing_threads = min(MAX_WRITING_THREADS, max(2, cpus // 4), samples + 1)
+    processing_threads = min(cpus, get_max_processing_threads(cpus, memory_gb))
+    return make_profile(loading_threads, processing_threads, writing_threads, 'derived')
+
+def get_candidate_profiles(cpus, memory_gb, samples):
+    ''' Description: Returns the thread profiles swept by the benchmark: the
+    derived profile, plus variants with more loading or writing threads and
+    with processing threads oversubscribed to cover I/O wait.
+    '''
+
+    derived = derive_thread_profile(cpus, memory_gb, samples)
+    max_processing_threads = get_max_processing_threads(cpus, memory_gb)
+
+    loading_options = sorted(set([derived['loading_threads'],
+                                  min(MAX_LOADING_THREADS, derived['loading_threads'] * 2)]))
+    writing_options = sorted(set([derived['writing_threads'],
+                                  min(MAX_WRITING_THREADS, derived['writing_threads'] * 2, samples + 1)]))
+    processing_options = sorted(set([derived['processing_threads'],
+                                     min(max_processing_threads, cpus + cpus // 2)]))
+
+    profiles = []
+    for loading_threads in loading_options:
+        for writing_threads in writing_options:
+            for processing_threads in processing_options:
+                profiles.append(make_profile(loading_threads, processing_threads, writing_threads, 'benchmark'))
+    return profiles
+
+def get_geometry_key(use_bases_mask, tile_count, samples):
+    ''' Description: Returns the run geometry part of a cache key. Sample
+    counts are rounded up to a power of two so that similar lanes share a
+    profile.
+    '''
+
+    samples_bucket = 1
+    while samples_bucket < samples:
+        samples_bucket *= 2
+    return '%s|tiles=%d|samples<=%d' % (use_bases_mask, tile_count, samples_bucket)
+
+def get_cache_key(instance_type, geometry_key):
+    return '%s|%s' % (instance_type, geometry_key)
+
+def load_cache(cache_file=None):
+    ''' Description: Read a profile cache JSON file, or return an empty cache.
+    '''
+
+    if cache_file:
+        with open(cache_file, 'r') as CACHE:
+            cache = json.load(CACHE)
+        if cache.get('version') == CACHE_VERSION:
+            return cache
+    return {'version': CACHE_VERSION, 'profiles': {}}
+
+def write_cache(cache, cache_file):
+    with open(cache_file, 'w') as CACHE:
+        json.dump(cache, CACHE, indent=2, sort_keys=True)
+
+def select_profile(results):
+    ''' Description: Returns the profile with the highest throughput from a
+    list of benchmark results (profiles with 'clusters_per_second' and
+    'seconds'), or None.
+    '''
+
+    results = [result for result in results if result.get('seconds')]
+    if not results:
+        return None
+    return max(results, key=lambda result: (result.get('clusters_per_second') or 0, -result['seconds']))
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+
+"""
+Profiles the index sequences of reads bcl2fastq could not assign to a sample.
+
+The Undetermined fastq files of a lane are streamed once. The index sequence
+is taken from the end of each read header (i.e. '1:N:0:ACGTACGT+TTTTGGGG')
+and counted with a Misra-Gries heavy-hitters summary, so memory is bounded by
+the summary capacity plus one batch of headers regardless of the number of
+reads. Each reported count is an underestimate by at most 'max_error'.
+
+The most frequent index sequences are matched against the LIMS barcodes of
+the lane, including reverse-complement and swapped i7/i5 variants, which are
+the usual cause of a high fraction of undetermined reads.
+"""
+
+import json
+import gzip
+import itertools
+import subprocess
+import collections
+import distutils.spawn
+
+from run_metadata import reverse_complement
+
+# Number of index sequences tracked by the heavy-hitters summary
+SUMMARY_CAPACITY = 10000
+# Number of read headers counted exactly before merging into the summary
+BATCH_SIZE = 1000000
+# Number of index sequences reported
+TOP_K = 100
+
+class HeavyHitters:
+
+    def __init__(self, capacity=SUMMARY_CAPACITY):
+        ''' Description: Mergeable Misra-Gries summary of item counts with a
+        fixed number of counters.
+
+        Attributes:
+        capacity (int): Maximum number of items tracked
+        counts (dict): Item : estimated count
+        total (int): Exact number of items counted
+        max_error (int): Upper bound on the underestimate of any count
+        '''
+
+        self.capacity = capacity
+        self.counts = {}
+        self.total = 0
+        self.max_error = 0
+
+    def update(self, batch_counts):
+        ''' Description: Merge the exact counts of a batch (dict or Counter)
+        into the summary. When more than 'capacity' items are tracked, the
+        count of the first item past capacity is subtracted from every count
+        and items left without a count are evicted.
+        '''
+
+        counts = self.counts
+        for item, count in batch_counts.iteritems():
+            counts[item] = counts.get(item, 0) + count
+            self.total += count
+
+        if len(counts) > self.capacity:
+            ranked = sorted(counts.itervalues(), reverse=True)
+            decrement = ranked[self.capacity]
+            self.counts = dict([(item, count - decrement) for item, count in counts.iteritems() if count > decrement])
+            self.max_error += decrement
+
+    def top(self, k=TOP_K):
+        ''' Description: Returns the k items with the highest counts as a list
+        of (item, count) tuples.
+        '''
+
+        return sorted(self.counts.iteritems(), key=lambda item: (-item[1], item[0]))[:k]
+
+def open_fastq(fastq_file):
+    ''' Description: Open a gzipped fastq file for streaming, decompressing
+    with pigz in a separate process if it is installed. Returns the stream and
+    the pigz process (or None).
+    '''
+
+    if distutils.spawn.find_executable('pigz'):
+        process = subprocess.Popen(['pigz', '-dc', fastq_file], stdout=subprocess.PIPE, bufsize=-1)
+        return process.stdout, process
+    return gzip.open(fastq_file, 'rb'), None
+
+def count_index_sequences(fastq_files, summary=None, batch_size=BATCH_SIZE):
+    ''' Description: Count the index sequences in the read headers of
+    'fastq_files' in a single streaming pass. Dual indexes are joined with
+    '-' like LIMS barcodes. Returns the HeavyHitters summary.
+    '''
+
+    if summary is None:
+        summary = HeavyHitters()
+
+    for fastq_file in fastq_files:
+        stream, process = open_fastq(fastq_file)
+        headers = itertools.islice(stream, 0, None, 4)
+        while True:
+            batch = collections.Counter(header[header.rfind(':') + 1:].rstrip()
+                                        for header in itertools.islice(headers, batch_size))
+            if not batch:
+                break
+            summary.update(dict([(index.replace('+', '-'), count) for index, count in batch.iteritems()]))
+        stream.close()
+        if process is not None and process.wait() != 0:
+            raise RuntimeError('Could not decompress %s' % fastq_file)
+    return summary
+
+def get_barcode_variants(barcode):
+    ''' Description: Returns (variant, description) tuples for the ways a
+    barcode is commonly misread or misentered: reverse-complemented i7 or i5
+    indexes and swapped index reads.
+    '''
+
+    indexes = barcode.split('-')
+    variants = [(barcode, 'exact')]
+    if len(indexes) == 1:
+        variants.append((reverse_complement(barcode), 'rc_i7'))
+    else:
+        i7_index, i5_index = indexes[0], indexes[1]
+        variants.append(('-'.join([i7_index, reverse_complement(i5_index)]), 'rc_i5'))
+        variants.append(('-'.join([reverse_complement(i7_index), i5_index]), 'rc_i7'))
+        variants.append(('-'.join([reverse_complement(i7_index), reverse_complement(i5_index)]), 'rc_i7_rc_i5'))
+        variants.append(('-'.join([i5_index, i7_index]), 'swapped'))
+    return variants
+
+def profile_undetermined(fastq_files, barcode_dict, top_k=TOP_K):
+    ''' Description: Profile the index sequences of the Undetermined fastq
+    files of a lane. 'barcode_dict' maps LIMS barcodes (codepoints) to
+    barcode names. Returns a report dict.
+    '''
+
+    summary = count_index_sequences(fastq_files)
+
+    variant_dict = {}
+    for barcode, name in barcode_dict.items():
+        for variant, description in get_barcode_variants(barcode):
+            variant_dict.setdefault(variant, (barcode, name, description))
+
+    index_sequences = []
+    for index_sequence, count in summary.top(top_k):
+        match = variant_dict.get(index_sequence, (None, None, None))
+        index_sequences.append({
+                                'index': index_sequence,
+                                'count': count,
+                                'fraction': float(count) / summary.total if summary.total else 0.0,
+                                'barcode': match[0],
+                                'barcode_name': match[1],
+                                'match': match[2]
+                               })
+    report = {
+              'fastq_files': fastq_files,
+              'reads': summary.total,
+              'max_error': summary.max_error,
+              'index_sequences': index_sequences
+             }
+    return report
+
+def write_report(report, json_file, tsv_file):
+    ''' Description: Write an undetermined profile report as JSON and as a
+    TSV table of the most frequent index sequences.
+    '''
+
+    with open(json_file, 'w') as JSON:
+        json.dump(report, JSON, indent=2, sort_keys=True)
+    with open(tsv_file, 'w') as TSV:
+        TSV.write('index\tcount\tfraction\tbarcode\tbarcode_name\tmatch\n')
+        for entry in report['index_sequences']:
+            fields = [entry['index'], str(entry['count']), '%.6f' % entry['fraction'],
+                      entry['barcode'] or '', entry['barcode_name'] or '', entry['match'] or '']
+            TSV.write('\t'.join(fields) + '\n')
@@ -16,16 +16,72 @@ import dxpy
 import time
 import json
 import shutil
+import glob
 import fnmatch
 import datetime
+import hashlib
+import threading
+import distutils.spawn
 import subprocess
+import collections
 
 from distutils.version import StrictVersion
+from multiprocessing.pool import ThreadPool
 
 # Use homemade scgpm_lims package to access LIMS
 from scgpm_lims import Connection
 from scgpm_lims import RunInfo
 
+# Helper modules are installed to the job home directory from resources/home/dnanexus
+sys.path.append('/home/dnanexus')
+import run_metadata
+import barcode_collisions
+import undetermined_profiler
+import thread_tuning
+import bcl_validation
+import demux_stats
+import subprocess_supervisor
+import fastq_stats
+import fastq_compression
+import fastq_split
+
+# Fastq upload settings
+UPLOAD_WORKERS = 8
+UPLOAD_ATTEMPTS = 4
+UPLOAD_RETRY_DELAY = 30     # seconds; doubled after each failed attempt
+
+# Bytes read from the objectstore per write to tar when unpacking input files
+TAR_STREAM_CHUNK_SIZE = 16 * 1024 * 1024
+
+# Run metadata directories that lane conversions do not read; left out of
+# the run metadata shared with the lanes of a whole-run job
+RUN_METADATA_EXCLUDES = ['Images', 'Thumbnail_Images', 'Logs']
+
+# Bytes read from local fastq files per write to the objectstore when uploading
+UPLOAD_CHUNK_SIZE = 16 * 1024 * 1024
+
+# File properties computed from the fastq data while uploading
+FASTQ_STATS_PROPERTIES = ['md5', 'size', 'uncompressed_size', 'read_count', 'base_count', 
+                          'mean_quality', 'q30_fraction']
+# File properties of fastq files recompressed while uploading
+FASTQ_COMPRESSION_PROPERTIES = ['compression', 'compression_level', 'source_md5', 'source_size']
+# Fastq file properties recorded in the run metadata index
+FASTQ_INDEX_PROPERTIES = ['barcode', 'barcode_name', 'read', 'chunk', 'sample_reads', 'sample_yield']
+
+# Gzip levels of the fastq_compression modes. Fastq files are recompressed 
+# into BGZF at this level while uploading; bcl2fastq v2 then writes them at 
+# BCL2FASTQ_COMPRESSION_LEVEL, so compression does not hold up its writing threads.
+FASTQ_COMPRESSION_LEVELS = {'fast': 1, 'archival': 9}
+BCL2FASTQ_COMPRESSION_LEVEL = 1
+
+# Minimum seconds between checkpoint manifest updates while fastq files upload
+CHECKPOINT_INTERVAL = 60
+
+# Groups of tiles bcl2fastq v2 converts in turn when fastq files are uploaded
+# during conversion; the fastq files of a group are uploaded while the next 
+# group is converted
+STREAM_TILE_GROUPS = 8
+
 class InputParameters:
 
     def __init__(self, params_dict):
@@ -38,10 +94,31 @@ class InputParameters:
         '''
         
         # Required parameters
-        self.record_link = params_dict['record_link']
-        self.lane_data_tar = params_dict['lane_data_tar']
         self.metadata_tar = params_dict['metadata_tar']
 
+        # Either a single lane (record_link, lane_data_tar) or all lanes of
+        # a run (record_links, lane_data_tars) must be specified
+        run_inputs = [key for key in ['record_links', 'lane_data_tars'] if key in params_dict.keys()]
+        if len(run_inputs) == 1:
+            raise dxpy.AppError('record_links and lane_data_tars must be specified together; found only %s' % run_inputs[0])
+        if not run_inputs:
+            if not 'record_link' in params_dict.keys() or not 'lane_data_tar' in params_dict.keys():
+                raise dxpy.AppError('Either record_link and lane_data_tar or record_links and lane_data_tars must be specified')
+            self.record_links = None
+            self.lane_data_tars = None
+            self.record_link = params_dict['record_link']
+            self.lane_data_tar = params_dict['lane_data_tar']
+        else:
+            self.record_links = params_dict['record_links']
+            self.lane_data_tars = params_dict['lane_data_tars']
+            self.record_link = None
+            self.lane_data_tar = None
+            if not self.record_links:
+                raise dxpy.AppError('No lane records in record_links')
+            if len(self.record_links) != len(self.lane_data_tars):
+                raise dxpy.AppError('Found %d record links but %d lane tar files' % (len(self.record_links), 
+                                                                                      len(self.lane_data_tars)))
+
         # Optional parameters
         if not 'output_folder' in params_dict.keys():
             self.output_folder = '/stage_bcl2fastq'
@@ -53,8 +130,9 @@ class InputParameters:
         else:
             self.test_mode = params_dict['test_mode']
 
+        # None: select the largest safe value from the lane barcodes
         if not 'barcode_mismatches' in params_dict.keys():
-            self.mismatches = 1
+            self.mismatches = None
         else:
             self.mismatches = params_dict['barcode_mismatches']
 
@@ -63,18 +141,19 @@ class InputParameters:
         else:
             self.ignore_missing_stats = params_dict['ignore_missing_stats']
 
+        # None: set from the pre-flight scan of the lane input (see validate_bcl_input)
         if not 'ignore_missing_bcl' in params_dict.keys():
-            self.ignore_missing_bcl = True
+            self.ignore_missing_bcl = None
         else:
             self.ignore_missing_bcl = params_dict['ignore_missing_bcl']
 
         if not 'ignore_missing_positions' in params_dict.keys():
-            self.ignore_missing_positions = True
+            self.ignore_missing_positions = None
         else:
             self.ignore_missing_positions = params_dict['ignore_missing_positions']
 
         if not 'ignore_missing_filter' in params_dict.keys():
-            self.ignore_missing_filter = True
+            self.ignore_missing_filter = None
         else:
             self.ignore_missing_filter = params_dict['ignore_missing_filter']
 
@@ -88,9 +167,82 @@ class InputParameters:
         else:
             self.tiles = params_dict['tiles']
 
+        if not 'stream_upload' in params_dict.keys():
+            self.stream_upload = False
+        else:
+            self.stream_upload = params_dict['stream_upload']
+
+        if not 'shards' in params_dict.keys():
+            self.shards = 1
+        else:
+            self.shards = params_dict['shards']
+
+        if not 'upload_workers' in params_dict.keys():
+            self.upload_workers = UPLOAD_WORKERS
+        else:
+            self.upload_workers = params_dict['upload_workers']
+
+        if not 'profile_undetermined' in params_dict.keys():
+            self.profile_undetermined = False
+        else:
+            self.profile_undetermined = params_dict['profile_undetermined']
+
+        if not 'dedup_upload' in params_dict.keys():
+            self.dedup_upload = False
+        else:
+            self.dedup_upload = params_dict['dedup_upload']
+
+        if not 'thread_profile_cache' in params_dict.keys():
+            self.thread_profile_cache = None
+        else:
+            self.thread_profile_cache = params_dict['thread_profile_cache']
+
+        if not 'benchmark_threads' in params_dict.keys():
+            self.benchmark_threads = False
+        else:
+            self.benchmark_threads = params_dict['benchmark_threads']
+
+        if not 'benchmark_tiles' in params_dict.keys():
+            self.benchmark_tiles = 4
+        else:
+            self.benchmark_tiles = params_dict['benchmark_tiles']
+        # Without tiles, every benchmark run would convert the whole lane
+        if self.benchmark_tiles < 1:
+            raise dxpy.AppError('benchmark_tiles must be at least 1, not %s' % self.benchmark_tiles)
+
+        # 0: one fastq file per barcode/read
+        if not 'fastq_chunk_reads' in params_dict.keys():
+            self.fastq_chunk_reads = 0
+        else:
+            self.fastq_chunk_reads = params_dict['fastq_chunk_reads']
+
+        # 0: no preview
+        if not 'preview_tiles' in params_dict.keys():
+            self.preview_tiles = 0
+        else:
+            self.preview_tiles = params_dict['preview_tiles']
+
+        if not 'preview_only' in params_dict.keys():
+            self.preview_only = False
+        else:
+            self.preview_only = params_dict['preview_only']
+
+        # 'bcl2fastq': upload fastq files as written by bcl2fastq
+        if not 'fastq_compression' in params_dict.keys():
+            self.fastq_compression = 'bcl2fastq'
+        else:
+            self.fastq_compression = params_dict['fastq_compression']
+        if self.fastq_compression != 'bcl2fastq' and not self.fastq_compression in FASTQ_COMPRESSION_LEVELS:
+            raise dxpy.AppError('Unknown fastq compression mode: %s' % self.fastq_compression)
+
 class FlowcellLane:
     
-    def __init__(self, record_link):
+    def __init__(self, record_link, barcode_dict=None):
+        ''' Input:
+        record_link (str): Dashboard record of the lane ("project-XXX:record-YYY")
+        barcode_dict (dict): Barcode codepoint to name mapping for the lane. 
+                             Retrieved from LIMS if not specified.
+        '''
         
         self.record_link = record_link.strip()
         link_elements = self.record_link.split(':')
@@ -127,10 +279,29 @@ class FlowcellLane:
         self.home = os.getcwd()
 
         self.sample_sheet = None
+        self.sample_sheet_data = None
+        self.sample_sheet_file = None
+        self.run_config = None
+        self.run_parameters = None
         self.output_dir = None
         self.bcl2fastq_version = None
         self.lane_barcode = None
         self.flowcell_id = None
+        self.barcode_mismatches = None
+        self.checkpoint = None
+        self.thread_profile = None
+        self.thread_profile_cache_file = None
+        self.fastq_stats = {}   # fastq file ID : statistics
+        self.demux_summary = None
+        self.sample_stats = {}  # barcode : (reads, yield) from bcl2fastq demultiplexing statistics
+        self.dedup_upload = False
+        self.fastq_chunk_reads = 0
+        self.tile_group_chunks = False  # Tile groups are converted in turn and uploaded as chunks
+        self.dedup_index = None # fastq name : list of existing file descriptions
+        self.dedup_lock = threading.Lock()
+        self.fastq_compression = None   # Recompression mode (see FASTQ_COMPRESSION_LEVELS)
+        self.compression_threads = 1
+        self.compression_stats = {}     # fastq file ID : BgzfRecompressor
 
         # Choose bcl2fastq version based on rta_version
         ## DEV: Update version to match official documentation: i.e. 1.18.54 or later
@@ -141,28 +312,36 @@ class FlowcellLane:
 
         # Get barcode information (codepoint + name) from LIMS
         # Used to add barcode name to FastQ files
-        self.connection = Connection(lims_url=self.lims_url, lims_token=self.lims_token)
-        self.run_info = RunInfo(conn=self.connection, run=self.run_name)
-        self.lane_info = self.run_info.get_lane(self.lane_index)
-        
-        self.barcode_dict = {}
-        barcode_list = self.lane_info['barcodes']
-        for barcode_info in barcode_list:
-            self.barcode_dict[barcode_info['codepoint']] = barcode_info['name']
+        if barcode_dict is None:
+            self.connection = Connection(lims_url=self.lims_url, lims_token=self.lims_token)
+            self.run_info = RunInfo(conn=self.connection, run=self.run_name)
+            self.lane_info = self.run_info.get_lane(self.lane_index)
+            self.barcode_dict = get_barcode_dict(self.lane_info)
+        else:
+            # Barcodes were already retrieved by a whole-run job
+            self.connection = None
+            self.run_info = None
+            self.lane_info = None
+            self.barcode_dict = dict(barcode_dict)
 
     def describe(self):
         print "Sequencing run: %s" % self.run_name
         print "Flowcell lane index: %s" % self.lane_index
 
-    def unpack_tar(self, tar_file_dxlink):
+    def unpack_tar(self, tar_file_dxlink, directory=None):
         '''
         DEV: Eventually integrate dx-toolkit into trajectoread repo so I can 
              transition to using 'dx-download-all-inputs' to handle unpacking
              all input files.
              Pipeline used to store lane file dxids as project properties 
              and then pass to "dx download"
-        Description: Download and untar metadata and lane data files 
-                     (/Data/Intensities/BaseCalls)
+        Description: Stream metadata and lane data tar files (/Data/Intensities/BaseCalls) 
+                     from the DNAnexus objectstore directly into tar, so files are 
+                     extracted while the download is still in progress and the 
+                     tar file itself is never written to disk. Compression is 
+                     detected from the first bytes of the file (gzip, zstd or 
+                     uncompressed). Files are extracted into 'directory', or 
+                     the working directory if None.
         '''
 
         if dxpy.is_dxlink(tar_file_dxlink):
@@ -176,31 +355,69 @@ class FlowcellLane:
         file_dxid = dxpy.get_dxlink_ids(tar_file_dxlink)[0]
         project_id = dxpy.get_dxlink_ids(tar_file_dxlink)[1]
 
-        # Download file from DNAnexus objectstore to virtual machine
-        dxpy.download_dxfile(dxid=file_dxid, filename=filename, project=project_id)
-
-        # Untar file
-        ## DEV: Check if this is even in use anymore; also should have some method for 
-        ## checking what type of compression was used.
-        ## But I don't think this is in use
-        command = 'tar -xf %s --owner root --group root --no-same-owner' % filename
-        self.createSubprocess(cmd=command, pipeStdout=False)
+        tar_stream = dxpy.open_dxfile(dxid=file_dxid, project=project_id, 
+                                      read_buffer_size=TAR_STREAM_CHUNK_SIZE)
+        chunk = tar_stream.read(TAR_STREAM_CHUNK_SIZE)
+        
+        command = 'tar -xf - --owner root --group root --no-same-owner'
+        compression = get_tar_compression_option(chunk)
+        if compression:
+            command += ' %s' % compression
+        print 'Streaming %s into: %s' % (filename, command)
+        
+        start_time = time.time()
+        bytes_read = 0
+        popen = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE, cwd=directory)
+        try:
+            while chunk:
+                try:
+                    popen.stdin.write(chunk)
+                except IOError as error:
+                    # tar exited early; report its return code below
+                    print 'Warning: Could not write to tar: %s' % error
+                    break
+                bytes_read += len(chunk)
+                chunk = tar_stream.read(TAR_STREAM_CHUNK_SIZE)
+        finally:
+            # tar only exits once its input is closed, so a failed download
+            # is raised instead of leaving it waiting for more data
+            popen.stdin.close()
+            retcode = popen.wait()
+        if retcode:
+            raise Exception("subprocess command '{cmd}' failed with returncode '{returncode}' after reading {bytes} bytes of {filename}.".format(cmd=command,returncode=retcode,bytes=bytes_read,filename=filename))
+
+        elapsed = max(time.time() - start_time, 1e-6)
+        print 'Unpacked %s (%.1f MB) in %.1f seconds: %.1f MB/s' % (filename,
+                                                                     bytes_read / 1e6,
+                                                                     elapsed,
+                                                                     bytes_read / 1e6 / elapsed)
+
+    def unpack_tars(self, tar_file_dxlinks, directory=None):
+        ''' Description: Stream and unpack several tar files concurrently.
+        '''
 
-    def upload_result_files(self, output_folder):
-        ''' DEV: Look into using glob.glob to find all fastq files instead of 
-                 manually listing the directories and searching them, a la 
-                 implementation in gbsc/gbsc_utils/demultiplexing.py.
-            DEV: Upload
+        pool = ThreadPool(processes = len(tar_file_dxlinks))
+        try:
+            pool.map(lambda tar_file_dxlink: self.unpack_tar(tar_file_dxlink, directory),
+                     tar_file_dxlinks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    def upload_lane_html(self, misc_subfolder, report_html_file=None):
+        ''' Description: Upload the bcl2fastq lane.html report, or the 
+        'report_html_file' written instead of it, to the lane project.
         '''
-        
-        fastq_files = []
-        fastqs_subfolder = output_folder + '/fastqs'
-        misc_subfolder = output_folder + '/miscellany'
-        lane_dir = self.home + '/Unaligned_L' + str(self.lane_index)
 
-        # Upload lane.html file
-        self.lane_barcode = self.get_lane_barcode()
-        report_html_file = 'Unaligned_L%d/Reports/html/%s/all/all/all/lane.html' % (self.lane_index, self.lane_barcode)
+        if self.checkpoint and self.checkpoint.is_complete('lane_html'):
+            lane_html_dxid = self.checkpoint.get_stage('lane_html')['lane_html']
+            print 'Skipping upload of lane.html; uploaded by a previous job as %s' % lane_html_dxid
+            return dxpy.DXFile(dxid = lane_html_dxid, project = self.lane_project_id)
+
+        if not report_html_file:
+            self.lane_barcode = self.get_lane_barcode()
+            report_html_file = 'Unaligned_L%d/Reports/html/%s/all/all/all/lane.html' % (self.lane_index, self.lane_barcode)
+            report_html_file = os.path.join(self.home, report_html_file)
         properties = {
                       'run_date':   str(self.run_date),
                       'run_name':   str(self.run_name),
@@ -224,152 +441,663 @@ class FlowcellLane:
                                                 folder = misc_subfolder, 
                                                 parents = True
                                                )
+        if self.checkpoint:
+            self.checkpoint.complete_stage('lane_html', {'lane_html': lane_html_file.get_id()})
+        return lane_html_file
+
+    def upload_summary_lane_html(self, misc_subfolder):
+        ''' Description: Write the lane.html report from the lane 
+        demultiplexing summary and upload it, for lanes converted in several 
+        parts whose bcl2fastq lane.html reports each cover some of the tiles.
+        '''
 
-        # Upload fastq files generated by bcl2fastq version 1 (1.8.4)
-        ## Note: This version shouldn't ever be used anymore
-        if self.bcl2fastq_version == 1:
-            warning = 'Warning: Using bcl2fastq version 1.8.4. All sequencing platforms '
-            warning += 'should be compliant with bcl2fastq (RTA >= 1.18.54)'
-            print warning
+        lane_html_name = 'lane_L%d.html' % self.lane_index
+        demux_stats.write_lane_html(self.demux_summary, lane_html_name, 
+                                    '%s lane %d' % (self.run_name, self.lane_index))
+        return self.upload_lane_html(misc_subfolder, report_html_file=lane_html_name)
+
+    def get_fastq_dirs(self, output_dir=None):
+        ''' Description: Returns a list of (directory, sanitize_barcode_name) 
+        tuples for each directory bcl2fastq writes fastq files to, in 
+        'output_dir' or the lane directory. Barcode names are only sanitized 
+        for files in the lane directory, matching the names the applet has 
+        always produced.
+        '''
 
-            flowcell_dir = lane_dir + '/Project_' + self.flowcell_id
-            sample_dir = flowcell_dir + '/Sample_lane%s' % self.lane_index
+        lane_dir = os.path.join(self.home, output_dir or 'Unaligned_L%d' % self.lane_index)
 
-            # Upload all the fastq files from the lane directory (Unaligned_L%d)
-            os.chdir(sample_dir)
-            for filename in os.listdir('.'):
-                if fnmatch.fnmatch(filename, '*.fastq.gz'):
-                    scgpm_names = self.get_SCGPM_fastq_name_rta_v1(filename)
-                    scgpm_fastq_name = scgpm_names[0]
-                    barcode = scgpm_names[1]
-                    read_index = scgpm_names[2]
-                    fastq_name_v2 = 'SCGPM_%s_%s_%s_L%d_%s_R%d.fastq.gz' % (self.run_date,
-                                                                        self.library_name,
-                                                                        self.flowcell_id,
-                                                                        self.lane_index,
-                                                                        barcode,
-                                                                        int(read_index)
-                                                                       )
-                    properties = {'barcode': str(barcode),
-                                  'read': str(read),
-                                  'run_date': str(self.run_date),
-                                  'library_id': str(self.library_id),
-                                  'lane_id': str(self.lane_id),
-                                  'library_name': str(self.library_name)
-                                 }
-
-                    if not os.path.isfile(fastq_name_v2):
-                        shutil.move(filename, fastq_name_v2)
-                    fastq_file = dxpy.upload_local_file(filename = fastq_name_v2, 
-                                                        properties = properties, 
-                                                        project = self.lane_project_id, 
-                                                        folder = fastqs_subfolder, 
-                                                        parents = True)
-                    fastq_files.append(dxpy.dxlink(fastq_file))
+        # Fastq files generated by bcl2fastq version 1 (1.8.4)
+        if self.bcl2fastq_version == 1:
+            flowcell_dir = os.path.join(lane_dir, 'Project_' + self.flowcell_id)
+            sample_dir = os.path.join(flowcell_dir, 'Sample_lane%s' % self.lane_index)
+            return [(sample_dir, True)]
         
-        # Upload fastq files generated by bcl2fastq version 2 (2.17.-)
+        # Fastq files generated by bcl2fastq version 2 (2.17.-)
+        # Undetermined fastqs are in the lane directory (Unaligned_L%d) and
+        # sample fastqs are in the flowcell directory (Unaligned_L%d/<flowcell_id>)
         elif self.bcl2fastq_version == 2:
-            flowcell_dir = lane_dir + '/' + self.flowcell_id
-            
-            # Upload all the fastq files from the lane directory (Unaligned_L%d)            
-            os.chdir(lane_dir)
-            for filename in os.listdir('.'):
-                if fnmatch.fnmatch(filename, '*.fastq.gz'):
-                    print filename
-
-                    scgpm_names = self.get_SCGPM_fastq_name_rta_v2(filename)
-                    scgpm_fastq_name = scgpm_names[0]
-                    barcode = scgpm_names[1]
-                    try:
-                        barcode_name = self.barcode_dict[barcode]
-                        barcode_name = re.sub(r"[^a-zA-Z0-9]+", "-", barcode_name)
-                    except:
-                        barcode_name = None
-                    read_index = scgpm_names[2]
-                    if barcode_name:
-                        fastq_name_v2 = 'SCGPM_%s_%s_L%d_%s_%s_R%d.fastq.gz' % (self.library_name, 
-                                                                                self.flowcell_id,
-                                                                                self.lane_index,  
-                                                                                barcode,
-                                                                                barcode_name, 
-                                                                                int(read_index))
-                    else:
-                        fastq_name_v2 = 'SCGPM_%s_%s_L%d_%s_R%d.fastq.gz' % (self.library_name, 
-                                                                             self.flowcell_id,
-                                                                             self.lane_index,  
-                                                                             barcode,
-                                                                             int(read_index))
-                    properties = {
-                                  'run_date': str(self.run_date),
-                                  'run_name': str(self.run_name),
-                                  'library_id': str(self.library_id),
-                                  'barcode': str(barcode),
-                                  'read': str(read_index),
-                                  'lane_index': str(self.lane_index),
-                                  'lane_id': str(self.lane_id),
-                                  'library_name': str(self.library_name)
-                                 }
-                    if barcode_name:
-                        properties['barcode_name'] = barcode_name
-
-                    if not os.path.isfile(fastq_name_v2):
-                        shutil.move(filename, fastq_name_v2)
-                    fastq_file = dxpy.upload_local_file(filename = fastq_name_v2, 
-                                                        properties = properties, 
-                                                        project = self.lane_project_id, 
-                                                        folder = fastqs_subfolder, 
-                                                        parents = True)
-                    fastq_files.append(dxpy.dxlink(fastq_file))
+            flowcell_dir = os.path.join(lane_dir, self.flowcell_id)
+            return [(lane_dir, True), (flowcell_dir, False)]
+        else:
+            print 'Error: bcl2fastq applet not equipped to handle RTA version %d files' % self.bcl2fastq_version
+            sys.exit()
 
-            # Upload all the fastq files from the flowcell directory (Unaligned_L%d/<flowcell_id>)
-            os.chdir(flowcell_dir)
-            for filename in os.listdir('.'):
+    def find_fastq_files(self, output_dir=None):
+        ''' Description: Returns a sorted list of (fastq_path, sanitize_barcode_name) 
+        tuples for all fastq files currently in the bcl2fastq output directories.
+        '''
+
+        fastq_files = []
+        for fastq_dir, sanitize_barcode_name in self.get_fastq_dirs(output_dir):
+            if not os.path.isdir(fastq_dir):
+                continue
+            for filename in os.listdir(fastq_dir):
                 if fnmatch.fnmatch(filename, '*.fastq.gz'):
-                    scgpm_names = self.get_SCGPM_fastq_name_rta_v2(filename)
-                    scgpm_fastq_name = scgpm_names[0]
-                    barcode = scgpm_names[1]
-                    try:
-                        barcode_name = self.barcode_dict[barcode]
-                    except:
-                        barcode_name = None
-                    read_index = scgpm_names[2]
-                    if barcode_name:
-                        fastq_name_v2 = 'SCGPM_%s_%s_L%d_%s_%s_R%d.fastq.gz' % (self.library_name, 
-                                                                                self.flowcell_id,
-                                                                                self.lane_index,  
-                                                                                barcode,
-                                                                                barcode_name, 
-                                                                                int(read_index))
-                    else:
-                        fastq_name_v2 = 'SCGPM_%s_%s_L%d_%s_R%d.fastq.gz' % (self.library_name, 
-                                                                             self.flowcell_id,
-                                                                             self.lane_index,  
-                                                                             barcode,
-                                                                             int(read_index))
-                    properties = {
-                                  'barcode': str(barcode),
-                                  'read': str(read_index),
-                                  'run_name': str(self.run_name),
-                                  'lane_index': str(self.lane_index),
-                                  'run_date': str(self.run_date),
-                                  'library_id': str(self.library_id),
-                                  'lane_id': str(self.lane_id),
-                                  'library_name': str(self.library_name)
-                                 }
-                    if barcode_name:
-                        properties['barcode_name'] = str(barcode_name)
-
-                    if not os.path.isfile(fastq_name_v2):
-                        shutil.move(filename, fastq_name_v2)
-                    fastq_file = dxpy.upload_local_file(filename = fastq_name_v2, 
-                                                        properties = properties, 
-                                                        project = self.lane_project_id, 
-                                                        folder = fastqs_subfolder, 
-                                                        parents = True)
-                    fastq_files.append(dxpy.dxlink(fastq_file))
+                    fastq_path = os.path.join(fastq_dir, filename)
+                    fastq_files.append((fastq_path, sanitize_barcode_name))
+        return sorted(fastq_files)
+
+    def find_undetermined_fastq_files(self):
+        ''' Description: Returns a sorted list of the read 1 Undetermined fastq
+        files of the lane. Index sequences are in the read headers, so other 
+        reads do not need to be profiled.
+        '''
+
+        lane_dir = os.path.join(self.home, 'Unaligned_L%d' % self.lane_index)
+        if self.bcl2fastq_version == 1:
+            undetermined_dir = os.path.join(lane_dir, 'Undetermined_indices', 'Sample_lane%d' % self.lane_index)
+            pattern = 'lane%d_Undetermined_*_R1_*.fastq.gz' % self.lane_index
         else:
-            print 'Error: bcl2fastq applet not equipped to handle RTA version %d files' % self.bcl2fastq_version
+            undetermined_dir = lane_dir
+            pattern = 'Undetermined_*_R1_*.fastq.gz'
+        if not os.path.isdir(undetermined_dir):
+            return []
+        return sorted([os.path.join(undetermined_dir, filename) for filename in os.listdir(undetermined_dir) 
+                       if fnmatch.fnmatch(filename, pattern)])
+
+    def profile_undetermined_reads(self, output_folder):
+        ''' Description: Count the index sequences of the Undetermined reads of
+        the lane, match the most frequent ones against the LIMS barcodes and
+        upload JSON and TSV reports to miscellany.
+        '''
+
+        misc_subfolder = output_folder + '/miscellany'
+
+        fastq_files = self.find_undetermined_fastq_files()
+        if not fastq_files:
+            print 'Warning: Could not find Undetermined fastq files to profile'
+            return None
+
+        start_time = time.time()
+        report = undetermined_profiler.profile_undetermined(fastq_files, self.barcode_dict)
+        elapsed = time.time() - start_time
+        print 'Profiled %d Undetermined reads in %.1f s' % (report['reads'], elapsed)
+        for entry in report['index_sequences'][:10]:
+            print '%s\t%d\t%s\t%s' % (entry['index'], entry['count'], entry['barcode_name'], entry['match'])
+
+        report_json = '%s_L%d_undetermined_barcodes.json' % (self.run_name, self.lane_index)
+        report_tsv = '%s_L%d_undetermined_barcodes.tsv' % (self.run_name, self.lane_index)
+        undetermined_profiler.write_report(report, report_json, report_tsv)
+        for report_file in [report_json, report_tsv]:
+            dxpy.upload_local_file(filename = report_file, 
+                                   properties = None, 
+                                   project = self.lane_project_id, 
+                                   folder = misc_subfolder, 
+                                   parents = True)
+        return report
+
+    def get_demux_stats_file(self):
+        ''' Description: Returns the demultiplexing statistics file written by
+        bcl2fastq for the lane, or None if there is none.
+        '''
+
+        lane_dir = os.path.join(self.home, 'Unaligned_L%d' % self.lane_index)
+        if self.bcl2fastq_version == 1:
+            stats_files = glob.glob(os.path.join(lane_dir, 'Basecall_Stats_*', 'Flowcell_demux_summary.xml'))
+        else:
+            stats_files = glob.glob(os.path.join(lane_dir, 'Stats', 'Stats.json'))
+        if not stats_files:
+            return None
+        return stats_files[0]
+
+    def read_demux_stats(self):
+        ''' Description: Returns the demultiplexing summary of the lane from 
+        the bcl2fastq demultiplexing statistics, or None if bcl2fastq wrote 
+        no statistics.
+        '''
+
+        stats_file = self.get_demux_stats_file()
+        if not stats_file:
+            print 'Warning: Could not find demultiplexing statistics; fastq files will not have sample yields'
+            return None
+
+        if self.bcl2fastq_version == 1:
+            return demux_stats.read_demux_summary_xml(stats_file, self.lane_index)
+        else:
+            return demux_stats.read_stats_json(stats_file, self.lane_index)
+
+    def load_demux_stats(self, misc_subfolder):
+        ''' Description: Read the per-barcode read counts and passing filter 
+        yields of the lane from the bcl2fastq demultiplexing statistics, so 
+        they can be added to fastq file properties. Returns the summary dict, 
+        or None if bcl2fastq wrote no statistics.
+        '''
+
+        summary = self.read_demux_stats()
+        if not summary:
+            return None
+        return self.record_demux_summary(summary, misc_subfolder)
+
+    def record_demux_summary(self, summary, misc_subfolder):
+        ''' Description: Keep the per-barcode read counts and yields of a 
+        lane demultiplexing summary for fastq file properties. The summary is 
+        uploaded to miscellany and recorded in the lane record properties.
+        Returns the summary dict.
+        '''
+
+        self.demux_summary = summary
+        self.sample_stats = {'unmatched': (summary['undetermined_reads'], summary['undetermined_yield'])}
+        for sample in summary['samples']:
+            if sample['barcode']:
+                self.sample_stats[sample['barcode']] = (sample['reads'], sample['yield'])
+        print 'Demultiplexed %d PF clusters into %d samples; %.1f%% undetermined' % (
+                                                    summary['clusters_pf'],
+                                                    len(summary['samples']),
+                                                    100 * summary['undetermined_fraction'])
+
+        summary_name = '%s_L%d_demux_summary.json' % (self.run_name, self.lane_index)
+        with open(summary_name, 'w') as SUMMARY:
+            json.dump(summary, SUMMARY, indent=2, sort_keys=True)
+        summary_file = dxpy.upload_local_file(filename = summary_name, 
+                                              properties = None, 
+                                              project = self.lane_project_id, 
+                                              folder = misc_subfolder, 
+                                              parents = True)
+        input_params = {
+                        'project': self.record.project, 
+                        'properties': {
+                                       'demux_summary': summary_file.get_id(),
+                                       'demux_clusters_raw': str(summary['clusters_raw']),
+                                       'demux_clusters_pf': str(summary['clusters_pf']),
+                                       'demux_samples': str(len(summary['samples'])),
+                                       'demux_undetermined_fraction': '%.4f' % summary['undetermined_fraction']
+                                      }
+                       }
+        dxpy.api.record_set_properties(object_id = self.record.get_id(), input_params = input_params)
+        return summary
+
+    def record_demux_summaries(self, summaries, misc_subfolder):
+        ''' Description: Sum the demultiplexing summaries of the parts of a 
+        lane converted separately (tile shards or tile groups) and record the 
+        lane summary (see record_demux_summary). Returns the summary dict, or 
+        None if a part has no statistics, since the lane counts would then 
+        be incomplete.
+        '''
+
+        if not summaries or not all(summaries):
+            print 'Warning: Demultiplexing statistics are missing for some tiles; fastq files will not have sample yields'
+            return None
+        return self.record_demux_summary(demux_stats.merge_summaries(summaries), misc_subfolder)
+
+    def get_sample_properties(self, barcode):
+        ''' Description: Returns the read count (clusters) and passing filter 
+        yield of all reads of the sample with a barcode, as fastq file 
+        properties. Empty if demultiplexing statistics were not loaded.
+        '''
+
+        if not barcode in self.sample_stats:
+            return {}
+        reads, sample_yield = self.sample_stats[barcode]
+        return {'sample_reads': str(reads), 'sample_yield': str(sample_yield)}
+
+    def get_fastq_upload_info(self, filename, sanitize_barcode_name=True):
+        ''' Description: Returns the SCGPM name and DNAnexus properties of a 
+        fastq file generated by bcl2fastq. Does not actually rename files.
+        '''
+
+        if self.bcl2fastq_version == 1:
+            scgpm_names = self.get_SCGPM_fastq_name_rta_v1(filename)
+            barcode = scgpm_names[1]
+            read_index = scgpm_names[2]
+            fastq_name = 'SCGPM_%s_%s_%s_L%d_%s_R%d.fastq.gz' % (self.run_date,
+                                                                 self.library_name,
+                                                                 self.flowcell_id,
+                                                                 self.lane_index,
+                                                                 barcode,
+                                                                 int(read_index)
+                                                                )
+            properties = {'barcode': str(barcode),
+                          'read': str(read_index),
+                          'run_date': str(self.run_date),
+                          'library_id': str(self.library_id),
+                          'lane_id': str(self.lane_id),
+                          'library_name': str(self.library_name)
+                         }
+            properties.update(self.get_sample_properties(barcode))
+            return self.add_fastq_chunk(filename, fastq_name, properties)
+
+        scgpm_names = self.get_SCGPM_fastq_name_rta_v2(filename)
+        barcode = scgpm_names[1]
+        try:
+            barcode_name = self.barcode_dict[barcode]
+            if sanitize_barcode_name:
+                barcode_name = re.sub(r"[^a-zA-Z0-9]+", "-", barcode_name)
+        except:
+            barcode_name = None
+        read_index = scgpm_names[2]
+        if barcode_name:
+            fastq_name = 'SCGPM_%s_%s_L%d_%s_%s_R%d.fastq.gz' % (self.library_name, 
+                                                                 self.flowcell_id,
+                                                                 self.lane_index,  
+                                                                 barcode,
+                                                                 barcode_name, 
+                                                                 int(read_index))
+        else:
+            fastq_name = 'SCGPM_%s_%s_L%d_%s_R%d.fastq.gz' % (self.library_name, 
+                                                              self.flowcell_id,
+                                                              self.lane_index,  
+                                                              barcode,
+                                                              int(read_index))
+        properties = {
+                      'run_date': str(self.run_date),
+                      'run_name': str(self.run_name),
+                      'library_id': str(self.library_id),
+                      'barcode': str(barcode),
+                      'read': str(read_index),
+                      'lane_index': str(self.lane_index),
+                      'lane_id': str(self.lane_id),
+                      'library_name': str(self.library_name)
+                     }
+        if barcode_name:
+            properties['barcode_name'] = str(barcode_name)
+        properties.update(self.get_sample_properties(barcode))
+        return self.add_fastq_chunk(filename, fastq_name, properties)
+
+    def add_fastq_chunk(self, filename, fastq_name, properties):
+        ''' Description: If fastq files are chunked, add the chunk number of a 
+        bcl2fastq fastq file (the '_001' suffix) to its SCGPM name and 
+        properties. Returns the (fastq_name, properties) tuple.
+        '''
+
+        if not self.fastq_chunk_reads and not self.tile_group_chunks:
+            return (fastq_name, properties)
+        match = re.search(r'_(\d+)\.fastq\.gz$', filename)
+        if not match:
+            print 'Error: Could not determine chunk of %s' % filename
             sys.exit()
+        chunk = int(match.group(1))
+        fastq_name = re.sub(r'\.fastq\.gz$', '_%03d.fastq.gz' % chunk, fastq_name)
+        properties['chunk'] = str(chunk)
+        return (fastq_name, properties)
+
+    def rechunk_fastq_files(self, workers=UPLOAD_WORKERS, output_dir=None):
+        ''' Description: Split each fastq file written by bcl2fastq v2 to 
+        'output_dir' (default: the lane directory) into chunks of 
+        'fastq_chunk_reads' reads, numbered like bcl2fastq v1 chunks (_001, 
+        _002, ...) with as many digits as the file could need (see 
+        fastq_split). Chunks are cut at the same read in every read of a 
+        sample, so paired chunks hold the same clusters. The unchunked files 
+        are removed.
+        '''
+
+        chunk_reads = int(self.fastq_chunk_reads)
+        fastq_paths = [fastq_path for fastq_path, sanitize in self.find_fastq_files(output_dir)]
+        compress_threads = max(1, thread_tuning.get_cpu_count() // max(1, min(workers, len(fastq_paths))))
+        # Chunks that are recompressed while uploading only need fast compression
+        compress_level = '-%d ' % BCL2FASTQ_COMPRESSION_LEVEL if self.fastq_compression else ''
+
+        def rechunk(fastq_path):
+            prefix = re.sub(r'_\d+\.fastq\.gz$', '_', fastq_path)
+            unchunked_path = fastq_path + '.unchunked'
+            os.rename(fastq_path, unchunked_path)
+            suffix_width = fastq_split.get_suffix_width(os.path.getsize(unchunked_path), chunk_reads)
+            command = 'pigz -dc %s | ' % unchunked_path
+            command += fastq_split.split_command(chunk_reads, prefix, suffix_width, first_suffix=1,
+                                                 compress_command='pigz %s-p %d' % (compress_level, compress_threads))
+            subprocess_supervisor.run(command, pipefail=True, echo=False)
+            chunk_count = len(fastq_split.list_chunks(prefix))
+            if chunk_count:
+                os.remove(unchunked_path)
+            else:
+                # No reads; keep the empty file as the only chunk
+                os.rename(unchunked_path, fastq_split.get_chunk_path(prefix, suffix_width, 1))
+                chunk_count = 1
+            return chunk_count
+
+        print 'Splitting %d fastq files into chunks of %d reads' % (len(fastq_paths), self.fastq_chunk_reads)
+        pool = ThreadPool(processes = max(1, min(workers, len(fastq_paths))))
+        try:
+            chunk_counts = pool.map(rechunk, fastq_paths, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+        # Every read of a sample must have the same number of chunks
+        sample_chunks = {}
+        for fastq_path, chunk_count in zip(fastq_paths, chunk_counts):
+            sample = re.sub(r'_R\d_\d+\.fastq\.gz$', '', fastq_path)
+            sample_chunks.setdefault(sample, set()).add(chunk_count)
+        for sample, chunk_count_set in sample_chunks.items():
+            if len(chunk_count_set) > 1:
+                raise RuntimeError('Reads of %s were split into different numbers of chunks: %s' % (
+                                                    sample, sorted(chunk_count_set)))
+        print 'Wrote %d fastq chunks' % sum(chunk_counts)
+
+    def upload_fastq_file(self, fastq_path, fastqs_subfolder, sanitize_barcode_name=True, 
+                          checkpoint=True):
+        ''' Description: Upload a single fastq file to the lane project using 
+        its SCGPM name. Failed uploads are retried with exponential backoff; 
+        the incomplete file left by a failed attempt is removed before retrying.
+        If 'checkpoint' is set, a file already uploaded by a previous job is 
+        reused and new uploads are recorded in the lane checkpoint.
+        Returns the DXFile object.
+        '''
+
+        filename = os.path.basename(fastq_path)
+        fastq_name, properties = self.get_fastq_upload_info(filename, sanitize_barcode_name)
+        if checkpoint and self.checkpoint:
+            fastq_dxid = self.checkpoint.get_fastq(fastq_name)
+            if fastq_dxid:
+                print 'Skipping upload of %s; uploaded by a previous job as %s' % (filename, fastq_dxid)
+                fastq_file = dxpy.DXFile(dxid = fastq_dxid, project = self.lane_project_id)
+                file_properties = fastq_file.get_properties()
+                self.add_fastq_stats(fastq_file, fastq_name, file_properties)
+                return fastq_file
+        if self.dedup_upload:
+            fastq_file = self.find_duplicate_fastq(fastq_path, fastq_name, fastqs_subfolder)
+            if fastq_file:
+                if checkpoint and self.checkpoint:
+                    self.checkpoint.add_fastq(fastq_name, fastq_file.get_id())
+                return fastq_file
+        for attempt in range(1, UPLOAD_ATTEMPTS + 1):
+            try:
+                print 'Uploading %s as %s' % (filename, fastq_name)
+                fastq_file = self.stream_fastq_file(fastq_path, fastq_name, properties, fastqs_subfolder)
+                if checkpoint and self.checkpoint:
+                    self.checkpoint.add_fastq(fastq_name, fastq_file.get_id())
+                if self.dedup_upload:
+                    self.remove_superseded_fastqs(fastq_name, fastq_file.get_id())
+                return fastq_file
+            except Exception as error:
+                if attempt == UPLOAD_ATTEMPTS:
+                    raise
+                delay = UPLOAD_RETRY_DELAY * 2 ** (attempt - 1)
+                print 'Warning: Upload of %s failed (attempt %d of %d): %s' % (filename, attempt, UPLOAD_ATTEMPTS, error)
+                print 'Retrying in %d seconds' % delay
+                self.remove_open_files(fastq_name, fastqs_subfolder)
+                time.sleep(delay)
+
+    def load_dedup_index(self, fastqs_subfolder):
+        ''' Description: Index the closed files already in the fastqs folder of
+        the lane project by name, with their properties, using a single 
+        find_data_objects query.
+        '''
+
+        existing_files = dxpy.find_data_objects(classname = 'file', 
+                                                state = 'closed',
+                                                project = self.lane_project_id, 
+                                                folder = fastqs_subfolder, 
+                                                recurse = False,
+                                                describe = {'fields': {'name': True, 'properties': True}})
+        dedup_index = {}
+        for existing_file in existing_files:
+            description = existing_file['describe']
+            dedup_index.setdefault(description['name'], []).append({
+                                                                    'id': existing_file['id'],
+                                                                    'properties': description['properties']
+                                                                   })
+        print 'Found %d existing fastq files in %s' % (len(dedup_index), fastqs_subfolder)
+        self.dedup_index = dedup_index
+        return dedup_index
+
+    def find_duplicate_fastq(self, fastq_path, fastq_name, fastqs_subfolder):
+        ''' Description: Returns an existing file of the lane project with the
+        same name and MD5 as the local fastq file, or None.
+        '''
+
+        with self.dedup_lock:
+            if self.dedup_index is None:
+                self.load_dedup_index(fastqs_subfolder)
+            candidates = list(self.dedup_index.get(fastq_name, []))
+        # Recompressed files are matched on the MD5 of the bcl2fastq file
+        if self.fastq_compression:
+            md5_key = 'source_md5'
+            level = str(FASTQ_COMPRESSION_LEVELS[self.fastq_compression])
+            candidates = [candidate for candidate in candidates 
+                          if candidate['properties'].get('compression_level') == level]
+        else:
+            md5_key = 'md5'
+        candidates = [candidate for candidate in candidates if candidate['properties'].get(md5_key)]
+        if not candidates:
+            return None
+
+        md5 = get_file_md5(fastq_path)
+        for candidate in candidates:
+            if candidate['properties'][md5_key] == md5:
+                print 'Skipping upload of %s; identical to existing file %s' % (fastq_name, candidate['id'])
+                fastq_file = dxpy.DXFile(dxid = candidate['id'], project = self.lane_project_id)
+                self.add_fastq_stats(fastq_file, fastq_name, candidate['properties'])
+                return fastq_file
+        print '%s changed since the existing upload; uploading again' % fastq_name
+        return None
+
+    def remove_superseded_fastqs(self, fastq_name, fastq_dxid):
+        ''' Description: Remove the existing files with the name of a fastq file
+        that was just uploaded with different content, so that reruns do not
+        leave duplicates in the fastqs folder.
+        '''
+
+        with self.dedup_lock:
+            superseded = self.dedup_index.pop(fastq_name, []) if self.dedup_index else []
+        superseded_dxids = [existing['id'] for existing in superseded if existing['id'] != fastq_dxid]
+        if superseded_dxids:
+            print 'Removing %d superseded copies of %s' % (len(superseded_dxids), fastq_name)
+            self.lane_project.remove_objects(superseded_dxids)
+
+    def stream_fastq_file(self, fastq_path, fastq_name, properties, fastqs_subfolder):
+        ''' Description: Upload a fastq file, computing its checksum, sizes, read
+        and base counts and quality summary from the same chunks that are 
+        uploaded. These are added to the file properties before the file is 
+        closed. If 'fastq_compression' is set, the file is recompressed into 
+        BGZF as it is uploaded. Returns the DXFile object.
+        '''
+
+        stats = fastq_stats.FastqStats()
+        fastq_file = dxpy.new_dxfile(name = fastq_name,
+                                     properties = properties, 
+                                     project = self.lane_project_id, 
+                                     folder = fastqs_subfolder, 
+                                     parents = True,
+                                     mode = 'w')
+        if self.fastq_compression:
+            recompressor = fastq_compression.BgzfRecompressor(level = FASTQ_COMPRESSION_LEVELS[self.fastq_compression], 
+                                                              threads = self.compression_threads)
+            for chunk, data in recompressor.iter_chunks(fastq_path, UPLOAD_CHUNK_SIZE):
+                stats.update(chunk, data)
+                fastq_file.write(chunk)
+        else:
+            with open(fastq_path, 'rb') as FASTQ:
+                chunk = FASTQ.read(UPLOAD_CHUNK_SIZE)
+                while chunk:
+                    stats.update(chunk)
+                    fastq_file.write(chunk)
+                    chunk = FASTQ.read(UPLOAD_CHUNK_SIZE)
+        file_stats = stats.finish()
+        if self.fastq_compression:
+            file_stats.update({
+                               'compression': 'bgzf',
+                               'compression_level': str(recompressor.level),
+                               'source_md5': recompressor.source_md5.hexdigest(),
+                               'source_size': str(recompressor.source_size)
+                              })
+            self.compression_stats[fastq_file.get_id()] = recompressor
+        fastq_file.flush()
+        fastq_file.set_properties(file_stats)
+        fastq_file.close(block=True)
+        file_properties = dict(properties)
+        file_properties.update(file_stats)
+        self.add_fastq_stats(fastq_file, fastq_name, file_properties)
+        return fastq_file
+
+    def add_fastq_stats(self, fastq_file, fastq_name, file_properties):
+        ''' Description: Keep the statistics of an uploaded fastq file for the 
+        lane fastq manifest, and its barcode and read for the run metadata 
+        index.
+        '''
+
+        entry = {'name': fastq_name, 'file_id': fastq_file.get_id()}
+        for key in FASTQ_INDEX_PROPERTIES + FASTQ_STATS_PROPERTIES + FASTQ_COMPRESSION_PROPERTIES:
+            entry[key] = file_properties.get(key)
+        self.fastq_stats[fastq_file.get_id()] = entry
+
+    def upload_fastq_manifest(self, fastq_files, misc_subfolder):
+        ''' Description: Upload the lane fastq manifest, listing the checksum, 
+        sizes, read and base counts and quality summary of each fastq file.
+        '''
+
+        manifest_name = '%s_L%d_fastq_manifest.json' % (self.run_name, self.lane_index)
+        entries = [self.fastq_stats.get(fastq_file.get_id(), {'file_id': fastq_file.get_id()}) 
+                   for fastq_file in fastq_files]
+        return upload_fastq_manifest(manifest_name, entries, self.lane_project_id, misc_subfolder)
+
+    def upload_run_index(self, fastq_files, misc_subfolder):
+        ''' Description: Upload the run metadata index of the lane: read 
+        geometry, tiles, lane barcode, RTA version, barcodes and sample names, 
+        and the fastq file ID of each read of each sample. Downstream applets 
+        load this file instead of describing each fastq file. Returns the 
+        DXFile object.
+        '''
+
+        fastqs = [self.fastq_stats[fastq_file.get_id()] for fastq_file in fastq_files]
+        run_index = run_metadata.create_run_index(run_config = self.get_run_config(), 
+                                                  run_parameters = self.get_run_parameters(), 
+                                                  sample_sheet = self.sample_sheet_data, 
+                                                  lane_index = self.lane_index, 
+                                                  fastqs = fastqs,
+                                                  run_name = self.run_name, 
+                                                  flowcell_id = self.flowcell_id,
+                                                  library_name = self.library_name,
+                                                  bcl2fastq_version = self.bcl2fastq_version,
+                                                  use_bases_mask = self.use_bases_mask,
+                                                  barcode_mismatches = self.barcode_mismatches)
+        run_index_name = '%s_L%d_run_metadata.json' % (self.run_name, self.lane_index)
+        with open(run_index_name, 'w') as INDEX:
+            json.dump(run_index, INDEX, indent=2, sort_keys=True)
+        properties = {
+                      'run_name': str(self.run_name),
+                      'lane_index': str(self.lane_index),
+                      'run_metadata_version': str(run_metadata.RUN_INDEX_VERSION)
+                     }
+        return dxpy.upload_local_file(filename = run_index_name, 
+                                      properties = properties, 
+                                      project = self.lane_project_id, 
+                                      folder = misc_subfolder, 
+                                      parents = True)
+
+    def remove_open_files(self, name, folder):
+        ''' Description: Remove files left in the 'open' state by a failed 
+        upload so that a retry does not leave duplicates in the lane project.
+        '''
+
+        open_files = dxpy.find_data_objects(classname = 'file', 
+                                            name = name, 
+                                            name_mode = 'exact',
+                                            state = 'open',
+                                            project = self.lane_project_id,
+                                            folder = folder, 
+                                            recurse = False)
+        open_dxids = [open_file['id'] for open_file in open_files]
+        if open_dxids:
+            self.lane_project.remove_objects(open_dxids)
+
+    def upload_fastq_files(self, fastq_files, fastqs_subfolder, workers=UPLOAD_WORKERS, 
+                           checkpoint=True):
+        ''' Description: Upload fastq files concurrently using a pool of 
+        'workers' threads and print a throughput summary.
+
+        Input:
+        fastq_files (list): (fastq_path, sanitize_barcode_name) tuples
+
+        Returns: List of DXFile objects in the same order as fastq_files.
+        '''
+
+        if not fastq_files:
+            return []
+
+        total_bytes = sum([os.path.getsize(fastq_path) for fastq_path, sanitize in fastq_files])
+        start_time = time.time()
+        # Cores are shared by the recompression of the files uploaded at once
+        self.compression_threads = max(1, thread_tuning.get_cpu_count() // max(1, min(workers, len(fastq_files))))
+
+        def upload(fastq_info):
+            return self.upload_fastq_file(fastq_info[0], fastqs_subfolder, fastq_info[1], checkpoint)
+
+        pool = ThreadPool(processes = max(1, min(workers, len(fastq_files))))
+        try:
+            uploaded_files = pool.map(upload, fastq_files, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+        elapsed = max(time.time() - start_time, 1e-6)
+        print 'Uploaded %d fastq files (%.1f MB) in %.1f seconds: %.1f MB/s with %d workers' % (
+                                                                    len(fastq_files),
+                                                                    total_bytes / 1e6,
+                                                                    elapsed,
+                                                                    total_bytes / 1e6 / elapsed,
+                                                                    workers)
+        if self.fastq_compression:
+            self.print_compression_summary(uploaded_files)
+        return uploaded_files
+
+    def print_compression_summary(self, fastq_files):
+        ''' Description: Print the bytes saved by recompressing fastq files and
+        the time spent decompressing and compressing them.
+        '''
+
+        recompressors = [self.compression_stats[fastq_file.get_id()] for fastq_file in fastq_files 
+                         if fastq_file.get_id() in self.compression_stats]
+        if not recompressors:
+            return
+        source_bytes = sum([recompressor.source_size for recompressor in recompressors])
+        output_bytes = sum([recompressor.size for recompressor in recompressors])
+        saved_fraction = 1 - float(output_bytes) / source_bytes if source_bytes else 0.0
+        print 'Recompressed %d fastq files (%s): %.1f MB to %.1f MB, saved %.1f MB (%.1f%%)' % (
+                                                    len(recompressors),
+                                                    self.fastq_compression,
+                                                    source_bytes / 1e6,
+                                                    output_bytes / 1e6,
+                                                    (source_bytes - output_bytes) / 1e6,
+                                                    100 * saved_fraction)
+        print 'Recompression time: %.1f s reading and decompressing, %.1f s compressing over %d threads per file' % (
+                                                    sum([recompressor.read_seconds for recompressor in recompressors]),
+                                                    sum([recompressor.compress_seconds for recompressor in recompressors]),
+                                                    self.compression_threads)
+
+    def upload_result_files(self, output_folder, workers=UPLOAD_WORKERS):
+        ''' Description: Upload all fastq files and the lane.html report after 
+        bcl2fastq has finished.
+        '''
+        
+        fastqs_subfolder = output_folder + '/fastqs'
+        misc_subfolder = output_folder + '/miscellany'
+
+        # Upload lane.html file
+        lane_html_file = self.upload_lane_html(misc_subfolder)
+
+        # Sample yields are added to the properties of each fastq file
+        self.load_demux_stats(misc_subfolder)
+
+        if self.bcl2fastq_version == 1:
+            warning = 'Warning: Using bcl2fastq version 1.8.4. All sequencing platforms '
+            warning += 'should be compliant with bcl2fastq (RTA >= 1.18.54)'
+            print warning
+
+        # Upload all the fastq files from the lane directory (Unaligned_L%d)
+        uploaded_files = self.upload_fastq_files(self.find_fastq_files(), fastqs_subfolder, workers)
+        self.upload_fastq_manifest(uploaded_files, misc_subfolder)
+        run_index_file = self.upload_run_index(uploaded_files, misc_subfolder)
+        fastq_files = [dxpy.dxlink(fastq_file) for fastq_file in uploaded_files]
         
         print 'Uploaded fastq files:'
         for dxlink in fastq_files:
@@ -377,33 +1105,178 @@ class FlowcellLane:
 
         output = {
                   'fastqs': fastq_files,
-                  'lane_html': dxpy.dxlink(lane_html_file)
+                  'lane_html': dxpy.dxlink(lane_html_file),
+                  'run_metadata': dxpy.dxlink(run_index_file)
                  }
         return(output)
 
-    def create_sample_sheet(self, output_folder):
-        ''' Description:
+    def find_finished_fastq_files(self):
+        ''' Description: Returns the (fastq_path, sanitize_barcode_name) 
+        tuples of the fastq files bcl2fastq is known to have finished writing
+        while it is still running. Tile group chunks are only moved into the 
+        lane directory once their group is converted (see 
+        run_bcl2fastq_tile_groups). bcl2fastq v1 writes the chunks of a 
+        sample read one after another (--fastq-cluster-count), so a chunk is 
+        finished once the next one exists. Other fastq files are only 
+        finished when bcl2fastq exits.
+        '''
+
+        if self.tile_group_chunks:
+            return self.find_fastq_files()
+        if self.bcl2fastq_version != 1 or not self.fastq_chunk_reads:
+            return []
+        fastq_files = self.find_fastq_files()
+        fastq_paths = set([fastq_path for fastq_path, sanitize in fastq_files])
+        finished_files = []
+        for fastq_path, sanitize_barcode_name in fastq_files:
+            match = re.search(r'_(\d+)\.fastq\.gz$', fastq_path)
+            if not match:
+                continue
+            next_chunk = '%0*d' % (len(match.group(1)), int(match.group(1)) + 1)
+            if fastq_path[:match.start(1)] + next_chunk + '.fastq.gz' in fastq_paths:
+                finished_files.append((fastq_path, sanitize_barcode_name))
+        return finished_files
+
+    def stream_upload_result_files(self, output_folder, conversion, workers=UPLOAD_WORKERS, 
+                                   poll_interval=60):
+        ''' Description: Upload fastq files while bcl2fastq is still running, 
+        as soon as they are known to be finished (see find_finished_fastq_files),
+        and the other fastq files once bcl2fastq exits. Uploads are recorded 
+        in the lane checkpoint, and files a previous job uploaded are reused.
+
+        Input:
+        conversion (ConversionThread): Thread running bcl2fastq
+        '''
+
+        fastqs_subfolder = output_folder + '/fastqs'
+        misc_subfolder = output_folder + '/miscellany'
+
+        if not self.tile_group_chunks and (self.bcl2fastq_version != 1 or not self.fastq_chunk_reads):
+            print 'Fastq files are only finished when bcl2fastq exits; uploading them then'
+
+        uploaded = {}   # fastq path : DXFile
+        while conversion.is_alive():
+            conversion.join(poll_interval)
+            if not conversion.is_alive():
+                break
+            finished_files = [fastq_info for fastq_info in self.find_finished_fastq_files() 
+                              if not fastq_info[0] in uploaded]
+            uploaded_files = self.upload_fastq_files(finished_files, fastqs_subfolder, workers)
+            for fastq_info, fastq_file in zip(finished_files, uploaded_files):
+                uploaded[fastq_info[0]] = fastq_file
+        conversion.raise_error()
+        print 'bcl2fastq finished; %d fastq files were uploaded during conversion' % len(uploaded)
+        if self.tile_group_chunks:
+            self.record_demux_summaries(self.tile_group_summaries, misc_subfolder)
+        else:
+            self.load_demux_stats(misc_subfolder)
+
+        # Statistics are only written once bcl2fastq has finished, so sample 
+        # yields are added to the files uploaded during conversion afterwards
+        self.set_sample_properties(uploaded.values(), workers)
+
+        current_files = self.find_fastq_files()
+        remaining_files = [fastq_info for fastq_info in current_files if not fastq_info[0] in uploaded]
+        uploaded_files = self.upload_fastq_files(remaining_files, fastqs_subfolder, workers)
+        for fastq_info, fastq_file in zip(remaining_files, uploaded_files):
+            uploaded[fastq_info[0]] = fastq_file
+
+        # Files reused from the checkpoint may have been uploaded by a previous
+        # job before it loaded the statistics
+        self.set_sample_properties([fastq_file for fastq_file in uploaded_files 
+                                    if not self.fastq_stats.get(fastq_file.get_id(), {}).get('sample_reads')], 
+                                   workers)
+
+        # Output fastqs in the same order as upload_result_files()
+        uploaded_files = [uploaded[fastq_path] for fastq_path, sanitize in current_files]
+        self.upload_fastq_manifest(uploaded_files, misc_subfolder)
+        run_index_file = self.upload_run_index(uploaded_files, misc_subfolder)
+        fastq_files = [dxpy.dxlink(fastq_file) for fastq_file in uploaded_files]
+
+        # Reports are only written once bcl2fastq has finished
+        if self.tile_group_chunks:
+            lane_html_file = self.upload_summary_lane_html(misc_subfolder)
+        else:
+            lane_html_file = self.upload_lane_html(misc_subfolder)
+
+        print 'Uploaded fastq files:'
+        for dxlink in fastq_files:
+            print dxlink
+
+        output = {
+                  'fastqs': fastq_files,
+                  'lane_html': dxpy.dxlink(lane_html_file),
+                  'run_metadata': dxpy.dxlink(run_index_file)
+                 }
+        return(output)
+
+    def set_sample_properties(self, fastq_files, workers=UPLOAD_WORKERS):
+        ''' Description: Add the sample read count and yield properties to 
+        fastq files that were uploaded before demultiplexing statistics were 
+        loaded.
+        '''
+
+        def set_properties(fastq_file):
+            entry = self.fastq_stats.get(fastq_file.get_id(), {})
+            properties = self.get_sample_properties(entry.get('barcode'))
+            if properties:
+                dxpy.api.file_set_properties(fastq_file.get_id(), 
+                                             {'project': self.lane_project_id, 'properties': properties})
+                entry.update(properties)
+
+        if not fastq_files or not self.sample_stats:
+            return
+        pool = ThreadPool(processes = max(1, min(workers, len(fastq_files))))
+        try:
+            pool.map(set_properties, fastq_files, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    def get_lims_connection(self):
+        ''' Description: Returns the LIMS connection, creating it if needed.
+        '''
+
+        if not self.connection:
+            self.connection = Connection(lims_url=self.lims_url, lims_token=self.lims_token)
+        return self.connection
+
+    def create_run_sample_sheet(self):
+        ''' Description: Create a sample sheet for all lanes of the run from 
+        LIMS. Returns the sample sheet filename.
+        '''
+
+        run_sample_sheet = run_metadata.create_sample_sheet(conn = self.get_lims_connection(),
+                                                            run_name = self.run_name, 
+                                                            bcl2fastq_version = int(self.bcl2fastq_version))
+        print 'Created run sample sheet: %s' % run_sample_sheet
+        return run_sample_sheet
+
+    def create_sample_sheet(self, output_folder, run_sample_sheet=None):
+        ''' Description: Create the lane sample sheet from LIMS, or extract 
+        it from 'run_sample_sheet' if one was already created for the whole run.
+        The sample sheet is parsed once into self.sample_sheet_data, which is 
+        used to get the flowcell ID and the use bases mask.
         '''
 
         misc_subfolder = output_folder + '/miscellany'
         
-        command = 'python create_sample_sheet.py -r %s ' % self.run_name
-        command += '-t %s ' % self.lims_token
-        command += '-u %s ' % self.lims_url
-        command += '-b %d ' % int(self.bcl2fastq_version)
-        command += '-l %d' % int(self.lane_index)
-        
-        stdout,stderr = self.createSubprocess(cmd=command, pipeStdout=True)
-        
-        self.sample_sheet = '%s_L%d_samplesheet.csv' % (self.run_name, self.lane_index)
-        stdout_elements = stdout.split()
-        self.sample_sheet = stdout_elements[1]
+        if run_sample_sheet:
+            run_sample_sheet_data = run_metadata.SampleSheet(run_sample_sheet)
+            self.sample_sheet = '%s_L%d_samplesheet.csv' % (self.run_name, self.lane_index)
+            run_sample_sheet_data.write(self.sample_sheet, lane_index=self.lane_index)
+        else:
+            self.sample_sheet = run_metadata.create_sample_sheet(conn = self.get_lims_connection(),
+                                                                 run_name = self.run_name, 
+                                                                 bcl2fastq_version = int(self.bcl2fastq_version),
+                                                                 lane = int(self.lane_index))
         print 'This is the self.sample_sheet: %s' % self.sample_sheet
+        self.sample_sheet_data = run_metadata.SampleSheet(self.sample_sheet)
         
         # DEV: This is a dirty hack. Need to fix issue in LIMS ASAP -PBR 6/6/2016
         if self.seq_instrument not in ['Cooper', 'Gadget']:
             print 'This is not a HiSeq 4000 run: need to RC i5s'
-            self.reverse_complement_i5(self.sample_sheet)
+            self.reverse_complement_i5()
         else:
             print 'This is a HiSeq 4000 run; indexes are fine'
             # Reverse complement i5 index keys in barcode_dict
@@ -414,7 +1287,7 @@ class FlowcellLane:
                 if len(indexes) > 1:
                     dual_index = True
                     index_i7 = indexes[0]
-                    index_rci5 = reverse_complement(indexes[1])
+                    index_rci5 = run_metadata.reverse_complement(indexes[1])
                     barcode_rci5 = '-'.join([index_i7,index_rci5])
                     barcode_dict_rci5[barcode_rci5] = self.barcode_dict[key]
             if dual_index == True:
@@ -423,62 +1296,24 @@ class FlowcellLane:
 
         # DEV: insert check so that samplesheet is only uploaded if does not exist.
         #      Also, maybe add it to output?
-        dxpy.upload_local_file(filename = self.sample_sheet, 
-                               properties = None, 
-                               project = self.lane_project_id, 
-                               folder = misc_subfolder, 
-                               parents = True
-                              )
+        self.sample_sheet_file = dxpy.upload_local_file(filename = self.sample_sheet, 
+                                                        properties = None, 
+                                                        project = self.lane_project_id, 
+                                                        folder = misc_subfolder, 
+                                                        parents = True
+                                                       )
         return self.sample_sheet
         
-    def reverse_complement_i5(self, sample_sheet):
+    def reverse_complement_i5(self):
+        ''' Description: Reverse complement any i5 indexes in the parsed
+        sample sheet, and write the result to a new sample sheet file.
+        '''
 
-        # Read in samplesheet
-        # For line in file
-        # Reverse complement any i5 barcodes
         print 'Reverse complementing any i5 indexes'
-        dual_index = False
-
-        rci5_sample_sheet = '%s_L%d_rci5_samplesheet.csv' % (self.run_name, self.lane_index)
-        OUT = open(rci5_sample_sheet, 'w')
-
-        with open(sample_sheet, 'r') as IN:
-            for line in IN:
-                line = line.rstrip()
-                elements = line.split(',')
-                print elements
-                if len(elements) == 6 and elements[0] != 'Sample_Project' and elements[5]:
-                    dual_index = True
-                    print 'Found i5 indexes, replacing sample sheet'
-                    # reverse-complement Sample_Name
-                    sample_id = elements[2]
-                    id_elements = sample_id.split('_')
-                    i5_index = id_elements[2]
-                    rc_i5_index = reverse_complement(i5_index)
-                    id_elements[2] = rc_i5_index
-                    sample_id_rc_i5 = '_'.join(id_elements)
-                    elements[2] = sample_id_rc_i5
-
-                    # reverse-complement Sample_ID
-                    sample_name = elements[3]
-                    name_elements = sample_name.split('_')
-                    name_elements[2] = rc_i5_index
-                    sample_name_rc_i5 = '_'.join(name_elements)
-                    elements[3] = sample_name_rc_i5
-
-                    # reverse-complement index element
-                    elements[5] = rc_i5_index
-
-                    # Join revised elements back into string
-                    new_line = ','.join(elements)
-                    new_line += '\n'
-                    OUT.write(new_line)
-                else:
-                    line += '\n'
-                    OUT.write(line)
-        OUT.close()
-
-        if dual_index == True:
+        if self.sample_sheet_data.reverse_complement_i5():
+            print 'Found i5 indexes, replacing sample sheet'
+            rci5_sample_sheet = '%s_L%d_rci5_samplesheet.csv' % (self.run_name, self.lane_index)
+            self.sample_sheet_data.write(rci5_sample_sheet)
             self.sample_sheet = rci5_sample_sheet
 
     def get_flowcell_id(self):
@@ -490,18 +1325,8 @@ class FlowcellLane:
             warning += 'samplesheet. Creating samplesheet now.'
             self.sample_sheet = self.create_sample_sheet()
 
-        get_flowcell_id_from_line = False
-        with open(self.sample_sheet, 'r') as SAMPLE_SHEET:
-            for line in SAMPLE_SHEET:
-                elements = line.split(',')
-                if get_flowcell_id_from_line == True:
-                    self.flowcell_id = elements[0]
-                    break
-                elif elements[0] == 'FCID' or elements[0] == 'Sample_Project':
-                    # RTA v1 == 'FCID', RTA v2 == 'Sample_Project'
-                    get_flowcell_id_from_line = True
-                else:
-                    continue
+        # RTA v1 == 'FCID', RTA v2 == 'Sample_Project'
+        self.flowcell_id = self.sample_sheet_data.flowcell_id
 
         if not self.flowcell_id:
             print 'Error: Could not get flowcell ID from sample sheet'
@@ -517,22 +1342,79 @@ class FlowcellLane:
                                            input_params = input_params)
             return self.flowcell_id
 
-    def get_use_bases_mask(self, output_folder):
+    def restore_sample_sheet(self, stage):
+        ''' Description: Restore the sample sheet, barcodes and flowcell ID 
+        recorded in the 'sample_sheet' stage of a checkpoint, instead of 
+        creating them again. The sample sheet is downloaded from miscellany.
         '''
-        command = "python calculate_use_bases_mask.py {runinfoFile} {sampleSheet} {lane}"
-        gbsc_utils.createSubprocess(cmd=command)
+
+        self.sample_sheet = stage['sample_sheet']
+        self.sample_sheet_file = dxpy.DXFile(dxid = stage['sample_sheet_file'], project = self.lane_project_id)
+        dxpy.download_dxfile(dxid = self.sample_sheet_file.get_id(), 
+                             filename = self.sample_sheet, 
+                             project = self.lane_project_id)
+        self.sample_sheet_data = run_metadata.SampleSheet(self.sample_sheet)
+        self.barcode_dict = stage['barcode_dict']
+        self.flowcell_id = stage['flowcell_id']
+        print 'Restored sample sheet %s from checkpoint' % self.sample_sheet
+
+    def get_run_config(self):
+        ''' Description: Returns the run configuration parsed from RunInfo.xml.
         '''
-        
+
+        if not self.run_config:
+            self.run_config = run_metadata.RunConfig(os.path.join(self.home, 'RunInfo.xml'))
+        return self.run_config
+
+    def validate_bcl_input(self, output_folder):
+        ''' Description: Scan the basecall, filter and positions files of the 
+        lane before conversion. The missing-file matrix is uploaded to 
+        miscellany. Exits if the input is grossly incomplete. Returns the 
+        bcl2fastq ignore flags the input needs.
+        '''
+
         misc_subfolder = output_folder + '/miscellany'
-        run_info_file = 'RunInfo.xml'
+        run_config = self.get_run_config()
+        cycles = sum([read['NumCycles'] for read in run_config.reads])
+        tiles = run_config.get_lane_tiles(self.lane_index)
+
+        start_time = time.time()
+        basecalls_dir = os.path.join(self.home, 'Data', 'Intensities', 'BaseCalls')
+        report = bcl_validation.scan_lane(basecalls_dir, self.lane_index, cycles, tiles)
+        print 'Scanned %d cycles of %d tiles (%s) in %.1f seconds' % (cycles, len(tiles), report['format'], 
+                                                                      time.time() - start_time)
+        print 'Missing basecall files: %d, truncated: %d, missing filter files: %d, missing positions files: %d' % (
+                                                    report['missing_bcl'], report['truncated_bcl'],
+                                                    report['missing_filter'], report['missing_positions'])
+
+        report_json = '%s_L%d_bcl_validation.json' % (self.run_name, self.lane_index)
+        report_tsv = '%s_L%d_bcl_missing_files.tsv' % (self.run_name, self.lane_index)
+        bcl_validation.write_report(report, report_json, report_tsv)
+        for report_file in [report_json, report_tsv]:
+            dxpy.upload_local_file(filename = report_file, 
+                                   properties = None, 
+                                   project = self.lane_project_id, 
+                                   folder = misc_subfolder, 
+                                   parents = True)
+
+        problems = bcl_validation.get_gross_problems(report)
+        if problems:
+            print 'Error: Lane input is incomplete; see %s' % report_tsv
+            for problem in problems:
+                print problem
+            sys.exit(1)
+        return bcl_validation.get_ignore_flags(report)
 
-        command = 'python calculate_use_bases_mask.py %s ' % run_info_file
-        command += '%s ' % self.sample_sheet
-        command += '%d ' % int(self.lane_index)
-        command += '%d' % int(self.bcl2fastq_version)
+    def get_use_bases_mask(self, output_folder):
+        ''' Description: Calculate the use bases mask of the lane from the 
+        parsed RunInfo.xml and sample sheet.
+        '''
+        
+        misc_subfolder = output_folder + '/miscellany'
 
-        stdout,stderr = self.createSubprocess(cmd=command, pipeStdout=True)
-        self.use_bases_mask = stdout
+        self.use_bases_mask = run_metadata.calculate_use_bases_mask(self.get_run_config(), 
+                                                                    self.sample_sheet_data, 
+                                                                    int(self.lane_index))
         print 'This is use_bases_mask value: %s' % self.use_bases_mask
 
         use_bases_mask_file = 'use_bases_mask.txt'
@@ -545,23 +1427,238 @@ class FlowcellLane:
                                parents = True)
         return self.use_bases_mask
 
+    def get_barcode_mismatches(self, output_folder, mismatches=None):
+        ''' Description: Check the lane barcodes for collisions and choose the
+        barcode mismatch tolerance passed to bcl2fastq. If 'mismatches' is None
+        the largest safe tolerance is selected; otherwise 'mismatches' is used 
+        as given. The collision report is uploaded to miscellany.
+
+        Returns the bcl2fastq argument: a comma-separated tolerance per index
+        read for bcl2fastq v2 (i.e. '1,0'), or a single int for v1.
+        '''
+
+        misc_subfolder = output_folder + '/miscellany'
+
+        barcodes = self.sample_sheet_data.get_barcodes(self.lane_index)
+        report = barcode_collisions.analyze_barcodes(barcodes = barcodes, 
+                                                     bcl2fastq_version = self.bcl2fastq_version)
+        print 'Minimum barcode distance per index read: %s' % report['min_distances']
+        print 'Safe barcode mismatches per index read: %s' % report['mismatches']
+
+        if mismatches is not None:
+            self.barcode_mismatches = mismatches
+            if report['mismatches'] is not None and int(mismatches) > min(report['mismatches']):
+                print 'Warning: %d barcode mismatches may cause barcode collisions' % int(mismatches)
+        elif report['mismatches'] is None:
+            # Lane is not barcoded
+            self.barcode_mismatches = 1
+        elif self.bcl2fastq_version == 2:
+            self.barcode_mismatches = ','.join([str(value) for value in report['mismatches']])
+        else:
+            self.barcode_mismatches = min(report['mismatches'])
+        report['barcode_mismatches'] = self.barcode_mismatches
+        print 'Using barcode mismatches: %s' % self.barcode_mismatches
+
+        report_json = '%s_L%d_barcode_collisions.json' % (self.run_name, self.lane_index)
+        report_tsv = '%s_L%d_barcode_collisions.tsv' % (self.run_name, self.lane_index)
+        barcode_collisions.write_report(report, report_json, report_tsv)
+        for report_file in [report_json, report_tsv]:
+            dxpy.upload_local_file(filename = report_file, 
+                                   properties = None, 
+                                   project = self.lane_project_id, 
+                                   folder = misc_subfolder, 
+                                   parents = True)
+        return self.barcode_mismatches
+
+    def get_thread_profile(self, bcl2fastq_args, output_folder, cache_file=None, benchmark=False, 
+                           benchmark_tiles=4):
+        ''' Description: Choose the bcl2fastq v2 thread split for the lane. A 
+        profile cached for this instance type and run geometry is used if there
+        is one, unless 'benchmark' is set, in which case candidate profiles are
+        swept on 'benchmark_tiles' tiles of the lane and the fastest is cached. 
+        Otherwise the profile is derived from the cores, memory and samples.
+
+        Input:
+        bcl2fastq_args (dict): run_bcl2fastq arguments used for the benchmark
+        cache_file (dxlink): Profile cache JSON file
+        '''
+
+        if self.bcl2fastq_version != 2:
+            # bcl2fastq v1 already runs 'make -j' with all cores
+            return None
+
+        cpus = thread_tuning.get_cpu_count()
+        memory_gb = thread_tuning.get_memory_gb()
+        samples = len(self.sample_sheet_data.get_barcodes(self.lane_index))
+        tiles = self.get_run_config().get_lane_tiles(self.lane_index)
+        geometry_key = thread_tuning.get_geometry_key(self.use_bases_mask, len(tiles), samples)
+        cache_key = thread_tuning.get_cache_key(get_instance_type(), geometry_key)
+        print 'Thread profile key: %s (%d cpus, %s GB memory)' % (cache_key, cpus, memory_gb)
+
+        local_cache_file = None
+        if cache_file:
+            local_cache_file = 'thread_profile_cache.json'
+            dxpy.download_dxfile(dxid = cache_file, filename = local_cache_file)
+        cache = thread_tuning.load_cache(local_cache_file)
+
+        if cache_key in cache['profiles'] and not benchmark:
+            self.thread_profile = cache['profiles'][cache_key]
+            self.thread_profile['source'] = 'cache'
+        elif benchmark:
+            profiles = thread_tuning.get_candidate_profiles(cpus, memory_gb, samples)
+            benchmark_tiles = self.get_run_config().get_spread_tiles(self.lane_index, benchmark_tiles)
+            if benchmark_tiles:
+                results = self.benchmark_thread_profiles(profiles, benchmark_tiles, 
+                                                         bcl2fastq_args, output_folder)
+                self.thread_profile = thread_tuning.select_profile(results)
+            else:
+                print 'Warning: Could not find lane tiles to benchmark thread profiles on'
+            if self.thread_profile:
+                cache['profiles'][cache_key] = self.thread_profile
+                local_cache_file = 'thread_profile_cache.json'
+                thread_tuning.write_cache(cache, local_cache_file)
+                self.thread_profile_cache_file = dxpy.upload_local_file(filename = local_cache_file, 
+                                                                        properties = None, 
+                                                                        project = self.lane_project_id, 
+                                                                        folder = output_folder + '/miscellany', 
+                                                                        parents = True)
+        if not self.thread_profile:
+            self.thread_profile = thread_tuning.derive_thread_profile(cpus, memory_gb, samples)
+        print 'Using thread profile: %s' % self.thread_profile
+        return self.thread_profile
+
+    def benchmark_thread_profiles(self, profiles, tiles, bcl2fastq_args, output_folder):
+        ''' Description: Run bcl2fastq on a subset of the lane tiles with each 
+        thread profile and record its throughput. Benchmark output is deleted 
+        after each run. The results are uploaded to miscellany.
+
+        Returns: List of profiles with 'seconds' and 'clusters_per_second' added.
+        '''
+
+        tiles_regex = ','.join(['s_%d_%s' % (self.lane_index, tile) for tile in tiles])
+        benchmark_args = dict(bcl2fastq_args)
+        benchmark_args['tiles'] = tiles_regex
+        benchmark_args['tools_used'] = {'commands': []}
+        output_dir = 'Benchmark_L%d' % self.lane_index
+
+        results = []
+        for profile in profiles:
+            print 'Benchmarking thread profile %s on %d tiles' % (profile, len(tiles))
+            benchmark_args['thread_profile'] = profile
+            start_time = time.time()
+            try:
+                self.run_bcl2fastq(output_dir = output_dir, **benchmark_args)
+            except Exception as error:
+                print 'Warning: Benchmark failed with thread profile %s: %s' % (profile, error)
+                shutil.rmtree(output_dir, ignore_errors=True)
+                continue
+            result = dict(profile)
+            result['seconds'] = time.time() - start_time
+            clusters = get_stats_clusters(os.path.join(output_dir, 'Stats', 'Stats.json'))
+            result['clusters_per_second'] = clusters / result['seconds'] if clusters else None
+            print 'Benchmark took %.1f s (%s clusters/s)' % (result['seconds'], result['clusters_per_second'])
+            results.append(result)
+            shutil.rmtree(output_dir, ignore_errors=True)
+        self.output_dir = None
+
+        results_file = '%s_L%d_thread_benchmark.json' % (self.run_name, self.lane_index)
+        with open(results_file, 'w') as RESULTS:
+            json.dump({'tiles': tiles, 'results': results}, RESULTS, indent=2, sort_keys=True)
+        dxpy.upload_local_file(filename = results_file, 
+                               properties = None, 
+                               project = self.lane_project_id, 
+                               folder = output_folder + '/miscellany', 
+                               parents = True)
+        return results
+
+    def preview_lane(self, bcl2fastq_args, output_folder, preview_tiles):
+        ''' Description: Demultiplex 'preview_tiles' tiles spread across the 
+        surfaces and swaths of the lane, and extrapolate per-barcode yields and
+        the undetermined rate to the whole lane from Stats.json. The preview 
+        JSON is uploaded to miscellany and linked from the lane record, along 
+        with a summary in record properties. Preview output is deleted 
+        afterwards. Returns the preview JSON DXFile, or None for bcl2fastq v1,
+        which does not write Stats.json.
+
+        The preview runs once the lane data is unpacked: the lane tar is 
+        ordered by cycle, so the files of any tile span the whole stream. It 
+        saves the time of the full conversion, not of the download.
+        '''
+
+        if self.bcl2fastq_version != 2:
+            print 'Warning: Preview requires bcl2fastq v2; skipping preview'
+            return None
+
+        run_config = self.get_run_config()
+        lane_tiles = run_config.get_lane_tiles(self.lane_index)
+        tiles = run_config.get_spread_tiles(self.lane_index, preview_tiles)
+        print 'Previewing lane %d on tiles %s' % (self.lane_index, ','.join(tiles))
+
+        preview_args = dict(bcl2fastq_args)
+        preview_args['tiles'] = ','.join(['s_%d_%s' % (self.lane_index, tile) for tile in tiles])
+        preview_args['tools_used'] = {'commands': []}
+        output_dir = 'Preview_L%d' % self.lane_index
+
+        start_time = time.time()
+        try:
+            self.run_bcl2fastq(output_dir = output_dir, **preview_args)
+            summary = demux_stats.read_stats_json(os.path.join(output_dir, 'Stats', 'Stats.json'), self.lane_index)
+        finally:
+            shutil.rmtree(output_dir, ignore_errors=True)
+            self.output_dir = None
+        preview = demux_stats.extrapolate_preview(summary, len(tiles), len(lane_tiles))
+        preview['tiles'] = tiles
+        preview['seconds'] = time.time() - start_time
+        print 'Preview took %.1f s: estimated %d PF clusters, %.1f%% undetermined, %d low samples' % (
+                                                    preview['seconds'], 
+                                                    preview['estimated_clusters_pf'],
+                                                    100 * preview['undetermined_fraction'],
+                                                    len(preview['low_samples']))
+
+        preview_name = '%s_L%d_preview.json' % (self.run_name, self.lane_index)
+        with open(preview_name, 'w') as PREVIEW:
+            json.dump(preview, PREVIEW, indent=2, sort_keys=True)
+        preview_file = dxpy.upload_local_file(filename = preview_name, 
+                                              properties = None, 
+                                              project = self.lane_project_id, 
+                                              folder = output_folder + '/miscellany', 
+                                              parents = True)
+        input_params = {
+                        'project': self.record.project, 
+                        'properties': {
+                                       'preview_json': preview_file.get_id(),
+                                       'preview_estimated_clusters_pf': str(preview['estimated_clusters_pf']),
+                                       'preview_undetermined_fraction': '%.4f' % preview['undetermined_fraction'],
+                                       'preview_low_samples': ','.join([str(barcode) for barcode in preview['low_samples']])
+                                      }
+                       }
+        dxpy.api.record_set_properties(object_id = self.record.id, 
+                                       input_params = input_params)
+        return preview_file
+
+    def get_run_parameters(self):
+        ''' Description: Returns the run parameters parsed from runParameters.xml.
+        '''
+
+        if not self.run_parameters:
+            run_params_file = os.path.join(self.home, 'runParameters.xml')
+            if not os.path.isfile(run_params_file):
+                print 'Error: Could not find %s' % run_params_file
+                sys.exit()
+            self.run_parameters = run_metadata.RunParameters(run_params_file)
+        return self.run_parameters
+
     def get_lane_barcode(self):
-        run_params_file = 'runParameters.xml'
-        if not os.path.isfile(run_params_file):
-            print 'Error: Could not find %s' % run_params_file
+        lane_barcode = self.get_run_parameters().lane_barcode
+        if not lane_barcode:
+            print 'Error: Could not determine lane barcode from runParameters.xml'
             sys.exit()
-        with open(run_params_file, 'r') as PARAM:
-            for line in PARAM:
-                match = re.search(r'<Barcode>([\w-]+)</Barcode>', line)
-                if match:
-                    lane_barcode = match.group(1)
-                    return lane_barcode
-        print 'Error: Could not determine lane barcode from %s' % run_params_file
-        sys.exit()
+        return lane_barcode
 
     def run_bcl2fastq(self, mismatches, ignore_missing_stats, ignore_missing_bcl, 
                       ignore_missing_positions, ignore_missing_filter, with_failed_reads, 
-                      tiles, test_mode, tools_used):
+                      tiles, test_mode, tools_used, thread_profile=None, output_dir=None, 
+                      compression_level=None):
         '''
         DEV: Change definition line to "def run_bcl2fastq(self, **optional_params)"
         bcl2fastq --output-dir ${new_run_dir}/${seq_run_name}/Unaligned_L${SGE_TASK_ID}
@@ -569,25 +1666,33 @@ class FlowcellLane:
             --ignore-missing-bcls
             --ignore-missing-filter
             --ignore-missing-positions
-            --barcode-mismatches 1
+            --barcode-mismatches 1 (or one value per index read, i.e. 1,0)
             --use-bases-mask ${SGE_TASK_ID}:Y*,n*,Y*
+            --loading-threads 4 --processing-threads 16 --writing-threads 4 (thread_profile)
+
+        'output_dir' overrides the default output directory (Unaligned_L<lane>).
+        'compression_level' sets the gzip level of bcl2fastq v2 fastq files.
         '''
 
-        self.output_dir = 'Unaligned_L%d' % self.lane_index
+        self.output_dir = output_dir or 'Unaligned_L%d' % self.lane_index
 
         ## DEV : set all --ignore flags to on by default (consistent with existing practices)
 
         # bcl2fastq version 2 for HiSeq 4000s
         if self.bcl2fastq_version == 2:
-            self.output_dir = 'Unaligned_L%d' % self.lane_index
-            
             command = 'bcl2fastq ' 
             command += '--output-dir %s ' % self.output_dir
             command += '--sample-sheet %s ' % self.sample_sheet
-            command += '--barcode-mismatches %d ' % mismatches
+            command += '--barcode-mismatches %s ' % mismatches
             command += '--use-bases-mask %d:%s ' % (int(self.lane_index), self.use_bases_mask)
-            if test_mode and tiles:
-                command += '--tiles %d ' % tiles
+            if tiles:
+                command += '--tiles %s ' % tiles
+            if thread_profile:
+                command += '--loading-threads %d ' % thread_profile['loading_threads']
+                command += '--processing-threads %d ' % thread_profile['processing_threads']
+                command += '--writing-threads %d ' % thread_profile['writing_threads']
+            if compression_level is not None:
+                command += '--fastq-compression-level %d ' % compression_level
             if with_failed_reads:
                 command += '--with-failed-reads '
             if ignore_missing_bcl:
@@ -601,7 +1706,7 @@ class FlowcellLane:
             print command
 
             tools_used['commands'].append(command)
-            stdout,stderr = self.createSubprocess(cmd=command, pipeStdout=True)
+            subprocess_supervisor.run(command, log_file=self.get_bcl2fastq_log_file())
         
         # bcl2fastq version 1 for HiSeq 2000s/MiSeq (1.8.4)
         elif self.bcl2fastq_version == 1:
@@ -614,7 +1719,8 @@ class FlowcellLane:
             opts = "--no-eamss --input-dir " + basecalls_dir + " --output-dir " +  self.output_dir 
             opts +=" --sample-sheet " + self.sample_sheet
             opts +=" --use-bases-mask " + self.use_bases_mask
-            opts += " --fastq-cluster-count 0"  # Output it all in one file
+            # 0: Output it all in one file
+            opts += " --fastq-cluster-count %d" % int(self.fastq_chunk_reads or 0)
             if ignore_missing_bcl:
                 ignore_missing_bcl = True
             if mismatches:
@@ -625,7 +1731,7 @@ class FlowcellLane:
                 opts += " --ignore-missing-bcl"
             if  with_failed_reads:
                 opts += " --with-failed-reads"
-            if test_mode and tiles:
+            if tiles:
                 opts += " --tiles " + str(tiles)
 
             # Run it
@@ -633,8 +1739,8 @@ class FlowcellLane:
             print opts
             command_1 = configure_script_path + " " + opts
             command_2 = "nohup make -C " + self.output_dir + " -j `nproc`"
-            self.createSubprocess(cmd=configure_script_path + " " + opts, checkRetcode=True, pipeStdout=False)
-            self.createSubprocess(cmd="nohup make -C " + self.output_dir + " -j `nproc`",checkRetcode=True,pipeStdout=False)
+            subprocess_supervisor.run(command_1, log_file=self.get_bcl2fastq_log_file())
+            subprocess_supervisor.run(command_2, log_file=self.get_bcl2fastq_log_file())
             
             tools_used['commands'].append(command_1)
             tools_used['commands'].append(command_2)
@@ -642,54 +1748,58 @@ class FlowcellLane:
             print 'Could not determine bcl2fastq version'
             print EMPTY_DEBUG_VARIABLE
 
+    def run_bcl2fastq_tile_groups(self, tile_groups, **bcl2fastq_args):
+        ''' Description: Run bcl2fastq v2 on each group of tiles in turn, so 
+        that the fastq files of a group can be uploaded while the next group 
+        is converted. The fastq files of a group, split into chunks of 
+        'fastq_chunk_reads' reads if set, are then moved into the lane 
+        directory as the next chunks of each sample read; every fastq file in
+        the lane directory is finished. The demultiplexing summary of each 
+        group is kept in 'tile_group_summaries'.
+
+        Input:
+        tile_groups (list): bcl2fastq --tiles values, one per group
+        '''
+
+        lane_dirs = [fastq_dir for fastq_dir, sanitize in self.get_fastq_dirs()]
+        next_chunks = {}    # chunk path prefix in the lane directory : next chunk number
+        self.tile_group_summaries = []
+        for group_index, tiles in enumerate(tile_groups):
+            group_dir = 'Unaligned_L%d_group%03d' % (self.lane_index, group_index + 1)
+            print 'Converting tile group %d of %d' % (group_index + 1, len(tile_groups))
+            group_args = dict(bcl2fastq_args)
+            group_args['tiles'] = tiles
+            self.run_bcl2fastq(output_dir = group_dir, **group_args)
+            if self.fastq_chunk_reads:
+                self.rechunk_fastq_files(output_dir = group_dir)
+
+            stats_file = os.path.join(self.home, group_dir, 'Stats', 'Stats.json')
+            summary = None
+            if os.path.isfile(stats_file):
+                summary = demux_stats.read_stats_json(stats_file, self.lane_index)
+            self.tile_group_summaries.append(summary)
+
+            group_fastq_dirs = [fastq_dir for fastq_dir, sanitize in self.get_fastq_dirs(group_dir)]
+            for fastq_path, sanitize in self.find_fastq_files(group_dir):
+                fastq_dir = lane_dirs[group_fastq_dirs.index(os.path.dirname(fastq_path))]
+                if not os.path.isdir(fastq_dir):
+                    os.makedirs(fastq_dir)
+                filename = os.path.basename(fastq_path)
+                prefix = os.path.join(fastq_dir, re.sub(r'\d+\.fastq\.gz$', '', filename))
+                chunk = next_chunks.get(prefix, 1)
+                next_chunks[prefix] = chunk + 1
+                os.rename(fastq_path, '%s%03d.fastq.gz' % (prefix, chunk))
+            shutil.rmtree(os.path.join(self.home, group_dir))
+
     def get_rta_version(self, params_file):
-        with open(params_file, 'r') as PARAM:
-            for line in PARAM:
-                match = re.search(r'<RTAVersion>([\d\.]+)</RTAVersion>', line)
-                if match:
-                    rta_version = match.group(1)
-                    break
-        return rta_version
-
-    def createSubprocess(self, cmd, pipeStdout=False, checkRetcode=True):
-        """
-        Function: Creates a subprocess via a call to subprocess.Popen with the argument 
-                  'shell=True', and pipes stdout and stderr. Stderr is always  piped, but 
-                  stdout can be turned off. If the argument checkRetcode is True, which 
-                  it is by default, then for any non-zero return code, an Exception is
-                  raised that will print out the the command, stdout, stderr, and the 
-                  returncode when not caught. Otherwise, the Popen instance will be 
-                  return, in which case the caller must call the instance's communicate()
-                  method (and not it's wait() method!) in order to get the return code to 
-                  see if the command was a success. communicate() will return a tuple 
-                  containing (stdout, stderr). But at that point, you can then check 
-                  the return code with Popen instance's 'returncode' attribute.
-        Args    : cmd (str): Command line argument for the subprocess wrapped in the 
-                    subprocess.Popen instance. Will be printed to stdout when 
-                    there is an error in the subprocess.
-                  pipeStdout (bool): If 'True' pipe stdout of the subprocess.
-                  checkRetcode (bool): See documentation above.
-        Returns : A two-item tuple containing stdout and stderr, respectively.
-        """
-        stdout = None
-        if pipeStdout:
-            stdout = subprocess.PIPE
-            stderr = subprocess.PIPE
-        popen = subprocess.Popen(cmd,shell=True,stdout=stdout,stderr=subprocess.PIPE)
-        if checkRetcode:
-            stdout,stderr = popen.communicate()
-            if not stdout: #will be None if not piped
-                stdout = ""
-            stdout = stdout.strip()
-            stderr = stderr.strip()
-            retcode = popen.returncode
-            if retcode:
-                #below, I'd like to raise a subprocess.SubprocessError, but that doens't exist until Python 3.3.
-                raise Exception("subprocess command '{cmd}' failed with returncode '{returncode}'.\n\nstdout is: '{stdout}'.\n\nstderr is: '{stderr}'.".format(cmd=cmd,returncode=retcode,stdout=stdout,stderr=stderr))
-            return stdout,stderr
-        else:
-            return popen
-            #return stdout,stderr
+        return run_metadata.RunParameters(params_file).rta_version
+
+    def get_bcl2fastq_log_file(self):
+        ''' Description: Returns the rotating log file bcl2fastq output is 
+        written to, next to its output directory.
+        '''
+
+        return os.path.join(self.home, '%s.log' % self.output_dir)
 
     def get_SCGPM_fastq_name_rta_v1(self, fastq_filename):
         '''
@@ -837,54 +1947,694 @@ class FlowcellLane:
             pass
         return (new_fastq_filename, barcode, read_index)
 
-def reverse_complement(seq):
-    seq_dict = {'A':'T','T':'A','G':'C','C':'G'}
-    return "".join([seq_dict[base] for base in reversed(seq)])
+class LaneCheckpoint:
 
-@dxpy.entry_point("main")
-def main(**applet_input):
-    ''' Description: Use illumina bcl2fastq applet to perform demultiplex and 
-    convert bcl files to fastq files. Currently handles files generated from
-    RTA version 2.7.3 and earlier.
+    def __init__(self, lane, output_folder, inputs):
+        ''' Description: Stage checkpoints of a lane conversion, so that a 
+        restarted job skips the stages a previous job finished. Checkpoints 
+        are kept in a manifest JSON file in the miscellany folder of the lane
+        project. The manifest file ID and the last completed stage are set as
+        the 'bcl2fastq_checkpoint' and 'bcl2fastq_stage' properties of the lane 
+        record, where a restarted job finds them.
+
+        The manifest also records the file ID of each uploaded fastq file, by 
+        SCGPM name. A checkpoint is only reused by a job with the same 'inputs'.
+
+        Input:
+        lane (FlowcellLane): Lane being converted
+        output_folder (str): Output folder of the lane project
+        inputs (dict): Applet inputs that determine the conversion output
+        '''
+
+        self.lane = lane
+        self.misc_subfolder = output_folder + '/miscellany'
+        self.fastqs_subfolder = output_folder + '/fastqs'
+        self.manifest_name = '%s_L%d_bcl2fastq_checkpoint.json' % (lane.run_name, lane.lane_index)
+        self.manifest = {'inputs': inputs, 'stages': {}, 'fastqs': {}}
+        self.manifest_dxid = None
+        self.last_save = 0
+        self.lock = threading.Lock()
+
+    def load(self):
+        ''' Description: Load the checkpoint of a previous job from the lane
+        record. Fastq files that are no longer closed in the lane project are
+        dropped from it.
+        '''
+
+        manifest_dxid = self.lane.properties.get('bcl2fastq_checkpoint')
+        if not manifest_dxid:
+            return
+        try:
+            manifest_file = dxpy.open_dxfile(dxid = manifest_dxid, project = self.lane.lane_project_id)
+            manifest = json.loads(manifest_file.read())
+        except Exception as error:
+            print 'Warning: Could not read checkpoint %s: %s' % (manifest_dxid, error)
+            return
+        self.manifest_dxid = manifest_dxid
+
+        if json.dumps(manifest['inputs'], sort_keys=True) != json.dumps(self.manifest['inputs'], sort_keys=True):
+            print 'Checkpoint %s was created with different inputs; starting over' % manifest_dxid
+            return
+
+        closed_files = dxpy.find_data_objects(classname = 'file', 
+                                              state = 'closed',
+                                              project = self.lane.lane_project_id, 
+                                              folder = self.fastqs_subfolder, 
+                                              recurse = False)
+        closed_dxids = set([closed_file['id'] for closed_file in closed_files])
+        fastqs = dict([(name, dxid) for name, dxid in manifest['fastqs'].items() if dxid in closed_dxids])
+        if len(fastqs) < len(manifest['fastqs']):
+            print 'Warning: %d checkpointed fastq files are missing' % (len(manifest['fastqs']) - len(fastqs))
+            # The upload stage is only complete if all of its fastq files still exist
+            manifest['stages'].pop('upload', None)
+        manifest['fastqs'] = fastqs
+        self.manifest = manifest
+        print 'Loaded checkpoint %s: completed stages %s, %d fastq files uploaded' % (
+                                                                    manifest_dxid,
+                                                                    sorted(manifest['stages'].keys()),
+                                                                    len(fastqs))
+
+    def save(self):
+        ''' Description: Upload the manifest, remove the previous version and 
+        point the lane record at the new one. Must be called with self.lock held.
+        '''
+
+        manifest_file = dxpy.upload_string(json.dumps(self.manifest, indent=2, sort_keys=True),
+                                           name = self.manifest_name, 
+                                           project = self.lane.lane_project_id, 
+                                           folder = self.misc_subfolder, 
+                                           parents = True, 
+                                           wait_on_close = True)
+        stages = sorted(self.manifest['stages'].keys(), key=lambda stage: self.manifest['stages'][stage]['time'])
+        input_params = {
+                        'project': self.lane.record.project,
+                        'properties': {
+                                       'bcl2fastq_checkpoint': manifest_file.get_id(),
+                                       'bcl2fastq_stage': stages[-1] if stages else ''
+                                      }
+                       }
+        dxpy.api.record_set_properties(object_id = self.lane.record.id, 
+                                       input_params = input_params)
+        if self.manifest_dxid:
+            try:
+                self.lane.lane_project.remove_objects([self.manifest_dxid])
+            except dxpy.exceptions.DXAPIError as error:
+                print 'Warning: Could not remove previous checkpoint %s: %s' % (self.manifest_dxid, error)
+        self.manifest_dxid = manifest_file.get_id()
+        self.last_save = time.time()
+
+    def is_complete(self, stage):
+        return stage in self.manifest['stages']
+
+    def get_stage(self, stage):
+        return self.manifest['stages'].get(stage)
+
+    def complete_stage(self, stage, data):
+        ''' Description: Record that 'stage' has finished, with the data needed 
+        to skip it when restarting.
+        '''
+
+        with self.lock:
+            data = dict(data)
+            data['time'] = time.time()
+            self.manifest['stages'][stage] = data
+            self.save()
+        print 'Checkpoint: completed stage %s' % stage
+
+    def get_fastq(self, fastq_name):
+        with self.lock:
+            return self.manifest['fastqs'].get(fastq_name)
+
+    def add_fastq(self, fastq_name, fastq_dxid):
+        ''' Description: Record an uploaded fastq file. The manifest is saved
+        at most every CHECKPOINT_INTERVAL seconds; complete_stage() saves it 
+        when the upload stage finishes.
+        '''
+
+        with self.lock:
+            self.manifest['fastqs'][fastq_name] = fastq_dxid
+            if time.time() - self.last_save >= CHECKPOINT_INTERVAL:
+                self.save()
+
+def get_checkpoint_inputs(params):
+    ''' Description: Returns the applet inputs that determine the output of
+    a lane conversion. A checkpoint is only reused if these are unchanged.
+    '''
+
+    inputs = {
+              'lane_data_tar': params.lane_data_tar,
+              'metadata_tar': params.metadata_tar,
+              'output_folder': params.output_folder,
+              'barcode_mismatches': params.mismatches,
+              'with_failed_reads': params.with_failed_reads,
+              'test_mode': params.test_mode,
+              'shards': params.shards,
+              'fastq_chunk_reads': params.fastq_chunk_reads,
+              'stream_upload': params.stream_upload,
+              'fastq_compression': params.fastq_compression
+             }
+    if params.test_mode:
+        inputs['tiles'] = params.tiles
+    return inputs
+
+class ConversionThread(threading.Thread):
+
+    def __init__(self, lane, tile_groups=None, **bcl2fastq_args):
+        ''' Description: Runs FlowcellLane.run_bcl2fastq in the background so
+        that fastq files can be uploaded while bcl2fastq is still running, or
+        FlowcellLane.run_bcl2fastq_tile_groups if 'tile_groups' is given. 
+        Any exception is kept and re-raised in the main thread by raise_error().
+        '''
+
+        threading.Thread.__init__(self)
+        self.lane = lane
+        self.tile_groups = tile_groups
+        self.bcl2fastq_args = bcl2fastq_args
+        self.exc_info = None
+
+    def run(self):
+        try:
+            if self.tile_groups:
+                self.lane.run_bcl2fastq_tile_groups(self.tile_groups, **self.bcl2fastq_args)
+            else:
+                self.lane.run_bcl2fastq(**self.bcl2fastq_args)
+        except Exception:
+            self.exc_info = sys.exc_info()
+
+    def raise_error(self):
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+
+def get_tar_compression_option(header):
+    ''' Description: Returns the tar option needed to decompress a tar stream
+    beginning with 'header', or None if the stream is not compressed. Uses 
+    pigz for gzip streams when it is installed.
+    '''
+
+    if header.startswith('\x1f\x8b'):
+        if distutils.spawn.find_executable('pigz'):
+            return '--use-compress-program=pigz'
+        else:
+            return '--gzip'
+    elif header.startswith('\x28\xb5\x2f\xfd'):
+        if not distutils.spawn.find_executable('zstd'):
+            raise dxpy.AppError('Input tar file is zstd compressed but zstd is not installed')
+        return '--use-compress-program=zstd'
+    else:
+        return None
+
+def get_file_md5(filename):
+    ''' Description: Returns the MD5 hex digest of a local file.
+    '''
+
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as IN:
+        chunk = IN.read(UPLOAD_CHUNK_SIZE)
+        while chunk:
+            md5.update(chunk)
+            chunk = IN.read(UPLOAD_CHUNK_SIZE)
+    return md5.hexdigest()
+
+def get_instance_type():
+    ''' Description: Returns the instance type of the current job.
+    '''
+
+    if dxpy.JOB_ID:
+        return dxpy.api.job_describe(dxpy.JOB_ID)['instanceType']
+    return 'local'
+
+def get_stats_clusters(stats_file):
+    ''' Description: Returns the number of clusters converted according to 
+    a bcl2fastq v2 Stats.json file, or None if it cannot be read.
+    '''
+
+    try:
+        with open(stats_file, 'r') as STATS:
+            stats = json.load(STATS)
+        return sum([lane_result['TotalClustersRaw'] for lane_result in stats['ConversionResults']])
+    except (IOError, ValueError, KeyError):
+        return None
+
+def get_barcode_dict(lane_info):
+    ''' Description: Returns a dict mapping barcode codepoints to barcode names
+    from the LIMS lane information.
+    '''
+
+    barcode_dict = {}
+    barcode_list = lane_info['barcodes']
+    for barcode_info in barcode_list:
+        barcode_dict[barcode_info['codepoint']] = barcode_info['name']
+    return barcode_dict
+
+def split_tiles(tiles, shards):
+    ''' Description: Split a list of tiles into at most 'shards' contiguous
+    groups of nearly equal size.
+    '''
+
+    shards = max(1, min(int(shards), len(tiles)))
+    size, remainder = divmod(len(tiles), shards)
+    groups = []
+    start = 0
+    for i in range(shards):
+        end = start + size + (1 if i < remainder else 0)
+        groups.append(tiles[start:end])
+        start = end
+    return groups
+
+def concatenate_dxfiles(dxfiles, name, properties, project, folder):
+    ''' Description: Create a new file in 'project' whose contents are the
+    concatenation of 'dxfiles', streamed from the objectstore without touching
+    local disk. Concatenated gzip files are valid multi-member gzip files. 
+    Statistics of the merged fastq file are computed from the same stream and 
+    set as file properties. Returns the DXFile object and the statistics.
+    '''
+
+    stats = fastq_stats.FastqStats()
+    merged_file = dxpy.new_dxfile(name = name,
+                                  properties = properties,
+                                  project = project,
+                                  folder = folder,
+                                  parents = True,
+                                  mode = 'w')
+    for dxfile in dxfiles:
+        shard_stream = dxpy.open_dxfile(dxid=dxfile.get_id(), project=project, 
+                                        read_buffer_size=TAR_STREAM_CHUNK_SIZE)
+        chunk = shard_stream.read(TAR_STREAM_CHUNK_SIZE)
+        while chunk:
+            stats.update(chunk)
+            merged_file.write(chunk)
+            chunk = shard_stream.read(TAR_STREAM_CHUNK_SIZE)
+    file_stats = stats.finish()
+    merged_file.flush()
+    merged_file.set_properties(file_stats)
+    merged_file.close(block=True)
+    return merged_file, file_stats
+
+def upload_fastq_manifest(manifest_name, entries, project, folder):
+    ''' Description: Upload a lane fastq manifest JSON file listing 'entries',
+    one dict of fastq file statistics per fastq file.
+    '''
+
+    with open(manifest_name, 'w') as MANIFEST:
+        json.dump({'fastqs': entries}, MANIFEST, indent=2, sort_keys=True)
+    return dxpy.upload_local_file(filename = manifest_name, 
+                                  properties = None, 
+                                  project = project, 
+                                  folder = folder, 
+                                  parents = True)
+
+def launch_tile_shards(lane, params, tools_used):
+    ''' Description: Split the tiles of a lane into 'params.shards' groups and
+    demultiplex each group in its own subjob. A final merge_tile_shards job 
+    concatenates the per-shard fastq files into one fastq file per barcode/read
+    and uploads the same lane reports as an unsharded conversion. Returns the 
+    applet output as job-based object references.
+    '''
+
+    tiles = lane.get_run_config().get_lane_tiles(lane.lane_index)
+    tile_groups = split_tiles(tiles, params.shards)
+    print 'Splitting %d tiles of lane %d into %d shards' % (len(tiles), lane.lane_index, len(tile_groups))
+
+    bcl2fastq_args = {
+                      'mismatches': lane.barcode_mismatches,
+                      'ignore_missing_stats': params.ignore_missing_stats,
+                      'ignore_missing_bcl': params.ignore_missing_bcl,
+                      'with_failed_reads': params.with_failed_reads,
+                      'ignore_missing_positions': params.ignore_missing_positions,
+                      'ignore_missing_filter': params.ignore_missing_filter,
+                      'test_mode': False,
+                      'thread_profile': lane.thread_profile
+                     }
+    if lane.fastq_compression and lane.bcl2fastq_version == 2:
+        bcl2fastq_args['compression_level'] = BCL2FASTQ_COMPRESSION_LEVEL
+    shard_jobs = []
+    for shard_index, tile_group in enumerate(tile_groups):
+        tiles_regex = ','.join(['s_%d_%s' % (lane.lane_index, tile) for tile in tile_group])
+        shard_input = {
+                       'record_link': params.record_link,
+                       'lane_data_tar': params.lane_data_tar,
+                       'metadata_tar': lane.metadata_tar,
+                       'sample_sheet': dxpy.dxlink(lane.sample_sheet_file),
+                       'use_bases_mask': lane.use_bases_mask,
+                       'flowcell_id': lane.flowcell_id,
+                       'barcode_dict': lane.barcode_dict,
+                       'tiles': tiles_regex,
+                       'shard_index': shard_index,
+                       'output_folder': params.output_folder,
+                       'bcl2fastq_args': bcl2fastq_args,
+                       'upload_workers': params.upload_workers,
+                       'fastq_compression': lane.fastq_compression
+                      }
+        shard_jobs.append(dxpy.new_dxjob(fn_input=shard_input, fn_name='demultiplex_tiles'))
+
+    merge_input = {
+                   'record_link': params.record_link,
+                   'metadata_tar': lane.metadata_tar,
+                   'sample_sheet': {
+                                    'sample_sheet': lane.sample_sheet,
+                                    'sample_sheet_file': lane.sample_sheet_file.get_id(),
+                                    'barcode_dict': lane.barcode_dict,
+                                    'flowcell_id': lane.flowcell_id
+                                   },
+                   'use_bases_mask': lane.use_bases_mask,
+                   'barcode_mismatches': lane.barcode_mismatches,
+                   'output_folder': params.output_folder,
+                   'shard_fastqs': [job.get_output_ref('fastqs') for job in shard_jobs],
+                   'shard_demux_summaries': [job.get_output_ref('demux_summary') for job in shard_jobs],
+                   'shard_commands': [job.get_output_ref('commands') for job in shard_jobs],
+                   'tools_used': tools_used,
+                   'workers': params.upload_workers
+                  }
+    merge_job = dxpy.new_dxjob(fn_input=merge_input, fn_name='merge_tile_shards', depends_on=shard_jobs)
+
+    output = {
+              'fastqs': merge_job.get_output_ref('fastqs'),
+              'lane_html': merge_job.get_output_ref('lane_html'),
+              'run_metadata': merge_job.get_output_ref('run_metadata'),
+              'tools_used': merge_job.get_output_ref('tools_used')
+             }
+    return output
+
+@dxpy.entry_point("demultiplex_tiles")
+def demultiplex_tiles(record_link, lane_data_tar, metadata_tar, sample_sheet, use_bases_mask, 
+                      flowcell_id, barcode_dict, tiles, shard_index, output_folder, bcl2fastq_args,
+                      upload_workers=UPLOAD_WORKERS, fastq_compression=None):
+    ''' Description: Demultiplex the subset of lane tiles matched by 'tiles' and
+    upload the resulting fastq files to a shard folder of the lane project. 
+    Barcodes were retrieved from LIMS by the lane job. Returns the 
+    demultiplexing summary of the shard, for merge_tile_shards to sum.
+    '''
+
+    lane = FlowcellLane(record_link=record_link, barcode_dict=barcode_dict)
+    lane.unpack_tars([lane_data_tar, metadata_tar])
+
+    sample_sheet_file = dxpy.DXFile(sample_sheet)
+    lane.sample_sheet = sample_sheet_file.describe()['name']
+    dxpy.download_dxfile(dxid=sample_sheet_file.get_id(), filename=lane.sample_sheet)
+    lane.use_bases_mask = use_bases_mask
+    lane.flowcell_id = flowcell_id
+    lane.fastq_compression = fastq_compression
+
+    tools_used = {'commands': []}
+    bcl2fastq_args['tiles'] = tiles
+    bcl2fastq_args['tools_used'] = tools_used
+    print 'Shard %d: demultiplexing tiles %s' % (shard_index, tiles)
+    lane.run_bcl2fastq(**bcl2fastq_args)
+
+    shard_folder = '%s/shards/shard_%03d' % (output_folder, shard_index)
+    uploaded_files = lane.upload_fastq_files(lane.find_fastq_files(), shard_folder, upload_workers)
+
+    output = {
+              'fastqs': [dxpy.dxlink(fastq_file) for fastq_file in uploaded_files],
+              'demux_summary': lane.read_demux_stats() or {},
+              'commands': tools_used['commands']
+             }
+    return output
+
+@dxpy.entry_point("merge_tile_shards")
+def merge_tile_shards(record_link, metadata_tar, sample_sheet, use_bases_mask, barcode_mismatches, 
+                      output_folder, shard_fastqs, shard_demux_summaries, shard_commands, tools_used, 
+                      workers=UPLOAD_WORKERS):
+    ''' Description: Concatenate the fastq files of each tile shard, in shard 
+    order, into a single fastq file per barcode/read with the same name and 
+    properties as an unsharded run. The demultiplexing summaries of the 
+    shards are summed into the lane summary, and the lane.html report, fastq 
+    manifest and run metadata index are uploaded as by an unsharded run. 
+    Shard files are removed afterwards.
+    '''
+
+    lane = FlowcellLane(record_link=record_link, barcode_dict=sample_sheet['barcode_dict'])
+    lane.unpack_tars([metadata_tar])
+    lane.restore_sample_sheet(sample_sheet)
+    lane.use_bases_mask = use_bases_mask
+    lane.barcode_mismatches = barcode_mismatches
+
+    fastqs_subfolder = output_folder + '/fastqs'
+    misc_subfolder = output_folder + '/miscellany'
+    project_id = lane.lane_project_id
+    project = dxpy.DXProject(project_id)
+
+    # Group shard files by their SCGPM name, keeping shard order
+    fastq_groups = collections.OrderedDict()
+    fastq_properties = {}
+    shard_dxids = []
+    for shard in shard_fastqs:
+        for fastq_link in shard:
+            fastq_file = dxpy.DXFile(fastq_link, project=project_id)
+            description = fastq_file.describe(incl_properties=True)
+            name = description['name']
+            if not name in fastq_groups:
+                fastq_groups[name] = []
+                # The checksum and size of the file bcl2fastq wrote before
+                # recompression only describe the first shard
+                fastq_properties[name] = dict([(key, value) for key, value in description['properties'].items()
+                                               if not key in ['source_md5', 'source_size']])
+            fastq_groups[name].append(fastq_file)
+            shard_dxids.append(fastq_file.get_id())
+    
+    def merge(name):
+        print 'Merging %d shards of %s' % (len(fastq_groups[name]), name)
+        return concatenate_dxfiles(fastq_groups[name], name, fastq_properties[name], 
+                                   project_id, fastqs_subfolder)
+
+    names = sorted(fastq_groups.keys())
+    pool = ThreadPool(processes = max(1, min(workers, len(names))))
+    try:
+        merge_results = pool.map(merge, names, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    merged_files = [merged_file for merged_file, file_stats in merge_results]
+    for name, (merged_file, file_stats) in zip(names, merge_results):
+        lane.add_fastq_stats(merged_file, name, dict(fastq_properties[name], **file_stats))
+
+    lane.record_demux_summaries(shard_demux_summaries, misc_subfolder)
+    lane.set_sample_properties(merged_files, workers)
+
+    # The lane.html reports of the shards only cover their tiles
+    lane_html_file = lane.upload_summary_lane_html(misc_subfolder)
+    lane.upload_fastq_manifest(merged_files, misc_subfolder)
+    run_index_file = lane.upload_run_index(merged_files, misc_subfolder)
+
+    project.remove_objects(shard_dxids)
+    project.remove_folder(output_folder + '/shards', recurse=True)
+
+    for commands in shard_commands:
+        tools_used['commands'] += commands
+    tools_used_file = 'bcl2fastq_tools_used.json'
+    with open(tools_used_file, 'w') as TOOLS:
+        TOOLS.write(json.dumps(tools_used))
+    tools_used_id = dxpy.upload_local_file(filename = tools_used_file, 
+                                           properties = None, 
+                                           project = project_id, 
+                                           folder = misc_subfolder, 
+                                           parents = True
+                                          )
+
+    output = {
+              'fastqs': [dxpy.dxlink(merged_file) for merged_file in merged_files],
+              'lane_html': dxpy.dxlink(lane_html_file),
+              'run_metadata': dxpy.dxlink(run_index_file),
+              'tools_used': dxpy.dxlink(tools_used_id)
+             }
+    return output
+
+def convert_lane(lane, params, run_sample_sheet=None, run_metadata_tar=None):
+    ''' Description: Download, demultiplex and upload the data of a single lane.
+    Returns the applet output.
 
     Input:
-    applet_input (dictionary): Input parameters specified when calling applet 
-                               from DNAnexus
+    lane (FlowcellLane): Lane to convert
+    params (InputParameters): Applet input parameters
+    run_sample_sheet (str): Whole-run sample sheet to extract the lane sample 
+                            sheet from, instead of creating it from LIMS
     '''
 
-    params = InputParameters(applet_input)
     tools_used_dict = {'name': 'Bcl to Fastq Conversion and Demultiplexing', 'commands': []}
-
-    lane = FlowcellLane(record_link=params.record_link)
     lane.describe()
+
+    checkpoint = LaneCheckpoint(lane, params.output_folder, get_checkpoint_inputs(params))
+    checkpoint.load()
+    lane.checkpoint = checkpoint
+    lane.dedup_upload = params.dedup_upload
+    # Lanes of a whole-run job unpack the run metadata packed by convert_run
+    lane.metadata_tar = run_metadata_tar or params.metadata_tar
+    if params.fastq_compression != 'bcl2fastq':
+        lane.fastq_compression = params.fastq_compression
+    if params.shards > 1 and params.fastq_chunk_reads:
+        print 'Warning: Fastq files are not chunked in sharded mode'
+    else:
+        lane.fastq_chunk_reads = params.fastq_chunk_reads
+
+    if checkpoint.is_complete('upload'):
+        # A previous job uploaded every fastq file; nothing to convert
+        print 'All fastq files were uploaded by a previous job; skipping conversion'
+        upload_stage = checkpoint.get_stage('upload')
+        upload_output = {
+                         'fastqs': [dxpy.dxlink(dxid) for dxid in upload_stage['fastqs']],
+                         'lane_html': dxpy.dxlink(upload_stage['lane_html'])
+                        }
+        if upload_stage.get('run_metadata'):
+            upload_output['run_metadata'] = dxpy.dxlink(upload_stage['run_metadata'])
+        return finish_lane(lane, params, upload_output, upload_stage['tools_used'])
     
     print 'Downloading lane data'
-    lane.unpack_tar(params.lane_data_tar)
-    lane.unpack_tar(params.metadata_tar)
+    if params.shards > 1:
+        # Lane data is only needed by the shard subjobs
+        lane.unpack_tars([lane.metadata_tar])
+    else:
+        lane.unpack_tars([params.lane_data_tar, lane.metadata_tar])
     
-    print 'Creating sample sheet\n'
-    lane.create_sample_sheet(params.output_folder)
-
-    print 'Parsing sample sheet to get flowcell ID'
-    lane.get_flowcell_id()
+    if checkpoint.is_complete('sample_sheet'):
+        lane.restore_sample_sheet(checkpoint.get_stage('sample_sheet'))
+    else:
+        print 'Creating sample sheet\n'
+        lane.create_sample_sheet(params.output_folder, run_sample_sheet)
+
+        print 'Parsing sample sheet to get flowcell ID'
+        lane.get_flowcell_id()
+
+        checkpoint.complete_stage('sample_sheet', {
+                                                   'sample_sheet': lane.sample_sheet,
+                                                   'sample_sheet_file': lane.sample_sheet_file.get_id(),
+                                                   'barcode_dict': lane.barcode_dict,
+                                                   'flowcell_id': lane.flowcell_id
+                                                  })
     
-    print 'Get use bases mask\n'
-    lane.get_use_bases_mask(params.output_folder)
+    if checkpoint.is_complete('use_bases_mask'):
+        mask_stage = checkpoint.get_stage('use_bases_mask')
+        lane.use_bases_mask = mask_stage['use_bases_mask']
+        lane.barcode_mismatches = mask_stage['barcode_mismatches']
+        print 'Restored use bases mask %s and barcode mismatches %s from checkpoint' % (
+                                                    lane.use_bases_mask, lane.barcode_mismatches)
+    else:
+        print 'Get use bases mask\n'
+        lane.get_use_bases_mask(params.output_folder)
+
+        print 'Checking barcodes for collisions\n'
+        lane.get_barcode_mismatches(params.output_folder, params.mismatches)
+
+        checkpoint.complete_stage('use_bases_mask', {
+                                                     'use_bases_mask': lane.use_bases_mask,
+                                                     'barcode_mismatches': lane.barcode_mismatches
+                                                    })
+
+    ignore_flags = ['ignore_missing_bcl', 'ignore_missing_filter', 'ignore_missing_positions']
+    if any([getattr(params, flag) is None for flag in ignore_flags]):
+        if params.shards > 1:
+            # Lane data is only downloaded by the shard subjobs
+            print 'Warning: Lane input is not scanned in sharded mode; ignoring missing files'
+            needed_flags = dict([(flag, True) for flag in ignore_flags])
+        else:
+            print 'Scanning lane input files\n'
+            needed_flags = lane.validate_bcl_input(params.output_folder)
+        for flag in ignore_flags:
+            if getattr(params, flag) is None:
+                setattr(params, flag, needed_flags[flag])
+                print 'Setting %s to %s' % (flag, needed_flags[flag])
+
+    # Tiles are only used to restrict conversion in test mode
+    tiles = None
+    if params.test_mode:
+        tiles = params.tiles
     
-    print 'Convert bcl to fastq files'
-    lane.run_bcl2fastq(mismatches = params.mismatches,
-                       ignore_missing_stats = params.ignore_missing_stats,
-                       ignore_missing_bcl = params.ignore_missing_bcl,
-                       with_failed_reads = params.with_failed_reads,
-                       ignore_missing_positions = params.ignore_missing_positions,
-                       ignore_missing_filter = params.ignore_missing_filter,
-                       tiles = params.tiles,
-                       test_mode = params.test_mode,
-                       tools_used = tools_used_dict
-                       )
+    bcl2fastq_args = {
+                      'mismatches': lane.barcode_mismatches,
+                      'ignore_missing_stats': params.ignore_missing_stats,
+                      'ignore_missing_bcl': params.ignore_missing_bcl,
+                      'with_failed_reads': params.with_failed_reads,
+                      'ignore_missing_positions': params.ignore_missing_positions,
+                      'ignore_missing_filter': params.ignore_missing_filter,
+                      'tiles': tiles,
+                      'test_mode': params.test_mode,
+                      'tools_used': tools_used_dict
+                     }
+    if lane.fastq_compression and lane.bcl2fastq_version == 2:
+        bcl2fastq_args['compression_level'] = BCL2FASTQ_COMPRESSION_LEVEL
+
+    preview_file = None
+    if params.preview_tiles > 0:
+        if params.shards > 1:
+            print 'Warning: Lanes are not previewed in sharded mode'
+        else:
+            print 'Previewing demultiplexing on %d tiles' % params.preview_tiles
+            preview_file = lane.preview_lane(bcl2fastq_args, params.output_folder, params.preview_tiles)
+    if params.preview_only:
+        print 'Preview only; skipping conversion'
+        upload_output = {'fastqs': []}
+        if preview_file:
+            upload_output['preview'] = dxpy.dxlink(preview_file)
+        return finish_lane(lane, params, upload_output, tools_used_dict)
+
+    # Benchmarks need the lane data, which sharded jobs leave to the shard subjobs
+    benchmark = params.benchmark_threads and params.shards <= 1
+    if params.benchmark_threads and not benchmark:
+        print 'Warning: Thread profiles are not benchmarked in sharded mode'
+    print 'Choosing bcl2fastq thread profile'
+    bcl2fastq_args['thread_profile'] = lane.get_thread_profile(bcl2fastq_args, params.output_folder, 
+                                                               cache_file = params.thread_profile_cache, 
+                                                               benchmark = benchmark,
+                                                               benchmark_tiles = params.benchmark_tiles)
+
+    if params.shards > 1:
+        if params.profile_undetermined:
+            print 'Warning: Undetermined reads are not profiled in sharded mode'
+        print 'Launching tile shard subjobs'
+        output = launch_tile_shards(lane, params, tools_used_dict)
+        print 'Output'
+        print output
+        return output
+
+    tile_groups = None
+    if params.stream_upload and lane.bcl2fastq_version == 2:
+        # bcl2fastq v2 only finishes its fastq files when it exits, so groups
+        # of tiles are converted in turn and uploaded as fastq chunks
+        if bcl2fastq_args['tiles']:
+            tile_groups = [bcl2fastq_args['tiles']]
+        else:
+            tile_groups = [','.join(['s_%d_%s' % (lane.lane_index, tile) for tile in tile_group]) 
+                           for tile_group in split_tiles(lane.get_run_config().get_lane_tiles(lane.lane_index), 
+                                                         STREAM_TILE_GROUPS)]
+        print 'Converting %d tile groups in turn' % len(tile_groups)
+        lane.tile_group_chunks = True
+
+    if params.stream_upload:
+        print 'Convert bcl to fastq files and upload fastq files as they are completed'
+        conversion = ConversionThread(lane, tile_groups, **bcl2fastq_args)
+        conversion.start()
+        upload_output = lane.stream_upload_result_files(params.output_folder, conversion, 
+                                                        workers = params.upload_workers)
+    else:
+        print 'Convert bcl to fastq files'
+        lane.run_bcl2fastq(**bcl2fastq_args)
+
+        if lane.fastq_chunk_reads and lane.bcl2fastq_version == 2:
+            lane.rechunk_fastq_files(workers = params.upload_workers)
     
-    print 'Uploading fastq files back to DNAnexus'
-    upload_output = lane.upload_result_files(params.output_folder)        # returns DXLink objects
+        print 'Uploading fastq files back to DNAnexus'
+        upload_output = lane.upload_result_files(params.output_folder,
+                                                 workers = params.upload_workers)        # returns DXLink objects
+
+    checkpoint.complete_stage('upload', {
+                                         'fastqs': [dxlink['$dnanexus_link'] for dxlink in upload_output['fastqs']],
+                                         'lane_html': upload_output['lane_html']['$dnanexus_link'],
+                                         'run_metadata': upload_output['run_metadata']['$dnanexus_link'],
+                                         'tools_used': tools_used_dict
+                                        })
+
+    if params.profile_undetermined:
+        print 'Profiling barcodes of Undetermined reads'
+        lane.profile_undetermined_reads(params.output_folder)
+
+    if preview_file:
+        upload_output['preview'] = dxpy.dxlink(preview_file)
+    return finish_lane(lane, params, upload_output, tools_used_dict)
+
+def finish_lane(lane, params, upload_output, tools_used_dict):
+    ''' Description: Upload the tools used file of a converted lane and 
+    return the applet output.
+    '''
+
     #print EMPTY_DEBUG_VARIABLE
 
     # Create tools used file
@@ -901,8 +2651,12 @@ def main(**applet_input):
 
     output = {}
     output['fastqs'] = upload_output['fastqs']
-    output['lane_html'] = upload_output['lane_html']
     output['tools_used'] = dxpy.dxlink(tools_used_id)
+    for key in ['lane_html', 'run_metadata', 'preview']:
+        if key in upload_output:
+            output[key] = upload_output[key]
+    if lane.thread_profile_cache_file:
+        output['thread_profile_cache'] = dxpy.dxlink(lane.thread_profile_cache_file)
 
     #print DEBUG_STOP
 
@@ -910,4 +2664,135 @@ def main(**applet_input):
     print output
     return output
 
+def pack_run_metadata(lane, metadata_tar):
+    ''' Description: Unpack the run metadata tar once for all lanes of a run 
+    and check its RunInfo.xml. Returns the DXFile of an uncompressed tar of 
+    the run metadata without the RUN_METADATA_EXCLUDES directories, which 
+    lane conversions do not read.
+    '''
+
+    metadata_dir = os.path.join(lane.home, 'run_metadata')
+    os.mkdir(metadata_dir)
+    lane.unpack_tars([metadata_tar], directory=metadata_dir)
+
+    run_config = run_metadata.RunConfig(os.path.join(metadata_dir, 'RunInfo.xml'))
+    print 'Run %s: %d reads, %s lanes' % (run_config.run_id, len(run_config.reads), 
+                                           run_config.layout.get('LaneCount'))
+
+    run_metadata_tar = '%s_run_metadata.tar' % lane.run_name
+    excludes = ' '.join(["--exclude='./%s'" % name for name in RUN_METADATA_EXCLUDES])
+    subprocess_supervisor.run('tar -cf %s %s -C %s .' % (run_metadata_tar, excludes, metadata_dir), echo=False)
+    shutil.rmtree(metadata_dir)
+    return dxpy.upload_local_file(filename = run_metadata_tar)
+
+def convert_run(applet_input, params):
+    ''' Description: Convert all lanes of a run. LIMS run information, the 
+    run sample sheet and the run metadata are retrieved once and shared by 
+    one run_lane subjob per lane, so each lane only downloads its own data. 
+    Each subjob updates its own lane dashboard record.
+    '''
+
+    # LIMS run information, the sample sheet and the run metadata are 
+    # shared by all lanes of the run
+    first_lane = FlowcellLane(record_link=params.record_links[0])
+    run_sample_sheet = first_lane.create_run_sample_sheet()
+    run_sample_sheet_file = dxpy.upload_local_file(filename = run_sample_sheet)
+    run_metadata_file = pack_run_metadata(first_lane, params.metadata_tar)
+
+    # InputParameters checked that there is one lane tar per record
+    lane_jobs = []
+    for record_link, lane_data_tar in zip(params.record_links, params.lane_data_tars):
+        link_elements = record_link.strip().split(':')
+        record = dxpy.DXRecord(dxid=link_elements[1], project=link_elements[0])
+        lane_index = int(record.get_details()['lane'])
+        barcode_dict = get_barcode_dict(first_lane.run_info.get_lane(lane_index))
+
+        lane_input = dict(applet_input)
+        del lane_input['record_links']
+        del lane_input['lane_data_tars']
+        lane_input['record_link'] = record_link
+        lane_input['lane_data_tar'] = lane_data_tar
+        lane_input['run_sample_sheet'] = dxpy.dxlink(run_sample_sheet_file)
+        lane_input['run_metadata_tar'] = dxpy.dxlink(run_metadata_file)
+        lane_input['barcode_dict'] = barcode_dict
+        print 'Launching conversion of lane %d' % lane_index
+        lane_jobs.append(dxpy.new_dxjob(fn_input=lane_input, fn_name='run_lane'))
+
+    gather_input = {
+                    'lane_fastqs': [job.get_output_ref('fastqs') for job in lane_jobs],
+                    'lane_tools_used': [job.get_output_ref('tools_used') for job in lane_jobs]
+                   }
+    gather_job = dxpy.new_dxjob(fn_input=gather_input, fn_name='gather_lanes', depends_on=lane_jobs)
+
+    output = {
+              'fastqs': gather_job.get_output_ref('fastqs'),
+              'tools_used': gather_job.get_output_ref('tools_used')
+             }
+    print 'Output'
+    print output
+    return output
+
+@dxpy.entry_point("run_lane")
+def run_lane(run_sample_sheet, barcode_dict, run_metadata_tar, **applet_input):
+    ''' Description: Convert one lane of a whole-run job, using the sample 
+    sheet, barcodes and run metadata retrieved by the parent job. The 
+    original metadata_tar input only identifies the lane checkpoint.
+    '''
+
+    params = InputParameters(applet_input)
+    lane = FlowcellLane(record_link=params.record_link, barcode_dict=barcode_dict)
+
+    run_sample_sheet_file = dxpy.DXFile(run_sample_sheet)
+    run_sample_sheet_name = run_sample_sheet_file.describe()['name']
+    dxpy.download_dxfile(dxid=run_sample_sheet_file.get_id(), filename=run_sample_sheet_name)
+    return convert_lane(lane, params, run_sample_sheet=run_sample_sheet_name,
+                        run_metadata_tar=run_metadata_tar)
+
+@dxpy.entry_point("gather_lanes")
+def gather_lanes(lane_fastqs, lane_tools_used):
+    ''' Description: Combine the outputs of the run_lane subjobs into the 
+    applet output.
+    '''
+
+    fastqs = []
+    for lane_fastq_links in lane_fastqs:
+        fastqs += lane_fastq_links
+
+    tools_used_dict = {'name': 'Bcl to Fastq Conversion and Demultiplexing', 'commands': []}
+    for tools_used_link in lane_tools_used:
+        tools_used_file = dxpy.DXFile(tools_used_link)
+        tools_used_stream = dxpy.open_dxfile(dxid=tools_used_file.get_id(), project=tools_used_file.get_proj_id())
+        tools_used_dict['commands'] += json.loads(tools_used_stream.read())['commands']
+
+    tools_used_file = 'bcl2fastq_tools_used.json'
+    with open(tools_used_file, 'w') as TOOLS:
+        TOOLS.write(json.dumps(tools_used_dict))
+    tools_used_id = dxpy.upload_local_file(filename = tools_used_file)
+
+    output = {
+              'fastqs': fastqs,
+              'tools_used': dxpy.dxlink(tools_used_id)
+             }
+    return output
+
+@dxpy.entry_point("main")
+def main(**applet_input):
+    ''' Description: Use illumina bcl2fastq applet to perform demultiplex and 
+    convert bcl files to fastq files. Currently handles files generated from
+    RTA version 2.7.3 and earlier.
+
+    Input:
+    applet_input (dictionary): Input parameters specified when calling applet 
+                               from DNAnexus
+    '''
+
+    params = InputParameters(applet_input)
+
+    if params.record_links:
+        print 'Converting %d lanes of run' % len(params.record_links)
+        return convert_run(applet_input, params)
+
+    lane = FlowcellLane(record_link=params.record_link)
+    return convert_lane(lane, params)
+
 dxpy.run()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+"""
+Prepared reference bundles for map_sample.
+
+A bundle is an uncompressed tar archive with everything mapping needs from
+a genome: the extracted BWA index, the decompressed FASTA (genome.fa), its
+samtools faidx index (genome.fa.fai) and a SAM sequence dictionary
+(genome.dict). Workers stream the bundle straight into tar instead of
+downloading, extracting and decompressing the genome files themselves.
+
+Bundles are uploaded with properties holding the file IDs of the genome
+FASTA and index they were built from and the bundle version, so they can be
+found again with a single find_data_objects query (find_reference_bundle).
+This module is shared by map_sample, which builds and uses bundles, and
+bwa_controller, which looks one up before launching map_sample jobs.
+"""
+
+import hashlib
+
+import dxpy
+
+# Bumped when the contents of a bundle change
+BUNDLE_VERSION = 1
+
+BUNDLE_FASTA = 'genome.fa'
+BUNDLE_FAI = 'genome.fa.fai'
+BUNDLE_DICT = 'genome.dict'
+
+def get_bundle_properties(genome_fasta_id, genome_index_id):
+    ''' Description: Returns the file properties identifying the bundle of
+    a genome FASTA and BWA index.
+    '''
+
+    return {
+            'reference_bundle_version': str(BUNDLE_VERSION),
+            'genome_fasta_file': genome_fasta_id,
+            'genome_index_file': genome_index_id
+           }
+
+def find_reference_bundle(genome_fasta_file, genome_index_file, project_id):
+    ''' Description: Returns a link to a closed reference bundle built from
+    the genome FASTA and index files, looked up by their file IDs in the
+    project and in the project of the genome FASTA, or None.
+    '''
+
+    genome_fasta_file = dxpy.DXFile(genome_fasta_file)
+    genome_index_file = dxpy.DXFile(genome_index_file)
+    bundle_properties = get_bundle_properties(genome_fasta_file.get_id(), genome_index_file.get_id())
+    projects = [project_id]
+    fasta_project = genome_fasta_file.describe(fields={'project': True})['project']
+    if fasta_project != project_id:
+        projects.append(fasta_project)
+    for project in projects:
+        bundle = dxpy.find_one_data_object(classname = 'file', 
+                                           state = 'closed', 
+                                           properties = bundle_properties, 
+                                           project = project, 
+                                           zero_ok = True, 
+                                           more_ok = True)
+        if bundle:
+            return dxpy.dxlink(bundle['id'], bundle['project'])
+    return None
+
+def iter_fasta_sequences(fasta_file):
+    ''' Description: Yields (name, length, md5) tuples for each sequence of
+    an uncompressed FASTA file. The MD5 is of the upper-case sequence, as in
+    the M5 field of a SAM sequence dictionary.
+    '''
+
+    name = None
+    length = 0
+    md5 = None
+    with open(fasta_file, 'r') as FASTA:
+        for line in FASTA:
+            if line.startswith('>'):
+                if name is not None:
+                    yield (name, length, md5.hexdigest())
+                name = line[1:].split()[0]
+                length = 0
+                md5 = hashlib.md5()
+                continue
+            sequence = line.strip()
+            length += len(sequence)
+            md5.update(sequence.upper())
+    if name is not None:
+        yield (name, length, md5.hexdigest())
+
+def write_sequence_dictionary(fasta_file, dict_file, uri=None):
+    ''' Description: Write the SAM sequence dictionary of an uncompressed
+    FASTA file, like Picard CreateSequenceDictionary.
+    '''
+
+    with open(dict_file, 'w') as DICT:
+        DICT.write('@HD\tVN:1.4\tSO:unsorted\n')
+        for name, length, md5 in iter_fasta_sequences(fasta_file):
+            fields = ['@SQ', 'SN:%s' % name, 'LN:%d' % length, 'M5:%s' % md5]
+            if uri:
+                fields.append('UR:%s' % uri)
+            DICT.write('\t'.join(fields) + '\n')
@@ -19,6 +19,10 @@ import re
 import sys
 import dxpy
 
+sys.path.append('/home/dnanexus')
+import reference_bundle
+import run_metadata_index
+
 class FlowcellLane:
 
     def __init__(self, record_link, fastqs=None):
@@ -98,20 +102,24 @@ class FlowcellLane:
         
         return(self.samples_dicts)
 
-def group_files_by_barcode(fastq_files):
+def group_files_by_barcode(fastq_files, fastq_index=None):
     """
     Group FASTQ files by sample according to their SampleID and Index
     properties. Returns a dict mapping (SampleID, Index) tuples to lists of
-    files.
+    files. Properties are taken from 'fastq_index' (see run_metadata_index.load_run_metadata()) 
+    when a file is listed there.
     Note - since I have casava outputting each barcode read in a single file, the value of each group should be a single file for single-end sequencing,
      or two files for PE sequencing.
     """
+
+    if fastq_index is None:
+        fastq_index = {}
     
     print("Grouping Fastq files by barcode")
     sample_dict = {}
 
     for fastq_file in fastq_files:
-        props = fastq_file.get_properties()
+        props = fastq_index.get(fastq_file.get_id()) or fastq_file.get_properties()
         barcode =  props["barcode"] #will be NoIndex if non-multiplex (see bcl2fatq UG sectino "FASTQ Files")
         if barcode not in sample_dict:
             sample_dict[barcode] = []
@@ -120,30 +128,36 @@ def group_files_by_barcode(fastq_files):
     print(sample_dict)
     return sample_dict
 
-def group_files_by_read(fastq_files):
+def group_files_by_read(fastq_files, fastq_index=None):
     """
     Function : Groups a list of FASTQ files by the values of their Read property that indicates the read number.
                        Returns a dict mapping each observed value of the property (or 'none' if a file does not have a value
                          for the property) to a list of the files with that value. Within each group, the files are sorted by their
                        value of the Chunk property (to ensure that left and right reads of a given chunk are handled together.
     Args     : fastq_files - a list of dxpy.DXFile objects representing FASTQ files.
+               fastq_index - dict of file properties by file ID (see run_metadata_index.load_run_metadata())
     Returns  : dict.
     """
 
+    if fastq_index is None:
+        fastq_index = {}
+
     print("Grouping Fastq files by read number")
     read_dict = {}
+    chunks = {}
 
     for fastq_file in fastq_files:
-        props = fastq_file.get_properties()
+        props = fastq_index.get(fastq_file.get_id()) or fastq_file.get_properties()
         read_num = props["read"]
+        chunks[fastq_file.get_id()] = int(props.get("chunk", 1))
         if read_num not in ["1", "2", "none"]:
             raise dxpy.AppError("%s has invalid Read property: %s" % (fastq_file.get_id(), read_num))
         if read_num not in read_dict:
             read_dict[read_num] = []
         read_dict[read_num].append(fastq_file)
 
-    #for read_num in read_dict:
-    #    read_dict[read_num] = sorted(read_dict[read_num], key=chunk_property)
+    for read_num in read_dict:
+        read_dict[read_num] = sorted(read_dict[read_num], key=lambda fastq_file: chunks[fastq_file.get_id()])
 
     return read_dict
 
@@ -188,7 +202,8 @@ class MapperApp:
 @dxpy.entry_point("run_map_sample")
 def run_map_sample(project_id, output_folder, fastq_files, genome_fasta_file, 
     genome_index_file, mapper, applet_id, applet_project, 
-    fastq_files2=None, mark_duplicates=False, sample_name=None, properties=None):
+    fastq_files2=None, mark_duplicates=False, sample_name=None, properties=None,
+    reference_bundle_file=None, scatter_chunk_mb=0):
 
     mapper_applet = dxpy.DXApplet(dxid=applet_id, project=applet_project)
 
@@ -206,6 +221,10 @@ def run_map_sample(project_id, output_folder, fastq_files, genome_fasta_file,
                    }
     if fastq_files2:
         mapper_input['fastq_files2'] = fastq_files2
+    if reference_bundle_file:
+        mapper_input['reference_bundle_file'] = reference_bundle_file
+    if scatter_chunk_mb:
+        mapper_input['scatter_chunk_mb'] = scatter_chunk_mb
     map_sample_job = mapper_applet.run(mapper_input)
     mapper_output = {
         "bam": {"job": map_sample_job.get_id(), "field": "bam"},
@@ -266,7 +285,8 @@ def test_mapping():
         })
 
 @dxpy.entry_point("main")
-def main(record_link, worker_id, worker_project, fastqs, output_folder, mark_duplicates=False):
+def main(record_link, worker_id, worker_project, fastqs, output_folder, mark_duplicates=False, 
+         run_metadata=None, scatter_chunk_mb=0):
 
     output = {
               "bams": [],
@@ -277,17 +297,42 @@ def main(record_link, worker_id, worker_project, fastqs, output_folder, mark_dup
     lane = FlowcellLane(record_link=record_link, fastqs=fastqs)
     
     fastq_files = [dxpy.DXFile(item) for item in fastqs]
-    sample_dict = group_files_by_barcode(fastq_files)
+    fastq_index = run_metadata_index.load_run_metadata(run_metadata)
+    sample_dict = group_files_by_barcode(fastq_files, fastq_index)
+
+    # Prepare the reference bundle once, before the samples are mapped, so
+    # that map_sample jobs do not each build it
+    reference_bundle_file = reference_bundle.find_reference_bundle(lane.reference_genome_dxid, 
+                                                                   lane.reference_index_dxid, 
+                                                                   lane.project_id)
+    if reference_bundle_file:
+        print 'Found reference bundle %s' % reference_bundle_file['$dnanexus_link']['id']
+    else:
+        print 'Preparing reference bundle'
+        mapper_applet = dxpy.DXApplet(dxid=worker_id, project=worker_project)
+        prepare_job = mapper_applet.run({
+                                         "project_id": lane.project_id,
+                                         "output_folder": output_folder,
+                                         "fastq_files": [],
+                                         "genome_fasta_file": dxpy.dxlink(lane.reference_genome_dxid),
+                                         "genome_index_file": dxpy.dxlink(lane.reference_index_dxid),
+                                         "mapper": lane.mapper,
+                                         "prepare_reference_only": True
+                                        })
+        reference_bundle_file = {"job": prepare_job.get_id(), "field": "reference_bundle"}
 
     for barcode in sample_dict:
         print 'Processing sample: %s' % barcode
-        read_dict = group_files_by_read(sample_dict[barcode])
+        read_dict = group_files_by_read(sample_dict[barcode], fastq_index)
 
         fastq_files2 = None
 
         if "1" in read_dict and "2" in read_dict:
             # Sample is paired; there should be no files without a 'read'
             # property of "1" or "2"
+            if len(read_dict["1"]) != len(read_dict["2"]):
+                raise dxpy.AppError("Sample %s has %d read 1 chunks but %d read 2 chunks" % (
+                                    barcode, len(read_dict["1"]), len(read_dict["2"])))
             fastq_files = [dxpy.dxlink(item) for item in read_dict["1"]]
             fastq_files2 = [dxpy.dxlink(item) for item in read_dict["2"]]
         else:
@@ -322,7 +367,9 @@ def main(record_link, worker_id, worker_project, fastqs, output_folder, mark_dup
                                                   "mark_duplicates": mark_duplicates,
                                                   "applet_id": worker_id,
                                                   "applet_project": worker_project,
-                                                  "properties": mapped_files_properties
+                                                  "properties": mapped_files_properties,
+                                                  "reference_bundle_file": reference_bundle_file,
+                                                  "scatter_chunk_mb": scatter_chunk_mb
                                                  }, 
                                         fn_name="run_map_sample"
                                        ) 
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+
+"""
+Reads the run metadata index that bcl2fastq uploads for a lane (see
+bcl2fastq run_metadata.create_run_index), so that controllers can group
+fastq files by barcode and read without describing each file.
+
+This module is shared by bwa_controller, qc_controller and
+generate_qc_report.
+"""
+
+import json
+
+import dxpy
+
+# Supported version of the run metadata index written by bcl2fastq
+RUN_METADATA_VERSION = 2
+
+def load_run_metadata(run_metadata):
+    ''' Description: Returns the fastq files listed in the run metadata index
+    written by bcl2fastq as a dict; key = fastq dxid, value = dict with the
+    'barcode', 'read' and 'chunk' properties of the file. Returns an empty
+    dict if no index is given or its version is not supported, in which case
+    file properties are used.
+    '''
+
+    if not run_metadata:
+        return {}
+    run_metadata_file = dxpy.DXFile(run_metadata)
+    run_metadata_stream = dxpy.open_dxfile(dxid=run_metadata_file.get_id(), project=run_metadata_file.get_proj_id())
+    run_index = json.loads(run_metadata_stream.read())
+    if run_index.get('version') != RUN_METADATA_VERSION:
+        print 'Warning: Ignoring run metadata index version %s' % run_index.get('version')
+        return {}
+
+    fastq_index = {}
+    for barcode, sample in run_index['samples'].items():
+        for read, fastq_dxids in sample['fastqs'].items():
+            for chunk, fastq_dxid in enumerate(fastq_dxids):
+                fastq_index[fastq_dxid] = {'barcode': barcode, 'read': read, 'chunk': str(chunk + 1)}
+    print 'Loaded %d fastq files from run metadata index' % len(fastq_index)
+    return fastq_index
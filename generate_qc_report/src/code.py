@@ -9,6 +9,9 @@ import textwrap
 import collections
 import os
 
+sys.path.append('/home/dnanexus')
+import run_metadata_index
+
 MISMATCH_PER_CYCLE_STATS_FN = 'mismatch_per_cycle.stats'
 RUN_DETAILS_JSON_FN = 'run_details.json'
 SAMPLE_STATS_JSON_FN = 'sample_stats.json'
@@ -143,21 +146,25 @@ def create_tools_used_file(tools_used):
             fh.write('\n')
     return TOOLS_USED_TXT_FN
 
-def group_files_by_barcode(barcoded_files):
+def group_files_by_barcode(barcoded_files, fastq_index=None):
     """
     Group FASTQ files by sample according to their SampleID and Index
     properties. Returns a dict mapping (SampleID, Index) tuples to lists of
-    files.
+    files. Properties are taken from 'fastq_index' (see run_metadata_index.load_run_metadata()) 
+    when a file is listed there.
     Note - since I have casava outputting each barcode read in a single file, the value of each group should be a single file for single-end sequencing,
      or two files for PE sequencing.
     """
+
+    if fastq_index is None:
+        fastq_index = {}
     
     print("Grouping files by barcode")
     dxfiles = [dxpy.DXFile(item) for item in barcoded_files]
     sample_dict = {}
 
     for dxfile in dxfiles:
-        props = dxfile.get_properties()
+        props = fastq_index.get(dxfile.get_id()) or dxfile.get_properties()
         barcode =  props["barcode"] #will be NoIndex if non-multiplex (see bcl2fatq UG sectino "FASTQ Files")
         if barcode not in sample_dict:
             sample_dict[barcode] = []
@@ -169,7 +176,7 @@ def group_files_by_barcode(barcoded_files):
 
 @dxpy.entry_point("main")
 def main(record_link, output_folder, qc_stats_jsons, tools_used, fastqs, interop_tar, 
-         mismatch_metrics=[], paired_end=True, mark_duplicates=False):
+         mismatch_metrics=[], paired_end=True, mark_duplicates=False, run_metadata=None):
 
     lane = FlowcellLane(record_link=record_link)
     
@@ -193,7 +200,11 @@ def main(record_link, output_folder, qc_stats_jsons, tools_used, fastqs, interop
     
     interop_file = download_file(interop_tar)
     tools_used_fn = create_tools_used_file(tools_used)
-    sample_dict = group_files_by_barcode(fastqs)
+    fastq_index = run_metadata_index.load_run_metadata(run_metadata)
+    sample_dict = group_files_by_barcode(fastqs, fastq_index)
+    if fastq_index:
+        # Paired-end status of the fastq files, rather than of the input default
+        paired_end = any([fastq['read'] == '2' for fastq in fastq_index.values()])
     
     barcodes = sample_dict.keys()
 
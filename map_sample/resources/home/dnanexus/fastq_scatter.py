@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+
+"""
+Splits the FASTQ files of a sample into chunks of reads, so that a large
+sample is mapped by several subjobs instead of a single one.
+
+Files are re-chunked as they stream: each file is decompressed as it
+downloads and cut every N reads by split (see fastq_split), which
+compresses each chunk as it is written. The read 1 and read 2 files of a
+pair are cut at the same read counts, so chunk i of read 1 and chunk i of
+read 2 hold the same clusters, in the same order.
+
+The number of reads per chunk is chosen from the size of the read 1 file,
+for chunks of about 'chunk_size' compressed bytes. The read count of the
+file is taken from the 'read_count' property bcl2fastq sets on the fastq
+files it uploads, or estimated from the file size.
+"""
+
+import math
+import subprocess
+
+# Compressed bytes per read assumed for files without a read_count property
+ESTIMATED_READ_BYTES = 70
+
+def plan_chunks(file_size, read_count, chunk_size):
+    ''' Description: Returns the number of reads per chunk splitting a FASTQ
+    file of 'file_size' bytes and 'read_count' reads (None if unknown) into
+    chunks of at most about 'chunk_size' bytes, or None if the file fits in
+    a single chunk.
+    '''
+
+    chunks = int(math.ceil(float(file_size) / chunk_size))
+    if chunks <= 1:
+        return None
+    if not read_count:
+        read_count = file_size // ESTIMATED_READ_BYTES
+    return int(math.ceil(float(read_count) / chunks))
+
+def count_reads(chunk_file):
+    output = subprocess.check_output("pigz -dc %s | wc -l" % chunk_file, shell=True)
+    return int(output) // 4
+
+def check_pairs(read_chunks):
+    ''' Description: Raises a RuntimeError unless the chunk lists of the
+    read 1 and read 2 files of a pair hold the same reads. Chunks are cut at
+    the same read counts, so a truncated or mismatched mate file gives a
+    different number of chunks or a different number of reads in the last
+    chunk.
+    '''
+
+    if len(read_chunks) < 2:
+        return
+    chunk_counts = [len(chunks) for chunks in read_chunks]
+    if len(set(chunk_counts)) > 1:
+        raise RuntimeError('Read 1 and read 2 were split into %d and %d chunks' % tuple(chunk_counts))
+    if not chunk_counts[0]:
+        return
+    last_reads = [count_reads(chunks[-1]) for chunks in read_chunks]
+    if len(set(last_reads)) > 1:
+        raise RuntimeError('Last read 1 and read 2 chunks have %d and %d reads' % tuple(last_reads))
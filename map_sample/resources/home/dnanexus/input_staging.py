@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+"""
+Stages the inputs of a mapping job concurrently.
+
+Each input is transferred by its own thread with a shell command reading the
+file with 'dx cat', so archives are extracted and FASTA files decompressed
+as they download instead of after. FASTQ files can be streamed through named
+pipes (FIFOs), so that a mapper reading them starts as soon as the reference
+is ready rather than after the FASTQ files have downloaded.
+
+The transfer rate of each input is logged when it completes, and summarized
+by report_rates().
+"""
+
+import os
+import sys
+import time
+import threading
+
+import dxpy
+import subprocess_supervisor
+
+class StagedInput(threading.Thread):
+
+    def __init__(self, name, dxid, command, fifo=None):
+        ''' Description: Transfer a DNAnexus file in a background thread.
+
+        Input:
+        name (str): Name of the input in log messages
+        dxid (str/dxlink): File to transfer
+        command (str): Shell command reading the file from standard input,
+                       i.e. 'tar xf -' or 'cat > sample.fastq.gz'
+        fifo (str): Named pipe created before the transfer starts. The
+                    transfer blocks until a reader opens it.
+        '''
+
+        threading.Thread.__init__(self)
+        # Streamed inputs block until read; do not hold up exit on failure
+        self.daemon = True
+        self.name = name
+        self.dxfile = dxpy.DXFile(dxid)
+        self.command = 'dx cat %s | %s' % (self.dxfile.get_id(), command)
+        self.fifo = fifo
+        self.size = self.dxfile.describe(fields={'size': True})['size']
+        self.seconds = None
+        self.error = None
+        if fifo:
+            if os.path.exists(fifo):
+                os.remove(fifo)
+            os.mkfifo(fifo)
+
+    def run(self):
+        start_time = time.time()
+        try:
+            subprocess_supervisor.run(self.command, pipefail=True, echo=False)
+        except Exception:
+            self.error = sys.exc_info()
+            return
+        self.seconds = max(time.time() - start_time, 1e-6)
+        print 'Staged %s (%.1f MB) in %.1f s: %.1f MB/s%s' % (self.name,
+                                                            self.size / 1e6,
+                                                            self.seconds,
+                                                            self.size / 1e6 / self.seconds,
+                                                            ' (streamed)' if self.fifo else '')
+
+    def wait(self):
+        ''' Description: Wait for the transfer to finish, raising its error
+        if it failed.
+        '''
+
+        self.join()
+        if self.error:
+            raise self.error[0], self.error[1], self.error[2]
+
+def start(staged_inputs):
+    for staged_input in staged_inputs:
+        staged_input.start()
+    return staged_inputs
+
+def wait(staged_inputs):
+    for staged_input in staged_inputs:
+        staged_input.wait()
+
+def report_rates(staged_inputs):
+    ''' Description: Print the transfer rate of each staged input and the
+    combined rate over the wall time of the transfers.
+    '''
+
+    completed = [staged_input for staged_input in staged_inputs if staged_input.seconds]
+    if not completed:
+        return
+    for staged_input in completed:
+        print '%s\t%.1f MB\t%.1f s\t%.1f MB/s' % (staged_input.name,
+                                                staged_input.size / 1e6,
+                                                staged_input.seconds,
+                                                staged_input.size / 1e6 / staged_input.seconds)
+    total_size = sum([staged_input.size for staged_input in completed])
+    wall_seconds = max([staged_input.seconds for staged_input in completed])
+    print 'Staged %d inputs (%.1f MB) in %.1f s: %.1f MB/s combined' % (len(completed),
+                                                                       total_size / 1e6,
+                                                                       wall_seconds,
+                                                                       total_size / 1e6 / wall_seconds)
@@ -0,0 +1,29 @@
+#!/usr/bin/env python
+
+"""
+Builds the shell pipeline that turns the SAM output of a mapper into a
+cleaned, coordinate-sorted BAM file with MD/NM tags, without writing the
+intermediate SAM or BAM files to disk.
+
+Picard CleanSam 1.107 picks its output format from the output file name and
+only writes SAM to files named *.sam, so it writes BAM to /dev/stdout. The
+BAM is uncompressed (COMPRESSION_LEVEL=0) since samtools sort reads it
+right away.
+"""
+
+CLEAN_SAM_JAR = '/CleanSam.jar'
+
+def get_pipeline_command(map_cmd, threads, reference='genome.fa', output='sample.bam',
+                         sort_prefix='sample.sorting', clean_sam_jar=CLEAN_SAM_JAR):
+    ''' Description: Returns the shell command piping the SAM output of
+    'map_cmd' through CleanSam, samtools sort with 'threads' threads (spill
+    files are named <sort_prefix>.*) and samtools calmd against 'reference'
+    into 'output'. Run it with pipefail, so that it fails if any of its
+    commands fails.
+    '''
+
+    cmd = map_cmd
+    cmd += " | java -jar %s INPUT=/dev/stdin OUTPUT=/dev/stdout COMPRESSION_LEVEL=0 QUIET=true" % clean_sam_jar
+    cmd += " | samtools sort -o -@ %d - %s" % (threads, sort_prefix)
+    cmd += " | samtools calmd -b - %s > %s" % (reference, output)
+    return cmd
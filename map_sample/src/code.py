@@ -5,67 +5,146 @@ Maps FASTQ files to a genome using BWA.
 """
 
 import os.path
+import sys
 import subprocess
 import json
 import dxpy
 from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+sys.path.append('/home/dnanexus')
+import subprocess_supervisor
+import reference_bundle
+import input_staging
+import mapping_pipeline
+import fastq_scatter
+import fastq_split
 
 SUPPORTED_MAPPERS = ["bwa", "bwa_aln", "bwa_mem"]
 
-def run_cmd(cmd, logger, shell=True):
+# BAM files merged by a single job; larger merges run as a tree of subjobs
+MERGE_FAN_IN = 32
+# Intermediate BAM files of a merge tree are only read once
+MERGE_TREE_COMPRESSION_LEVEL = 1
+MERGE_DOWNLOAD_THREADS = 8
+
+def run_cmd(cmd, logger, shell=True, pipefail=False):
     if shell:
         save_cmd = cmd
     else:
         save_cmd = subprocess.list2cmdline(cmd)
     logger.append(save_cmd)
     print save_cmd
-    subprocess.check_call(cmd, shell=shell)
+    return subprocess_supervisor.run(cmd, shell=shell, pipefail=pipefail)
 
 def get_app_title():
     cmd = "dx describe `dx describe ${DX_JOB_ID} --json | jq -r '.applet'` --json | jq -r '.title'"
     title = subprocess.check_output(cmd, shell=True).strip()
     return title
 
+def download_file(args):
+    dxfile, filename = args
+    dxpy.download_dxfile(dxpy.DXFile(dxfile).get_id(), filename)
+
+def download_bams(bam_files):
+    """Downloads BAM files concurrently to bam_files-0, bam_files-1, ...
+    Returns the local file names, in the order of 'bam_files'."""
+
+    filenames = ["bam_files-" + str(i) for i in xrange(len(bam_files))]
+    pool = ThreadPool(processes = min(MERGE_DOWNLOAD_THREADS, len(bam_files)))
+    try:
+        pool.map(download_file, zip(bam_files, filenames))
+    finally:
+        pool.close()
+        pool.join()
+    return filenames
+
+def merge_bams(bam_files, logger, compression_level=None):
+    """Downloads BAM files and merges them into sample.bam with a samtools
+    merge thread per core."""
+
+    filenames = download_bams(bam_files)
+    cmd_array = ["samtools", "merge", "-f", "-@", str(cpu_count())]
+    if compression_level != None:
+        cmd_array += ["-l", str(compression_level)]
+    cmd_array += ["sample.bam"] + filenames
+    run_cmd(cmd_array, logger, shell=False)
+    # Free the disk for the next merge level or the index
+    for filename in filenames:
+        os.remove(filename)
+
+def upload_file(args):
+    filename, name, properties, project, folder = args
+    return dxpy.upload_local_file(filename = filename, 
+                                  name = name, 
+                                  properties = properties,
+                                  project = project,
+                                  folder = folder,
+                                  parents = True
+                                 )
+
+@dxpy.entry_point("merge_level")
+def merge_level(bam_files):
+    """Merges a group of BAM files into an intermediate BAM file in the
+    job workspace, for the next level of a postprocess merge tree."""
+
+    logger = []
+    merge_bams(bam_files, logger, compression_level=MERGE_TREE_COMPRESSION_LEVEL)
+    bam_file = dxpy.upload_local_file(filename = "sample.bam", 
+                                      project = dxpy.WORKSPACE_ID, 
+                                      wait_on_close = True)
+    return {"bam": dxpy.dxlink(bam_file), "tools_used": logger}
+
 @dxpy.entry_point("postprocess")
-def postprocess(project_id, output_folder, bam_files, sample_name=None, properties=None):
+def postprocess(project_id, output_folder, bam_files, sample_name=None, properties=None, tools_used=None):
     """Downloads the BAM files produced by mapping each of the input FASTQ
-    files. Merge them into a single BAM file."""
-
+    files. Merge them into a single BAM file. With more than MERGE_FAN_IN
+    BAM files, groups of them are first merged by merge_level subjobs and
+    a new postprocess subjob merges their output."""
 
     logger = []
+    for tools in (tools_used or []):
+        logger += tools
     bams_subfolder = output_folder + '/bams'
-    properties['file_type'] = None
-
-    bam_files = [dxpy.DXFile(f) for f in bam_files]
-    for i, bam_file in enumerate(bam_files):
-        dxpy.download_dxfile(bam_file.get_id(), "bam_files-" + str(i))
-
-    cmd_array = ["samtools", "merge", "sample.bam"]
-    for i in xrange(len(bam_files)):
-        cmd_array.append("bam_files-" + str(i))
-
-    run_cmd(cmd_array, logger, shell=False)
 
-    index_cmd = 'samtools index sample.bam'
-    run_cmd(index_cmd, logger)
+    if len(bam_files) > MERGE_FAN_IN:
+        level_jobs = []
+        for i in xrange(0, len(bam_files), MERGE_FAN_IN):
+            level_jobs.append(dxpy.new_dxjob({"bam_files": bam_files[i:i + MERGE_FAN_IN]}, "merge_level"))
+        postprocess_input = { 
+                             "project_id": project_id,
+                             "output_folder": output_folder,
+                             "bam_files": [job.get_output_ref("bam") for job in level_jobs],
+                             "sample_name": sample_name, 
+                             "properties": properties,
+                             "tools_used": [logger] + [job.get_output_ref("tools_used") for job in level_jobs]
+                            }
+        postprocess_job = dxpy.new_dxjob(postprocess_input, "postprocess")
+        return {
+                "bam": postprocess_job.get_output_ref("bam"),
+                "bai": postprocess_job.get_output_ref("bai"),
+                "tools_used": postprocess_job.get_output_ref("tools_used")
+               }
 
-    properties['file_type'] = 'bam'
-    merged_bam_file = dxpy.upload_local_file(filename = "sample.bam", 
-                                             name = sample_name + ".bam", 
-                                             properties = properties,
-                                             project = project_id,
-                                             folder = bams_subfolder,
-                                             parents = True
-                                            )
-
-    properties['file_type'] = 'bai'
-    merged_bai_file = dxpy.upload_local_file(filename = "sample.bam.bai", 
-                                             name = sample_name + ".bai", 
-                                             properties = properties,
-                                             project = project_id,
-                                             folder = bams_subfolder,
-                                             parents = True
-                                            )
+    merge_bams(bam_files, logger)
+
+    # The BAM uploads while it is indexed, and with the index; samtools 
+    # 0.1.19 cannot build the index while merging
+    bam_properties = dict(properties or {}, file_type = 'bam')
+    bai_properties = dict(properties or {}, file_type = 'bai')
+    pool = ThreadPool(processes = 2)
+    try:
+        bam_upload = pool.apply_async(upload_file, [("sample.bam", sample_name + ".bam", bam_properties, 
+                                                     project_id, bams_subfolder)])
+        index_cmd = 'samtools index sample.bam'
+        run_cmd(index_cmd, logger)
+        bai_upload = pool.apply_async(upload_file, [("sample.bam.bai", sample_name + ".bai", bai_properties, 
+                                                     project_id, bams_subfolder)])
+        merged_bam_file = bam_upload.get()
+        merged_bai_file = bai_upload.get()
+    finally:
+        pool.close()
+        pool.join()
 
     return {
             "bam": dxpy.dxlink(merged_bam_file),
@@ -84,118 +163,117 @@ def remove_ext(filename):
         return remove_ext(split[0])
 
 
-def run_bwa_mem_single(fastq_file, genome_fasta_file, genome_index_file, mark_duplicates, logger):
-    """Runs BWA-MEM on a single FASTQ file."""
+def stage_reference(genome_fasta_file, genome_index_file, bundle_file=None):
+    """Starts staging the reference in background threads: the prepared
+    reference bundle, or the genome FASTA, decompressed for samtools calmd
+    as it downloads, and the BWA index, extracted as it downloads (its file
+    names are listed in genome_index_files.txt). Returns the list of
+    StagedInput threads."""
+
+    if bundle_file is not None:
+        return input_staging.start([input_staging.StagedInput("reference_bundle", bundle_file, "tar xf -")])
+    return input_staging.start([
+                                input_staging.StagedInput("genome_fasta", genome_fasta_file, 
+                                                          "gunzip -c > genome.fa"),
+                                input_staging.StagedInput("genome_index", genome_index_file, 
+                                                          "tar xzvf - > genome_index_files.txt")
+                               ])
+
+def download_reference(genome_fasta_file, genome_index_file):
+    """Downloads the genome FASTA and BWA index concurrently, extracting the
+    index and decompressing the FASTA for samtools calmd."""
+
+    reference_inputs = stage_reference(genome_fasta_file, genome_index_file)
+    input_staging.wait(reference_inputs)
+    input_staging.report_rates(reference_inputs)
+
+def stage_fastqs(fastq_files, stream):
+    """Starts staging FASTQ files to sample.fastq.gz and sample_2.fastq.gz
+    in background threads. If 'stream', the files are named pipes the
+    mapper reads from while they download. Returns the list of StagedInput
+    threads."""
+
+    filenames = ["sample.fastq.gz", "sample_2.fastq.gz"]
+    fastq_inputs = []
+    for fastq_file, filename in zip(fastq_files, filenames):
+        fifo = filename if stream else None
+        fastq_inputs.append(input_staging.StagedInput(filename, fastq_file, "cat > " + filename, fifo=fifo))
+    return input_staging.start(fastq_inputs)
+
+def run_mapping_pipeline(map_cmd, logger):
+    """Pipes the SAM output of a mapping command into CleanSam, which
+    writes uncompressed BAM to samtools sort, and the sorted BAM through
+    samtools calmd into a single coordinate-sorted BAM file, sample.bam.
+    Only the sort spill files (sample.sorting.*) are written to disk besides
+    sample.bam. The pipeline fails if any of its commands fails."""
+
+    cmd = mapping_pipeline.get_pipeline_command(map_cmd, cpu_count())
+    run_cmd(cmd, logger, pipefail=True)
+
+def run_mark_duplicates(logger):
+    run_cmd("java -jar /MarkDuplicates.jar " +
+            "INPUT=sample.bam OUTPUT=sample_deduped.bam METRICS_FILE=/dev/null", logger)
+    subprocess_supervisor.run("mv sample_deduped.bam sample.bam")
+
+def run_bwa_mem_single(fastq_inputs, mark_duplicates, logger):
+    """Runs BWA-MEM on a single FASTQ file, streamed as it downloads."""
 
-    fastq_file = dxpy.DXFile(fastq_file)
-    genome_fasta_file = dxpy.DXFile(genome_fasta_file)
-    genome_index_file = dxpy.DXFile(genome_index_file)
-
-    dxpy.download_dxfile(fastq_file.get_id(), "sample.fastq.gz")
-    dxpy.download_dxfile(genome_fasta_file.get_id(), "genome.fa.gz")
-    dxpy.download_dxfile(genome_index_file.get_id(), "genome.tar.gz")
-
-    subprocess.check_call("tar xzvf genome.tar.gz", shell=True)
     num_cores = str(cpu_count())
 
-    run_cmd("bwa-0.7.7 mem -t " + num_cores + " genome.fa.gz sample.fastq.gz > sample0.sam", logger)
-    run_cmd("java -jar /CleanSam.jar INPUT=sample0.sam OUTPUT=sample1.bam", logger)
-    run_cmd("samtools sort -@ " + num_cores + " sample1.bam sample", logger)
+    run_mapping_pipeline("bwa-0.7.7 mem -t " + num_cores + " genome.fa.gz sample.fastq.gz", logger)
+    # A failed transfer only looks like a short file to the mapper
+    input_staging.wait(fastq_inputs)
 
     if mark_duplicates:
-        run_cmd("java -jar /MarkDuplicates.jar " +
-                "INPUT=sample.bam OUTPUT=sample_deduped.bam METRICS_FILE=/dev/null", logger)
-        subprocess.check_call("mv sample_deduped.bam sample.bam", shell=True)
-
-def run_bwa_mem_paired(fastq_file, fastq_file2, genome_fasta_file, genome_index_file, mark_duplicates, logger):
-    """Runs BWA-MEM on a pair of FASTQ files."""
+        run_mark_duplicates(logger)
 
-    fastq_file = dxpy.DXFile(fastq_file)
-    fastq_file2 = dxpy.DXFile(fastq_file2)
-    genome_fasta_file = dxpy.DXFile(genome_fasta_file)
-    genome_index_file = dxpy.DXFile(genome_index_file)
+def run_bwa_mem_paired(fastq_inputs, mark_duplicates, logger):
+    """Runs BWA-MEM on a pair of FASTQ files, streamed as they download."""
 
-    dxpy.download_dxfile(fastq_file.get_id(), "sample.fastq.gz")
-    dxpy.download_dxfile(fastq_file2.get_id(), "sample_2.fastq.gz")
-    dxpy.download_dxfile(genome_fasta_file.get_id(), "genome.fa.gz")
-    dxpy.download_dxfile(genome_index_file.get_id(), "genome.tar.gz")
-
-    subprocess.check_call("tar xzvf genome.tar.gz", shell=True)
     num_cores = str(cpu_count())
 
-    run_cmd("bwa-0.7.7 mem -t " + num_cores + " genome.fa.gz sample.fastq.gz sample_2.fastq.gz > sample0.sam", logger)
-    run_cmd("java -jar /CleanSam.jar INPUT=sample0.sam OUTPUT=sample1.bam", logger)
-    run_cmd("samtools sort -@ " + num_cores + " sample1.bam sample", logger)
+    run_mapping_pipeline("bwa-0.7.7 mem -t " + num_cores + " genome.fa.gz sample.fastq.gz sample_2.fastq.gz", 
+                         logger)
+    # A failed transfer only looks like a short file to the mapper
+    input_staging.wait(fastq_inputs)
 
     if mark_duplicates:
-        run_cmd("java -jar /MarkDuplicates.jar " +
-                "INPUT=sample.bam OUTPUT=sample_deduped.bam METRICS_FILE=/dev/null", logger)
-        subprocess.check_call("mv sample_deduped.bam sample.bam", shell=True)
+        run_mark_duplicates(logger)
 
-def run_bwa_backtrack_single(fastq_file, genome_fasta_file, genome_index_file, mark_duplicates, logger):
+def run_bwa_backtrack_single(fastq_inputs, mark_duplicates, logger):
     """Runs BWA-backtrack on a single FASTQ file."""
 
-    fastq_file = dxpy.DXFile(fastq_file)
-    genome_fasta_file = dxpy.DXFile(genome_fasta_file)
-    genome_index_file = dxpy.DXFile(genome_index_file)
-
-    dxpy.download_dxfile(fastq_file.get_id(), "sample.fastq.gz")
-    dxpy.download_dxfile(genome_fasta_file.get_id(), "genome.fa.gz")
-    dxpy.download_dxfile(genome_index_file.get_id(), "genome.tar.gz")
-
-    subprocess.check_call("tar xzvf genome.tar.gz", shell=True)
     num_cores = str(cpu_count())
 
+    fastq_inputs[0].wait()
     run_cmd("bwa-0.6.2 aln -t " + num_cores + " genome.fa.gz sample.fastq.gz > sample.sai", logger)
-    run_cmd("bwa-0.6.2 samse genome.fa.gz sample.sai sample.fastq.gz > sample0.sam", logger)
-    run_cmd("java -jar /CleanSam.jar INPUT=sample0.sam OUTPUT=sample1.bam", logger)
-    run_cmd("samtools sort -@ " + num_cores + " sample1.bam sample", logger)
+    run_mapping_pipeline("bwa-0.6.2 samse genome.fa.gz sample.sai sample.fastq.gz", logger)
 
     if mark_duplicates:
-        run_cmd("java -jar /MarkDuplicates.jar " +
-                "INPUT=sample.bam OUTPUT=sample_deduped.bam METRICS_FILE=/dev/null", logger)
-        subprocess.check_call("mv sample_deduped.bam sample.bam", shell=True)
+        run_mark_duplicates(logger)
 
-def run_bwa_backtrack_paired(fastq_file, fastq_file2, genome_fasta_file, genome_index_file, mark_duplicates, logger):
-    """Runs BWA-backtrack on a pair of FASTQ files."""
+def run_bwa_backtrack_paired(fastq_inputs, mark_duplicates, logger):
+    """Runs BWA-backtrack on a pair of FASTQ files. Read 1 is aligned while
+    read 2 is still downloading."""
 
-    fastq_file = dxpy.DXFile(fastq_file)
-    fastq_file2 = dxpy.DXFile(fastq_file2)
-    genome_fasta_file = dxpy.DXFile(genome_fasta_file)
-    genome_index_file = dxpy.DXFile(genome_index_file)
-
-    dxpy.download_dxfile(fastq_file.get_id(), "sample.fastq.gz")
-    dxpy.download_dxfile(fastq_file2.get_id(), "sample_2.fastq.gz")
-    dxpy.download_dxfile(genome_fasta_file.get_id(), "genome.fa.gz")
-    dxpy.download_dxfile(genome_index_file.get_id(), "genome.tar.gz")
-
-    subprocess.check_call("tar xzvf genome.tar.gz", shell=True)
     num_cores = str(cpu_count())
 
+    fastq_inputs[0].wait()
     run_cmd("bwa-0.6.2 aln -t " + num_cores + " genome.fa.gz sample.fastq.gz > sample.sai", logger)
+    fastq_inputs[1].wait()
     run_cmd("bwa-0.6.2 aln -t " + num_cores + " genome.fa.gz sample_2.fastq.gz > sample_2.sai", logger)
-    run_cmd("bwa-0.6.2 sampe -P genome.fa.gz sample.sai sample_2.sai sample.fastq.gz sample_2.fastq.gz" +
-            " > sample0.sam", logger)
-    run_cmd("java -jar /CleanSam.jar INPUT=sample0.sam OUTPUT=sample1.bam", logger)
-    run_cmd("samtools sort -@ " + num_cores + " sample1.bam sample", logger)
+    run_mapping_pipeline("bwa-0.6.2 sampe -P genome.fa.gz sample.sai sample_2.sai sample.fastq.gz sample_2.fastq.gz", 
+                         logger)
 
     if mark_duplicates:
-        run_cmd("java -jar /MarkDuplicates.jar " +
-                "INPUT=sample.bam OUTPUT=sample_deduped.bam METRICS_FILE=/dev/null", logger)
-        subprocess.check_call("mv sample_deduped.bam sample.bam", shell=True)
-
-def run_samtools_calmd(logger):
-    """Runs samtools calmd on the sorted BAM file."""
-
-    subprocess.check_call("gunzip -c genome.fa.gz > genome.fa", shell=True)
-    run_cmd("samtools calmd -b sample.bam genome.fa > sample.calmd.bam", logger)
-    subprocess.check_call("mv -v sample.calmd.bam sample.bam", shell=True)
+        run_mark_duplicates(logger)
 
 @dxpy.entry_point("process")
 def process(project_id, output_folder, fastq_file, genome_fasta_file, genome_index_file, mapper, mark_duplicates, fastq_file2=None,
-            sample_name=None, properties=None):
+            sample_name=None, properties=None, reference_bundle_file=None):
     """Download a single FASTQ file, map it, and output a coordinate-sorted
-    BAM file."""
+    BAM file. The reference is taken from the prepared reference bundle if
+    one is given."""
 
     logger = []
     bams_subfolder = output_folder + '/bams'
@@ -203,20 +281,27 @@ def process(project_id, output_folder, fastq_file, genome_fasta_file, genome_ind
     if mapper not in SUPPORTED_MAPPERS:
         raise dxpy.AppError("Unsupported mapper: " + mapper)
 
+    # All inputs download concurrently. BWA-MEM reads the FASTQ files as 
+    # they download, so mapping starts once the reference is ready; 
+    # BWA-backtrack reads them twice (aln, then samse/sampe).
+    fastq_files = [fastq_file] if fastq_file2 == None else [fastq_file, fastq_file2]
+    reference_inputs = stage_reference(genome_fasta_file, genome_index_file, reference_bundle_file)
+    fastq_inputs = stage_fastqs(fastq_files, stream = (mapper == "bwa_mem"))
+    input_staging.wait(reference_inputs)
+
     if mapper == "bwa_mem":
         if fastq_file2 == None:
-            run_bwa_mem_single(fastq_file, genome_fasta_file, genome_index_file, mark_duplicates, logger)
+            run_bwa_mem_single(fastq_inputs, mark_duplicates, logger)
         else:
-            run_bwa_mem_paired(fastq_file, fastq_file2, genome_fasta_file, genome_index_file, mark_duplicates, logger)
+            run_bwa_mem_paired(fastq_inputs, mark_duplicates, logger)
     elif mapper == "bwa" or mapper == "bwa_aln":
         if fastq_file2 == None:
-            run_bwa_backtrack_single(fastq_file, genome_fasta_file, genome_index_file, mark_duplicates, logger)
+            run_bwa_backtrack_single(fastq_inputs, mark_duplicates, logger)
         else:
-            run_bwa_backtrack_paired(fastq_file, fastq_file2, genome_fasta_file, genome_index_file, mark_duplicates, logger)
+            run_bwa_backtrack_paired(fastq_inputs, mark_duplicates, logger)
     else:
         raise dxpy.AppError("Unsupported mapper: " + mapper)
-
-    run_samtools_calmd(logger)
+    input_staging.report_rates(reference_inputs + fastq_inputs)
 
     ''' From bwa_mem_fastq_read_mapper bash source:
     bwa mem -t `nproc` "$genome_file" $input $opts | samtools view -u -S - | samtools sort -m 256M -@ `nproc` - output
@@ -247,6 +332,190 @@ def process(project_id, output_folder, fastq_file, genome_fasta_file, genome_ind
             "tools_used": logger 
            }
 
+@dxpy.entry_point("prepare_reference")
+def prepare_reference(project_id, output_folder, genome_fasta_file, genome_index_file):
+    """Builds the reference bundle of a genome FASTA and BWA index: the
+    extracted index, the decompressed and faidx-indexed FASTA and a sequence
+    dictionary, in an uncompressed tar file. An existing bundle of the same
+    genome files is reused."""
+
+    logger = []
+    misc_subfolder = output_folder + '/miscellany'
+
+    bundle = reference_bundle.find_reference_bundle(genome_fasta_file, genome_index_file, project_id)
+    if bundle:
+        print "Found reference bundle " + bundle['$dnanexus_link']['id']
+        return {"reference_bundle": bundle, "tools_used": logger}
+
+    download_reference(genome_fasta_file, genome_index_file)
+    with open("genome_index_files.txt") as INDEX_FILES:
+        index_files = INDEX_FILES.read().split()
+    run_cmd("samtools faidx " + reference_bundle.BUNDLE_FASTA, logger)
+    genome_fasta_name = dxpy.DXFile(genome_fasta_file).describe()['name']
+    reference_bundle.write_sequence_dictionary(reference_bundle.BUNDLE_FASTA, reference_bundle.BUNDLE_DICT, 
+                                               uri = genome_fasta_name)
+
+    bundle_files = [reference_bundle.BUNDLE_FASTA, reference_bundle.BUNDLE_FAI, reference_bundle.BUNDLE_DICT]
+    bundle_files += [name for name in index_files if not name.endswith('/')]
+    run_cmd("tar cf reference_bundle.tar " + " ".join(bundle_files), logger)
+
+    properties = reference_bundle.get_bundle_properties(dxpy.DXFile(genome_fasta_file).get_id(), 
+                                                        dxpy.DXFile(genome_index_file).get_id())
+    bundle_file = dxpy.upload_local_file(filename = "reference_bundle.tar", 
+                                         name = remove_ext(genome_fasta_name) + "_reference_bundle.tar", 
+                                         properties = properties,
+                                         project = project_id,
+                                         folder = misc_subfolder,
+                                         parents = True
+                                        )
+    return {"reference_bundle": dxpy.dxlink(bundle_file), "tools_used": logger}
+
+def get_file_sizes(dxfiles):
+    return [dxpy.DXFile(dxfile).describe(fields={'size': True})['size'] for dxfile in dxfiles]
+
+def launch_mapping(mapping_input, fastq_files, fastq_files2, tools_used):
+    """Launches a process subjob mapping each FASTQ file (and its pair),
+    a postprocess subjob merging their BAM files if there are several, and
+    a subjob writing the tools used, after the commands in 'tools_used'
+    (lists of commands or job output references). Returns the sample 
+    output."""
+
+    subjobs = []
+    for i in xrange(len(fastq_files)):
+        subjob_input = dict(mapping_input)
+        subjob_input["fastq_file"] = fastq_files[i]
+        if fastq_files2 != None:
+            subjob_input["fastq_file2"] = fastq_files2[i]
+        subjobs.append(dxpy.new_dxjob(subjob_input, "process"))
+
+    if len(fastq_files) > 1:
+        postprocess_input = { 
+                             "project_id": mapping_input["project_id"],
+                             "output_folder": mapping_input["output_folder"],
+                             "bam_files": [subjob.get_output_ref("bam") for subjob in subjobs],
+                             "sample_name": mapping_input["sample_name"], 
+                             "properties": mapping_input["properties"] 
+                            }
+        postprocess_job = dxpy.new_dxjob(fn_input=postprocess_input, 
+                                         fn_name="postprocess", 
+                                         depends_on=subjobs
+                                        )
+        output_job = postprocess_job
+        tools_used_jobs = subjobs + [postprocess_job]
+    else:
+        output_job = subjobs[0]
+        tools_used_jobs = subjobs
+
+    tools_used_input = {
+                        "project_id": mapping_input["project_id"],
+                        "output_folder": mapping_input["output_folder"],
+                        "tools_used": tools_used + [job.get_output_ref("tools_used") for job in tools_used_jobs]
+                       }
+    tools_used_job = dxpy.new_dxjob(tools_used_input, "create_tools_used_json_file")
+    return {
+            "bam": output_job.get_output_ref("bam"),
+            "bai": output_job.get_output_ref("bai"),
+            "tools_used": tools_used_job.get_output_ref("tools_used_json_file")
+           }
+
+def upload_chunk(chunk):
+    filename, name = chunk
+    chunk_file = dxpy.upload_local_file(filename = filename,
+                                        name = name,
+                                        project = dxpy.WORKSPACE_ID,
+                                        wait_on_close = True
+                                       )
+    return dxpy.dxlink(chunk_file)
+
+def split_fastq_files(fastq_files, fastq_files2, chunk_size, logger):
+    """Splits each read 1 FASTQ file larger than 'chunk_size' bytes, and
+    its read 2 pair, into chunks of the same read counts, and uploads the
+    chunks to the job workspace. Smaller files are mapped whole. Returns
+    the lists of read 1 and read 2 (None if single-end) files to map."""
+
+    pairs = []
+    split_inputs = []
+    for i in xrange(len(fastq_files)):
+        fastq_file = dxpy.DXFile(fastq_files[i])
+        describe = fastq_file.describe(fields={'name': True, 'size': True, 'properties': True})
+        read_count = describe['properties'].get('read_count')
+        reads_per_chunk = fastq_scatter.plan_chunks(describe['size'], 
+                                                    int(read_count) if read_count else None, 
+                                                    chunk_size)
+        pair = {"files": [fastq_files[i]], "names": [describe['name']], "prefixes": None}
+        if fastq_files2 != None:
+            pair["files"].append(fastq_files2[i])
+            pair["names"].append(dxpy.DXFile(fastq_files2[i]).describe(fields={'name': True})['name'])
+        if reads_per_chunk != None:
+            print "Splitting %s into chunks of %d reads" % (" and ".join(pair["names"]), reads_per_chunk)
+            pair["prefixes"] = []
+            for j, dxfile in enumerate(pair["files"]):
+                prefix = "fastq-%d_%d_" % (i, j + 1)
+                suffix_width = fastq_split.get_suffix_width(describe['size'], reads_per_chunk)
+                command = "pigz -dc | " + fastq_split.split_command(reads_per_chunk, prefix, suffix_width)
+                split_input = input_staging.StagedInput(prefix + "split", dxfile, command)
+                logger.append(split_input.command)
+                split_inputs.append(split_input)
+                pair["prefixes"].append(prefix)
+        pairs.append(pair)
+
+    # All files of the sample are split concurrently
+    input_staging.wait(input_staging.start(split_inputs))
+    input_staging.report_rates(split_inputs)
+
+    chunks = []
+    mapped_files = [[], [] if fastq_files2 != None else None]
+    for pair in pairs:
+        if pair["prefixes"] == None:
+            for j, dxfile in enumerate(pair["files"]):
+                mapped_files[j].append(dxfile)
+            continue
+        pair_chunks = [fastq_split.list_chunks(chunk_prefix) for chunk_prefix in pair["prefixes"]]
+        try:
+            fastq_scatter.check_pairs(pair_chunks)
+        except RuntimeError as error:
+            raise dxpy.AppError("Read pairs of %s and %s do not match: %s" % (pair["names"][0], pair["names"][1], error))
+        for j, read_chunks in enumerate(pair_chunks):
+            for k, filename in enumerate(read_chunks):
+                chunks.append((j, (filename, "%s_chunk%04d.fastq.gz" % (remove_ext(pair["names"][j]), k + 1))))
+
+    pool = ThreadPool(processes = cpu_count())
+    try:
+        chunk_links = pool.map(upload_chunk, [chunk for j, chunk in chunks])
+    finally:
+        pool.close()
+        pool.join()
+    for (j, chunk), chunk_link in zip(chunks, chunk_links):
+        mapped_files[j].append(chunk_link)
+    return mapped_files[0], mapped_files[1]
+
+@dxpy.entry_point("scatter")
+def scatter(project_id, output_folder, fastq_files, genome_fasta_file, genome_index_file, mapper, mark_duplicates, 
+            chunk_size, fastq_files2=None, sample_name=None, properties=None, reference_bundle_file=None, 
+            tools_used=None):
+    """Splits the FASTQ files of a sample into chunks of reads of about 
+    'chunk_size' bytes, keeping read pairs in matching chunks, maps each
+    chunk in a process subjob and merges their BAM files with postprocess."""
+
+    logger = []
+
+    chunk_files, chunk_files2 = split_fastq_files(fastq_files, fastq_files2, chunk_size, logger)
+    print "Mapping %d chunks" % len(chunk_files)
+
+    mapping_input = { 
+                     "project_id" : project_id,
+                     "output_folder": output_folder,
+                     "genome_fasta_file": genome_fasta_file,
+                     "genome_index_file": genome_index_file,
+                     "mapper": mapper,
+                     "sample_name": sample_name,
+                     "mark_duplicates": mark_duplicates,
+                     "properties": properties 
+                    }
+    if reference_bundle_file != None:
+        mapping_input["reference_bundle_file"] = reference_bundle_file
+    return launch_mapping(mapping_input, chunk_files, chunk_files2, (tools_used or []) + [logger])
+
 @dxpy.entry_point('create_tools_used_json_file')
 def create_tools_used_json_file(project_id, output_folder, tools_used):
     ''' Description: 
@@ -275,66 +544,73 @@ def create_tools_used_json_file(project_id, output_folder, tools_used):
 @dxpy.entry_point("main")
 def main(fastq_files, genome_fasta_file, genome_index_file, mapper, project_id, 
          output_folder, mark_duplicates=False, fastq_files2=None, sample_name=None, 
-         properties=None):
+         properties=None, reference_bundle_file=None, use_reference_bundle=True,
+         prepare_reference_only=False, scatter_chunk_mb=0):
     """Spawn subjobs to map each of the FASTQ files (and their pairs,
     if provided) and merge the BAM files into a single BAM file, which
-    is output."""
+    is output. Unless a reference bundle is given, the bundle of the genome
+    files is looked up, and built by a prepare_reference subjob if there is
+    none yet. With 'prepare_reference_only', only the reference bundle is 
+    output, so that a controller can prepare it once for all its samples.
+    If 'scatter_chunk_mb' is set and a FASTQ file is larger, the files are
+    split into chunks of reads of about that size by a scatter subjob and
+    each chunk is mapped in its own subjob."""
 
     if fastq_files2 != None:
         assert len(fastq_files2) == len(fastq_files), \
             "fastq_files2 contains %s elements; expected %s" % (len(fastq_files2), len(fastq_files))
 
-    subjobs = []
-    for i in xrange(len(fastq_files)):
-        subjob_input = { 
-                        "project_id" : project_id,
-                        "output_folder": output_folder,
-                        "fastq_file": fastq_files[i],
-                        "genome_fasta_file": genome_fasta_file,
-                        "genome_index_file": genome_index_file,
-                        "mapper": mapper,
-                        "sample_name": sample_name,
-                        "mark_duplicates": mark_duplicates,
-                        "properties": properties 
-                       }
-        if fastq_files2 != None:
-            subjob_input["fastq_file2"] = fastq_files2[i]
-        subjobs.append(dxpy.new_dxjob(subjob_input, "process"))
-
-    if len(fastq_files) > 1:
-        postprocess_input = { 
+    prepare_jobs = []
+    if reference_bundle_file is None and use_reference_bundle:
+        reference_bundle_file = reference_bundle.find_reference_bundle(genome_fasta_file, genome_index_file, project_id)
+        if reference_bundle_file is None:
+            prepare_input = {
                              "project_id": project_id,
                              "output_folder": output_folder,
-                             "bam_files": [subjob.get_output_ref("bam") for subjob in subjobs],
-                             "sample_name": sample_name, 
-                             "properties": properties 
+                             "genome_fasta_file": genome_fasta_file,
+                             "genome_index_file": genome_index_file
                             }
-        postprocess_job = dxpy.new_dxjob(fn_input=postprocess_input, 
-                                         fn_name="postprocess", 
-                                         depends_on=subjobs
-                                        )
-        tools_used_input = {
-                            "project_id": project_id,
-                            "output_folder": output_folder,
-                            "tools_used": [job.get_output_ref("tools_used") for job in (subjobs + [postprocess_job])]
-                           }
-        tools_used_job = dxpy.new_dxjob(tools_used_input, "create_tools_used_json_file")
-        return {
-                "bam": postprocess_job.get_output_ref("bam"),
-                "bai": postprocess_job.get_output_ref("bai"),
-                "tools_used": tools_used_job.get_output_ref("tools_used_json_file")
-               }
+            prepare_job = dxpy.new_dxjob(prepare_input, "prepare_reference")
+            prepare_jobs.append(prepare_job)
+            reference_bundle_file = prepare_job.get_output_ref("reference_bundle")
+
+    if prepare_reference_only:
+        return {"reference_bundle": reference_bundle_file}
+
+    mapping_input = { 
+                     "project_id" : project_id,
+                     "output_folder": output_folder,
+                     "genome_fasta_file": genome_fasta_file,
+                     "genome_index_file": genome_index_file,
+                     "mapper": mapper,
+                     "sample_name": sample_name,
+                     "mark_duplicates": mark_duplicates,
+                     "properties": properties 
+                    }
+    if reference_bundle_file != None:
+        mapping_input["reference_bundle_file"] = reference_bundle_file
+    tools_used = [job.get_output_ref("tools_used") for job in prepare_jobs]
+
+    chunk_size = scatter_chunk_mb * 1024 * 1024
+    if chunk_size > 0 and max(get_file_sizes(fastq_files)) > chunk_size:
+        # Split the sample in a subjob, which launches the mapping subjobs
+        # once it knows how many chunks there are
+        scatter_input = dict(mapping_input)
+        scatter_input["fastq_files"] = fastq_files
+        if fastq_files2 != None:
+            scatter_input["fastq_files2"] = fastq_files2
+        scatter_input["chunk_size"] = chunk_size
+        scatter_input["tools_used"] = tools_used
+        scatter_job = dxpy.new_dxjob(scatter_input, "scatter")
+        output = {
+                  "bam": scatter_job.get_output_ref("bam"),
+                  "bai": scatter_job.get_output_ref("bai"),
+                  "tools_used": scatter_job.get_output_ref("tools_used")
+                 }
     else:
-        tools_used_input = {
-                            "project_id": project_id,
-                            "output_folder": output_folder,
-                            "tools_used": [job.get_output_ref('tools_used') for job in subjobs]
-                           }
-        tools_used_job = dxpy.new_dxjob(tools_used_input, "create_tools_used_json_file")
-        return {
-                "bam": subjobs[0].get_output_ref("bam"),
-                "bai": subjobs[0].get_output_ref("bai"),
-                "tools_used": tools_used_job.get_output_ref("tools_used_json_file")
-               }
+        output = launch_mapping(mapping_input, fastq_files, fastq_files2, tools_used)
+    if reference_bundle_file != None:
+        output["reference_bundle"] = reference_bundle_file
+    return output
 
 dxpy.run()
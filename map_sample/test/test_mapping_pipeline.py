@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+"""
+Runs the map_sample mapping pipeline on a tiny SAM file, with the CleanSam
+jar and samtools binary bundled in the applet resources.
+
+Requires java; skipped if it is not installed, or if the bundled samtools
+cannot run on this host.
+
+    python map_sample/test/test_mapping_pipeline.py
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import subprocess
+import distutils.spawn
+
+APPLET_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESOURCES_DIR = os.path.join(APPLET_DIR, 'resources')
+CLEAN_SAM_JAR = os.path.join(RESOURCES_DIR, 'CleanSam.jar')
+SAMTOOLS_DIR = os.path.join(RESOURCES_DIR, 'usr', 'bin')
+
+sys.path.append(os.path.join(RESOURCES_DIR, 'home', 'dnanexus'))
+import mapping_pipeline
+
+GENOME_FA = '>chr1\nACGTACGTTAGCCATGGATCCGATCGATTACAGGCATTGC\n'
+
+# Unsorted, with a read overhanging the end of chr1 (40 bp) that CleanSam
+# soft-clips and a mismatch that calmd records in the MD tag
+SAMPLE_SAM = '\n'.join([
+    '@HD\tVN:1.4\tSO:unsorted',
+    '@SQ\tSN:chr1\tLN:40',
+    'read1\t0\tchr1\t11\t60\t10M\t*\t0\t0\tGCCATGGATC\tIIIIIIIIII',
+    'read2\t0\tchr1\t1\t60\t10M\t*\t0\t0\tACGTACGTTA\tIIIIIIIIII',
+    'read3\t0\tchr1\t35\t60\t10M\t*\t0\t0\tCATTGCAAAA\tIIIIIIIIII',
+    'read4\t0\tchr1\t21\t60\t10M\t*\t0\t0\tCGATCGTTTA\tIIIIIIIIII',
+    ''])
+
+def samtools_runs():
+    with open(os.devnull, 'w') as DEVNULL:
+        try:
+            # Exits with 1 after printing its usage, or 127 if it cannot load
+            return subprocess.call([os.path.join(SAMTOOLS_DIR, 'samtools')], stdout=DEVNULL, stderr=DEVNULL) != 127
+        except OSError:
+            return False
+
+@unittest.skipUnless(distutils.spawn.find_executable('java') and samtools_runs(),
+                     'java and the bundled samtools are required')
+class MappingPipelineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        with open(os.path.join(self.tmpdir, 'genome.fa'), 'w') as GENOME:
+            GENOME.write(GENOME_FA)
+        with open(os.path.join(self.tmpdir, 'sample.sam'), 'w') as SAM:
+            SAM.write(SAMPLE_SAM)
+        self.env = dict(os.environ, PATH=SAMTOOLS_DIR + os.pathsep + os.environ['PATH'])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def run_pipeline(self, map_cmd):
+        cmd = mapping_pipeline.get_pipeline_command(map_cmd, 1, clean_sam_jar=CLEAN_SAM_JAR)
+        return subprocess.call(['bash', '-o', 'pipefail', '-c', cmd], cwd=self.tmpdir, env=self.env)
+
+    def test_pipeline_cleans_sorts_and_tags_reads(self):
+        self.assertEqual(self.run_pipeline('cat sample.sam'), 0)
+        records = subprocess.check_output(['samtools', 'view', 'sample.bam'], cwd=self.tmpdir,
+                                          env=self.env).splitlines()
+        reads = dict([(record.split('\t')[0], record.split('\t')) for record in records])
+        positions = [int(record.split('\t')[3]) for record in records]
+
+        self.assertEqual(sorted(reads.keys()), ['read1', 'read2', 'read3', 'read4'])
+        self.assertEqual(positions, sorted(positions))
+        self.assertEqual(reads['read3'][5], '6M4S')
+        for fields in reads.values():
+            self.assertTrue([tag for tag in fields[11:] if tag.startswith('MD:Z:')])
+        self.assertTrue('MD:Z:6A3' in reads['read4'])
+        self.assertEqual(os.listdir(self.tmpdir).count('sample.bam'), 1)
+        self.assertFalse([name for name in os.listdir(self.tmpdir) if name.startswith('sample.sorting')])
+
+    def test_pipeline_fails_with_mapper(self):
+        self.assertNotEqual(self.run_pipeline('cat sample.sam; false'), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -21,6 +21,9 @@ import textwrap
 import collections
 import os
 
+sys.path.append('/home/dnanexus')
+import run_metadata_index
+
 MISMATCH_PER_CYCLE_STATS_FN = 'mismatch_per_cycle.stats'
 RUN_DETAILS_JSON_FN = 'run_details.json'
 SAMPLE_STATS_JSON_FN = 'sample_stats.json'
@@ -219,23 +222,29 @@ def create_tools_used_file(tools_used):
             fh.write('\n')
     return TOOLS_USED_TXT_FN
 
-def group_files_by_read(fastq_files):
+def group_files_by_read(fastq_files, fastq_index=None):
     """
     Function : Groups a list of FASTQ files by the values of their Read property that indicates the read number.
                        Returns a dict mapping each observed value of the property (or 'none' if a file does not have a value
                          for the property) to a list of the files with that value. Within each group, the files are sorted by their
                        value of the Chunk property (to ensure that left and right reads of a given chunk are handled together.
     Args     : fastq_files - a list of dxpy.DXFile objects representing FASTQ files.
+               fastq_index - dict of file properties by file ID (see run_metadata_index.load_run_metadata())
     Returns  : dict.
     """
 
+    if fastq_index is None:
+        fastq_index = {}
+
     #print("Grouping Fastq files by read number")
     fastq_dxfiles = [dxpy.DXFile(item) for item in fastq_files]
     read_dict = {}
+    chunks = {}
 
     for fastq_dxfile in fastq_dxfiles:
-        props = fastq_dxfile.get_properties()
+        props = fastq_index.get(fastq_dxfile.get_id()) or fastq_dxfile.get_properties()
         read_num = props["read"]
+        chunks[fastq_dxfile.get_id()] = int(props.get("chunk", 1))
         if read_num not in ["1", "2", "none"]:
             raise dxpy.AppError("%s has invalid Read property: %s" % (fastq_dxfile.get_id(), read_num))
         if read_num not in read_dict:
@@ -243,26 +252,30 @@ def group_files_by_read(fastq_files):
         fastq_dxlink = dxpy.dxlink(fastq_dxfile)
         read_dict[read_num].append(fastq_dxlink)
 
-    #for read_num in read_dict:
-    #    read_dict[read_num] = sorted(read_dict[read_num], key=chunk_property)
+    for read_num in read_dict:
+        read_dict[read_num] = sorted(read_dict[read_num], key=lambda dxlink: chunks[dxlink['$dnanexus_link']])
 
     return read_dict
 
-def group_files_by_barcode(barcoded_files):
+def group_files_by_barcode(barcoded_files, fastq_index=None):
     """
     Group FASTQ files by sample according to their SampleID and Index
     properties. Returns a dict mapping (SampleID, Index) tuples to lists of
-    files.
+    files. Properties are taken from 'fastq_index' (see run_metadata_index.load_run_metadata()) 
+    when a file is listed there; other files, such as bams, are described.
     Note - since I have casava outputting each barcode read in a single file, the value of each group should be a single file for single-end sequencing,
      or two files for PE sequencing.
     """
+
+    if fastq_index is None:
+        fastq_index = {}
     
     print("Grouping files by barcode")
     dxfiles = [dxpy.DXFile(item) for item in barcoded_files]
     sample_dict = {}
 
     for dxfile in dxfiles:
-        props = dxfile.get_properties()
+        props = fastq_index.get(dxfile.get_id()) or dxfile.get_properties()
         barcode =  props["barcode"] #will be NoIndex if non-multiplex (see bcl2fatq UG sectino "FASTQ Files")
         if barcode not in sample_dict:
             sample_dict[barcode] = []
@@ -328,7 +341,7 @@ def qc_sample(fastq_files, sample_name, applet_id, applet_project, output_projec
     return output
 
 @dxpy.entry_point("main")
-def main(record_link, worker_id, worker_project, output_folder, fastqs, bams=None):
+def main(record_link, worker_id, worker_project, output_folder, fastqs, bams=None, run_metadata=None):
 
     lane = FlowcellLane(record_link=record_link)
 
@@ -341,8 +354,9 @@ def main(record_link, worker_id, worker_project, output_folder, fastqs, bams=Non
               "tools_used": []
              }
 
+    fastq_index = run_metadata_index.load_run_metadata(run_metadata)
     print "Grouping fastq files by barcode"
-    fastq_dict = group_files_by_barcode(fastqs)
+    fastq_dict = group_files_by_barcode(fastqs, fastq_index)
     if bams != None:
         print "Grouping bam files by barcode"
         bam_dict = group_files_by_barcode(bams)
@@ -350,7 +364,7 @@ def main(record_link, worker_id, worker_project, output_folder, fastqs, bams=Non
     jobs = []
     for barcode in fastq_dict:
         print 'Processing sample: %s' % barcode
-        read_dict = group_files_by_read(fastq_dict[barcode])
+        read_dict = group_files_by_read(fastq_dict[barcode], fastq_index)
         
         fastq_files2 = None
 
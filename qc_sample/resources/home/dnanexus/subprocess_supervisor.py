@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+
+"""
+Runs external commands under supervision.
+
+Output of the child is streamed line by line to the job log and, optionally,
+to a rotating log file, instead of being buffered in memory until the child
+exits. Only a bounded tail of the output is kept, for the error raised when
+the command fails. The command can be given a timeout, and a heartbeat line
+is logged periodically while it runs. CPU time and peak RSS of the child are
+taken from resource.getrusage(RUSAGE_CHILDREN).
+
+Shell commands run under bash, so 'pipefail=True' can be used to fail a
+pipeline when any of its commands fails.
+"""
+
+import os
+import sys
+import time
+import signal
+import logging
+import resource
+import threading
+import subprocess
+import collections
+import logging.handlers
+
+# Lines of output kept for error messages
+TAIL_LINES = 200
+# Seconds between heartbeat lines while a command is running
+HEARTBEAT_INTERVAL = 600
+# Rotating log file size and number of backups
+LOG_MAX_BYTES = 64 * 1024 * 1024
+LOG_BACKUP_COUNT = 3
+
+SHELL_EXECUTABLE = '/bin/bash'
+
+class CommandError(subprocess.CalledProcessError):
+
+    def __init__(self, returncode, cmd, tail, timed_out=False):
+        ''' Description: Raised when a supervised command fails or times out.
+
+        Attributes:
+        returncode (int): Return code of the command
+        cmd (str): Command line
+        output (str): Last lines of the command output
+        timed_out (bool): The command was killed after its timeout
+        '''
+
+        subprocess.CalledProcessError.__init__(self, returncode, cmd, output=tail)
+        self.timed_out = timed_out
+
+    def __str__(self):
+        if self.timed_out:
+            message = "Command '%s' timed out and was killed." % self.cmd
+        else:
+            message = "Command '%s' failed with return code %d." % (self.cmd, self.returncode)
+        return '%s\n\nLast lines of output:\n%s' % (message, self.output)
+
+CommandResult = collections.namedtuple('CommandResult', ['returncode', 'elapsed', 'user_time',
+                                                         'system_time', 'max_rss_kb', 'stdout'])
+
+def get_file_logger(log_file):
+    ''' Description: Returns a logger writing raw lines to a rotating log file.
+    '''
+
+    logger = logging.getLogger('subprocess_supervisor.%s' % os.path.abspath(log_file))
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    if not logger.handlers:
+        handler = logging.handlers.RotatingFileHandler(log_file,
+                                                       maxBytes = LOG_MAX_BYTES,
+                                                       backupCount = LOG_BACKUP_COUNT)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(handler)
+    return logger
+
+class OutputReader(threading.Thread):
+
+    def __init__(self, pipe, tail, file_logger=None, echo=True, capture=False):
+        ''' Description: Reads the output of a child process line by line,
+        copying each line to the job log and the log file, and keeping the last
+        lines in 'tail'. If 'capture' is set, all output is also kept in
+        'lines', for commands whose output is needed.
+        '''
+
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.pipe = pipe
+        self.tail = tail
+        self.file_logger = file_logger
+        self.echo = echo
+        self.capture = capture
+        self.lines = []
+        self.line_count = 0
+        self.last_output = time.time()
+
+    def run(self):
+        for line in iter(self.pipe.readline, ''):
+            self.line_count += 1
+            self.last_output = time.time()
+            self.tail.append(line)
+            if self.capture:
+                self.lines.append(line)
+                continue
+            if self.echo:
+                sys.stdout.write(line)
+                sys.stdout.flush()
+            if self.file_logger:
+                self.file_logger.info(line.rstrip('\n'))
+        self.pipe.close()
+
+def run(cmd, shell=True, log_file=None, timeout=None, heartbeat=HEARTBEAT_INTERVAL,
+        capture_stdout=False, pipefail=False, echo=True, tail_lines=TAIL_LINES):
+    ''' Description: Run 'cmd' and wait for it to finish, streaming its output.
+    Raises CommandError if the command fails or runs longer than 'timeout'
+    seconds.
+
+    Input:
+    cmd (str or list): Command; a string run by bash if 'shell', else an argv list
+    log_file (str): Rotating log file for the command output
+    timeout (int): Seconds after which the command (and its children) is killed
+    heartbeat (int): Seconds between heartbeat lines; None to disable
+    capture_stdout (bool): Return stdout instead of streaming it; stderr is
+                           still streamed
+    pipefail (bool): Fail a shell pipeline if any of its commands fails
+    echo (bool): Copy output to the job log
+
+    Returns: CommandResult. CPU times and peak RSS are those of all children
+    waited on by this process while the command ran, so they are approximate
+    when other commands run concurrently.
+    '''
+
+    if shell:
+        if pipefail:
+            cmd = 'set -o pipefail; ' + cmd
+        cmd_line = cmd
+    else:
+        cmd_line = subprocess.list2cmdline(cmd)
+
+    file_logger = None
+    if log_file:
+        file_logger = get_file_logger(log_file)
+        file_logger.info('$ %s' % cmd_line)
+
+    tail = collections.deque(maxlen=tail_lines)
+    usage_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start_time = time.time()
+
+    # A new process group, so a timeout kills every process of a pipeline
+    process = subprocess.Popen(cmd,
+                               shell = shell,
+                               executable = SHELL_EXECUTABLE if shell else None,
+                               stdout = subprocess.PIPE,
+                               stderr = subprocess.PIPE if capture_stdout else subprocess.STDOUT,
+                               preexec_fn = os.setsid)
+    readers = [OutputReader(process.stdout, tail, file_logger, echo, capture=capture_stdout)]
+    if capture_stdout:
+        readers.append(OutputReader(process.stderr, tail, file_logger, echo))
+    for reader in readers:
+        reader.start()
+
+    timed_out = False
+    last_heartbeat = start_time
+    # Poll quickly at first so short commands do not wait a full second
+    poll_interval = 0.01
+    while process.poll() is None:
+        time.sleep(poll_interval)
+        poll_interval = min(1.0, poll_interval * 2)
+        now = time.time()
+        if timeout and now - start_time > timeout:
+            print 'Timeout: killing %s after %d seconds' % (cmd_line, timeout)
+            timed_out = True
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except OSError:
+                pass
+            process.wait()
+            break
+        if heartbeat and now - last_heartbeat >= heartbeat:
+            last_output = max([reader.last_output for reader in readers])
+            print '[heartbeat] %s: running for %d s, %d lines of output, last output %d s ago' % (
+                                                    cmd_line[:80],
+                                                    now - start_time,
+                                                    sum([reader.line_count for reader in readers]),
+                                                    now - last_output)
+            sys.stdout.flush()
+            last_heartbeat = now
+
+    for reader in readers:
+        reader.join()
+    elapsed = time.time() - start_time
+    usage_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    result = CommandResult(returncode = process.returncode,
+                           elapsed = elapsed,
+                           user_time = usage_after.ru_utime - usage_before.ru_utime,
+                           system_time = usage_after.ru_stime - usage_before.ru_stime,
+                           max_rss_kb = usage_after.ru_maxrss,
+                           stdout = ''.join(readers[0].lines) if capture_stdout else None)
+    summary = 'Finished in %.1f s (user %.1f s, system %.1f s, max child RSS %d MB), return code %s' % (
+                                                    result.elapsed,
+                                                    result.user_time,
+                                                    result.system_time,
+                                                    result.max_rss_kb / 1024,
+                                                    result.returncode)
+    if echo:
+        print summary
+    if file_logger:
+        file_logger.info(summary)
+
+    if timed_out or process.returncode:
+        raise CommandError(process.returncode, cmd_line, ''.join(tail), timed_out=timed_out)
+    return result
@@ -5,22 +5,26 @@ Compute QC metrics on a sample.
 """
 
 import os
+import sys
 import subprocess
 import csv
 import json
 from multiprocessing import cpu_count
 import dxpy
 
+sys.path.append('/home/dnanexus')
+import subprocess_supervisor
+
 ALIGNERS = {'bwa_aln': 0, 'bwa_mem': 1, 'Bowtie2': 2}
 
-def run_cmd(cmd, logger, shell=True):
+def run_cmd(cmd, logger, shell=True, pipefail=False):
     if shell:
         save_cmd = cmd
     else:
         save_cmd = subprocess.list2cmdline(cmd)
     logger.append(save_cmd)
     print save_cmd
-    subprocess.check_call(cmd, shell=shell)
+    return subprocess_supervisor.run(cmd, shell=shell, pipefail=pipefail)
 
 def get_app_title():
     cmd = "dx describe `dx describe ${DX_JOB_ID} --json | jq -r '.applet'` --json | jq -r '.title'"
@@ -181,7 +185,7 @@ def collect_insert_size_metrics(bam_file, genome_fasta_file, output_project, out
         json_info = extract_json_from_ism("sample.insert_size_metrics")
         cmd = ("tar czvf sample_insert_size_metrics.tar.gz " +
                "sample.insert_size_metrics sample.insert_size_histogram")
-        subprocess.check_call(cmd, shell=True)
+        subprocess_supervisor.run(cmd)
 
         properties['file_type'] = 'insert_stats'
         ism_file = dxpy.upload_local_file(